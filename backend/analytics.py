@@ -0,0 +1,433 @@
+# Columnar analytics engine for uploaded interaction data
+# ----- Computes every basic_stats field from factorized id codes and bincount aggregations -----
+
+import sys
+import time
+import heapq
+import numpy as np
+import pandas as pd
+from headers import CustomerHeaders, ProductHeaders, InteractionHeaders
+from id_dictionary import factorize_ids
+from instrumentation import get_logger, timed
+
+DEFAULT_PURCHASES = 1
+DEFAULT_RATING = 4.0
+MIN_RATINGS_FOR_TOP_RATED = 2
+TOP_PRODUCTS = 5
+
+log = get_logger(__name__)
+
+
+class AnalyticsInputError(ValueError):
+    """Interaction data that analytics cannot be computed from."""
+
+
+@timed("clean")
+def clean_interaction_columns(interactions_df):
+    """
+    Cleaned id, purchase and rating columns, without copying the whole frame.
+
+    Purchases are coerced to int (default 1) and rows with no purchases are
+    dropped; ratings are coerced to float (default 4.0) and clipped to 1-5.
+
+    Returns:
+        tuple: (customer_ids, product_ids, purchases, ratings). Purchases and
+        ratings are NumPy arrays; ids are string arrays, or Categoricals when the
+        columns are interned, so they can be factorized on their codes.
+
+    Raises:
+        AnalyticsInputError: If a required id column is missing.
+    """
+    for col in (InteractionHeaders.CUSTOMER_ID, InteractionHeaders.PRODUCT_ID):
+        if col not in interactions_df.columns:
+            raise AnalyticsInputError(f"Missing required column: {col}")
+
+    num_rows = len(interactions_df)
+    if InteractionHeaders.PURCHASES in interactions_df.columns:
+        purchases = pd.to_numeric(interactions_df[InteractionHeaders.PURCHASES], errors='coerce')
+        purchases = purchases.fillna(DEFAULT_PURCHASES).to_numpy().astype(np.int64)
+    else:
+        purchases = np.full(num_rows, DEFAULT_PURCHASES, dtype=np.int64)
+
+    if InteractionHeaders.RATINGS in interactions_df.columns:
+        ratings = pd.to_numeric(interactions_df[InteractionHeaders.RATINGS], errors='coerce')
+        ratings = ratings.fillna(DEFAULT_RATING).clip(1, 5).to_numpy(dtype=np.float64)
+    else:
+        ratings = np.full(num_rows, DEFAULT_RATING)
+
+    customer_ids = interactions_df[InteractionHeaders.CUSTOMER_ID]
+    product_ids = interactions_df[InteractionHeaders.PRODUCT_ID]
+
+    valid = purchases > 0
+    if not valid.all():
+        customer_ids, product_ids = customer_ids[valid], product_ids[valid]
+        purchases, ratings = purchases[valid], ratings[valid]
+
+    return _clean_ids(customer_ids), _clean_ids(product_ids), purchases, ratings
+
+
+def _clean_ids(ids):
+    """Ids with missing values as 'Unknown'; interned ids stay categorical."""
+    if isinstance(ids.dtype, pd.CategoricalDtype):
+        if ids.hasnans:
+            if 'Unknown' not in ids.cat.categories:
+                ids = ids.cat.add_categories('Unknown')
+            ids = ids.fillna('Unknown')
+        return ids.array
+    return ids.fillna('Unknown').astype(str).to_numpy()
+
+
+def _bincount(codes, size, weights=None):
+    """Per-code counts, or sums of `weights`, for codes from `factorize_ids`; rows with code -1 (missing id) are left out."""
+    known = codes >= 0
+    if not known.all():
+        codes, weights = codes[known], None if weights is None else weights[known]
+    return np.bincount(codes, weights=weights, minlength=size)
+
+
+def _products_by_id(products_df):
+    """Product rows indexed by id (first row per id), or None without product data."""
+    if products_df is None or len(products_df) == 0 or ProductHeaders.PRODUCT_ID not in products_df.columns:
+        return None
+    products = products_df.drop_duplicates(ProductHeaders.PRODUCT_ID).set_index(ProductHeaders.PRODUCT_ID)
+    # Lookups are by id string; an interned index would carry the whole dataset's dictionary
+    products.index = products.index.astype(object)
+    return products
+
+
+def _product_details(products, product_id):
+    """Category and price of a product, when known."""
+    details = {}
+    if products is None or product_id not in products.index:
+        return details
+    row = products.loc[product_id]
+    if ProductHeaders.CATEGORY in products.columns and pd.notna(row[ProductHeaders.CATEGORY]):
+        details["category"] = str(row[ProductHeaders.CATEGORY])
+    if ProductHeaders.PRICE in products.columns:
+        price = pd.to_numeric(row[ProductHeaders.PRICE], errors='coerce')
+        if pd.notna(price) and price > 0:
+            details["price"] = round(float(price), 2)
+    return details
+
+
+def _distribution(customers_df, column):
+    if customers_df is None or column not in customers_df.columns:
+        return {}
+    return {str(k): int(v) for k, v in customers_df[column].value_counts().items()}
+
+
+@timed("analytics")
+def compute_basic_analytics(interactions_df, customers_df=None, products_df=None):
+    """
+    Calculate comprehensive analytics and return as dictionary.
+
+    Ids are factorized once and every per-user and per-product aggregate is a
+    single `np.bincount` over the codes.
+
+    Args:
+        interactions_df (pd.DataFrame): Interaction data.
+        customers_df (pd.DataFrame): Customer data, used for demographics.
+        products_df (pd.DataFrame): Product data, used for product details and revenue.
+
+    Returns:
+        dict: data_loaded flags and basic_stats, or an "error" entry.
+    """
+    analytics = {
+        "data_loaded": {
+            "customers": customers_df is not None and len(customers_df) > 0,
+            "products": products_df is not None and len(products_df) > 0,
+            "interactions": interactions_df is not None and len(interactions_df) > 0
+        },
+        "basic_stats": {}
+    }
+
+    if interactions_df is None:
+        analytics["error"] = "No interaction data available - DataFrame is None"
+        return analytics
+    if len(interactions_df) == 0:
+        analytics["error"] = "No interaction data available - DataFrame is empty"
+        return analytics
+
+    try:
+        customer_ids, product_ids, purchases, ratings = clean_interaction_columns(interactions_df)
+    except AnalyticsInputError as e:
+        analytics["error"] = str(e)
+        return analytics
+
+    if len(purchases) == 0:
+        analytics["error"] = "No valid data after cleaning"
+        return analytics
+
+    try:
+        stats = analytics["basic_stats"]
+
+        # Factorize ids once; sorted product codes keep groupby's tie-breaking order
+        user_codes, user_uniques = factorize_ids(customer_ids)
+        product_codes, product_uniques = factorize_ids(product_ids, sort=True)
+        user_purchases = _bincount(user_codes, len(user_uniques), purchases)
+        product_sales = _bincount(product_codes, len(product_uniques), purchases)
+        product_rating_sums = _bincount(product_codes, len(product_uniques), ratings)
+        product_rating_counts = _bincount(product_codes, len(product_uniques))
+
+        # 1. BASIC COUNTS
+        total_customers = len(user_uniques)
+        stats["unique_users"] = total_customers
+        stats["unique_products"] = len(product_uniques)
+        stats["total_purchases"] = int(purchases.sum())
+
+        # 2. USER ENGAGEMENT METRICS
+        repeat_customers = int((user_purchases > 1).sum())
+        stats["average_purchases_per_user"] = round(float(user_purchases.mean()), 2)
+        stats["repeat_customers"] = repeat_customers
+        stats["total_customers"] = total_customers
+        stats["retention_rate_percentage"] = round(repeat_customers / total_customers * 100, 2)
+
+        # 3. RATING ANALYTICS (ratings are already clipped to 1-5)
+        rating_values, rating_counts = np.unique(ratings, return_counts=True)
+        stats["average_rating_overall"] = round(float(ratings.mean()), 2)
+        stats["total_ratings_given"] = len(ratings)
+        stats["rating_distribution"] = {int(k): int(v) for k, v in zip(rating_values, rating_counts)}
+
+        # 4. PRODUCT PERFORMANCE
+        products = _products_by_id(products_df)
+
+        by_sales = np.argsort(-product_sales, kind="stable")
+        top_5 = []
+        for code in by_sales[:TOP_PRODUCTS]:
+            product_id = product_uniques[code]
+            top_5.append({
+                "product_id": str(product_id),
+                "total_purchases": int(product_sales[code]),
+                **_product_details(products, product_id)
+            })
+        stats["top_sold_product"] = top_5[0]
+
+        qualified = product_rating_counts >= MIN_RATINGS_FOR_TOP_RATED
+        if qualified.any():
+            mean_ratings = np.where(qualified, product_rating_sums / np.maximum(product_rating_counts, 1), -np.inf)
+            code = int(np.argmax(mean_ratings))
+            product_id = product_uniques[code]
+            stats["top_rated_product"] = {
+                "product_id": str(product_id),
+                "average_rating": round(float(mean_ratings[code]), 2),
+                "rating_count": int(product_rating_counts[code]),
+                **_product_details(products, product_id)
+            }
+        else:
+            stats["top_rated_product"] = {"message": f"No products with sufficient ratings (min {MIN_RATINGS_FOR_TOP_RATED})"}
+
+        stats["top_5_products_by_sales"] = top_5
+
+        # 5. REVENUE (products without a valid price contribute nothing)
+        total_revenue = 0.0
+        if products is not None and ProductHeaders.PRICE in products.columns:
+            prices = pd.to_numeric(products[ProductHeaders.PRICE], errors='coerce')
+            prices = prices.where(prices > 0).reindex(product_uniques).to_numpy(dtype=np.float64)
+            total_revenue = float(np.nansum(product_sales * prices))
+        stats["total_revenue"] = round(total_revenue, 2)
+        stats["average_spending_per_user"] = round(total_revenue / total_customers, 2)
+
+        # 6. DEMOGRAPHICS
+        stats["customer_demographics"] = {
+            "gender_distribution": _distribution(customers_df, CustomerHeaders.GENDER),
+            "age_group_distribution": _distribution(customers_df, CustomerHeaders.AGE_GROUP)
+        }
+        return analytics
+
+    except Exception as e:
+        log.exception("Analytics calculation failed")
+        analytics["error"] = f"Analytics calculation failed: {str(e)}"
+        return analytics
+
+
+class IncrementalAnalytics:
+    """
+    Mergeable sufficient statistics behind basic_stats, for append-only uploads.
+
+    Holds per-user purchase sums, per-product sales and rating sum/count, the
+    rating histogram and running totals. Folding in a batch of new rows only
+    touches the users and products in that batch, so the cost of an append is
+    proportional to the delta rather than the history:
+
+    - purchases are always positive, so a product can only enter the top sellers
+      if it was in the previous top list or in the new batch;
+    - top-rated candidates live in a max-heap whose stale entries are dropped
+      lazily when read.
+    """
+
+    def __init__(self):
+        self.user_purchases = {}
+        self.product_sales = {}
+        self.product_rating_sums = {}
+        self.product_rating_counts = {}
+        self.rating_histogram = {}
+        self.total_purchases = 0
+        self.rating_sum = 0.0
+        self.rating_count = 0
+        self.repeat_customers = 0
+        self.total_revenue = 0.0
+        self._top_sellers = []
+        self._rated_heap = []
+        self._products = None
+        self._prices = {}
+
+    @classmethod
+    def from_interactions(cls, interactions_df, products_df=None):
+        """Build the statistics for a full interaction history."""
+        state = cls()
+        state.set_products(products_df)
+        state.add_interactions(interactions_df)
+        return state
+
+    def set_products(self, products_df):
+        """Use `products_df` for product details and revenue; revenue is recomputed once."""
+        self._products = _products_by_id(products_df)
+        self._prices = {}
+        if self._products is not None:
+            if ProductHeaders.PRICE in self._products.columns:
+                prices = pd.to_numeric(self._products[ProductHeaders.PRICE], errors='coerce')
+                prices = prices[prices > 0]
+                self._prices = dict(zip(prices.index, prices.to_numpy(dtype=np.float64)))
+        self.total_revenue = sum(sales * self._prices.get(product_id, 0.0) for product_id, sales in self.product_sales.items())
+
+    @timed("analytics_append")
+    def add_interactions(self, interactions_df):
+        """
+        Fold new interaction rows into the statistics.
+
+        Returns:
+            int: Number of valid rows folded in.
+
+        Raises:
+            AnalyticsInputError: If a required id column is missing.
+        """
+        customer_ids, product_ids, purchases, ratings = clean_interaction_columns(interactions_df)
+        if len(purchases) == 0:
+            return 0
+
+        user_codes, user_uniques = factorize_ids(customer_ids)
+        product_codes, product_uniques = factorize_ids(product_ids)
+        user_purchases = _bincount(user_codes, len(user_uniques), purchases).astype(np.int64)
+        product_sales = _bincount(product_codes, len(product_uniques), purchases).astype(np.int64)
+        product_rating_sums = _bincount(product_codes, len(product_uniques), ratings)
+        product_rating_counts = _bincount(product_codes, len(product_uniques))
+        rating_values, rating_counts = np.unique(ratings, return_counts=True)
+
+        for customer_id, added in zip(user_uniques.tolist(), user_purchases.tolist()):
+            before = self.user_purchases.get(customer_id, 0)
+            self.user_purchases[customer_id] = before + added
+            if before <= 1 < before + added:
+                self.repeat_customers += 1
+
+        for product_id, sales, rating_sum, rating_count in zip(
+            product_uniques.tolist(), product_sales.tolist(), product_rating_sums.tolist(), product_rating_counts.tolist()
+        ):
+            self.product_sales[product_id] = self.product_sales.get(product_id, 0) + sales
+            self.product_rating_sums[product_id] = self.product_rating_sums.get(product_id, 0.0) + rating_sum
+            self.product_rating_counts[product_id] = count = self.product_rating_counts.get(product_id, 0) + rating_count
+            if count >= MIN_RATINGS_FOR_TOP_RATED:
+                heapq.heappush(self._rated_heap, (-self._mean_rating(product_id), product_id))
+            self.total_revenue += sales * self._prices.get(product_id, 0.0)
+
+        for value, count in zip(rating_values.tolist(), rating_counts.tolist()):
+            self.rating_histogram[value] = self.rating_histogram.get(value, 0) + count
+
+        self.total_purchases += int(purchases.sum())
+        self.rating_sum += float(ratings.sum())
+        self.rating_count += len(ratings)
+        self._top_sellers = heapq.nsmallest(
+            TOP_PRODUCTS,
+            set(self._top_sellers).union(product_uniques.tolist()),
+            key=lambda product_id: (-self.product_sales[product_id], product_id)
+        )
+        return len(purchases)
+
+    def _mean_rating(self, product_id):
+        return self.product_rating_sums[product_id] / self.product_rating_counts[product_id]
+
+    def _top_rated(self):
+        # Drop heap entries whose product has since been rated again
+        while self._rated_heap:
+            negative_mean, product_id = self._rated_heap[0]
+            if -negative_mean == self._mean_rating(product_id):
+                return product_id
+            heapq.heappop(self._rated_heap)
+        return None
+
+    def to_analytics(self, customers_df=None):
+        """Render the statistics in the same format as `compute_basic_analytics`."""
+        analytics = {
+            "data_loaded": {
+                "customers": customers_df is not None and len(customers_df) > 0,
+                "products": self._products is not None,
+                "interactions": self.rating_count > 0
+            },
+            "basic_stats": {}
+        }
+        if self.rating_count == 0:
+            analytics["error"] = "No valid data after cleaning"
+            return analytics
+
+        stats = analytics["basic_stats"]
+        total_customers = len(self.user_purchases)
+        stats["unique_users"] = total_customers
+        stats["unique_products"] = len(self.product_sales)
+        stats["total_purchases"] = self.total_purchases
+        stats["average_purchases_per_user"] = round(self.total_purchases / total_customers, 2)
+        stats["repeat_customers"] = self.repeat_customers
+        stats["total_customers"] = total_customers
+        stats["retention_rate_percentage"] = round(self.repeat_customers / total_customers * 100, 2)
+        stats["average_rating_overall"] = round(self.rating_sum / self.rating_count, 2)
+        stats["total_ratings_given"] = self.rating_count
+        stats["rating_distribution"] = {int(k): int(v) for k, v in sorted(self.rating_histogram.items())}
+
+        top_5 = [
+            {
+                "product_id": str(product_id),
+                "total_purchases": int(self.product_sales[product_id]),
+                **_product_details(self._products, product_id)
+            }
+            for product_id in self._top_sellers
+        ]
+        stats["top_sold_product"] = top_5[0]
+
+        product_id = self._top_rated()
+        if product_id is not None:
+            stats["top_rated_product"] = {
+                "product_id": str(product_id),
+                "average_rating": round(self._mean_rating(product_id), 2),
+                "rating_count": int(self.product_rating_counts[product_id]),
+                **_product_details(self._products, product_id)
+            }
+        else:
+            stats["top_rated_product"] = {"message": f"No products with sufficient ratings (min {MIN_RATINGS_FOR_TOP_RATED})"}
+
+        stats["top_5_products_by_sales"] = top_5
+        stats["total_revenue"] = round(self.total_revenue, 2)
+        stats["average_spending_per_user"] = round(self.total_revenue / total_customers, 2)
+        stats["customer_demographics"] = {
+            "gender_distribution": _distribution(customers_df, CustomerHeaders.GENDER),
+            "age_group_distribution": _distribution(customers_df, CustomerHeaders.AGE_GROUP)
+        }
+        return analytics
+
+
+if __name__ == "__main__":
+    # Benchmark: python analytics.py [num_interactions ...]
+    from synthetic_data import generate_frames
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1_000_000]
+    for size in sizes:
+        interactions, customers, products = generate_frames(size)
+        start = time.perf_counter()
+        compute_basic_analytics(interactions, customers, products)
+        full_seconds = time.perf_counter() - start
+
+        # Incremental: the same history folded in, then a 1% daily delta appended
+        state = IncrementalAnalytics.from_interactions(interactions, products)
+        delta, _, _ = generate_frames(max(1, size // 100), num_users=len(customers), num_items=len(products), seed=1)
+        start = time.perf_counter()
+        state.add_interactions(delta)
+        state.to_analytics(customers)
+        append_seconds = time.perf_counter() - start
+        print(f"{size:>9} interactions: full analytics {full_seconds:8.3f}s  append {len(delta)} rows {append_seconds:8.3f}s")
@@ -1,327 +1,84 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, send_file, g
 from flask_cors import CORS
 import numpy as np
 import pandas as pd
-import io
-import traceback
-from train_lightfm import train_model
-from email_sending import send_bulk_from_model
-import os
-
-# Column name constants for customers data
-class CustomerHeaders:
-    CUSTOMER_ID = 'CustomerID'
-    GENDER = 'Gender'
-    AGE_GROUP = 'AgeGroup'
-
-# Column name constants for products data  
-class ProductHeaders:
-    PRODUCT_ID = 'ProductID'
-    CATEGORY = 'ProductCategory'
-    PRICE = 'Price'
-
-# Column name constants for interactions data
-class InteractionHeaders:
-    CUSTOMER_ID = 'CustomerID'
-    PRODUCT_ID = 'ProductID'
-    PURCHASES = 'NumberOfPurchases'
-    RATINGS = 'Rating'
-    EMAIL = 'Email'
-
+from train_lightfm import load_recommendations, recommendations_file, training_hyperparameters
+from jobs import submit_training, get_job
+from email_sending import start_campaign
+from email_ledger import campaign_status, CampaignRunningError
+from online_recommendations import recommend_rewards, stored_rewards
+from recommendation_store import open_store
+from model_registry import model_path, MODEL_ID_PATTERN
 import os
+import shutil
 import tempfile
 from werkzeug.utils import secure_filename
+from ingestion import spool_to_disk, read_csv_file, read_interactions_aggregated, AGGREGATE_INTERACTIONS
+from schema import read_csv_text
+from analytics import compute_basic_analytics, IncrementalAnalytics
+from dataset_store import current_dataset, publish_dataset, append_frame, dataset_lock, FRAME_KINDS
+from training_cache import fingerprint, find_cached_run, remember_run
+import time
+import logging
+from instrumentation import get_logger, span, inc, observe, render as render_metrics
 
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
+log = get_logger(__name__)
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 # Create upload directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-ALLOWED_EXTENSIONS = {'csv'}
+ALLOWED_EXTENSIONS = {'csv', 'csv.gz'}
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    filename = filename.lower()
+    return any(filename.endswith(f'.{extension}') for extension in ALLOWED_EXTENSIONS)
 
-customers_df = None # dataframe for customer metadata
-products_df = None # product data e.g. price
-interactions_df = None #interactions done per product purchased
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-def calculate_basic_analytics():
+@app.after_request
+def record_request_metrics(response):
+    """Count every request and its latency, labelled by route pattern rather than raw path"""
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    if hasattr(g, "request_started"):
+        observe("http_request_seconds", time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Counters and latency histograms of every worker and training process, in Prometheus text format"""
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Uploaded customers, products and interactions live in the shared dataset store
+# (backend/datasets), so every gunicorn worker sees the latest upload and maps
+# the same pages instead of holding its own DataFrames.
+
+def calculate_basic_analytics(dataset):
     """Calculate comprehensive analytics and return as dictionary"""
-    print("=== STARTING ANALYTICS CALCULATION ===")
-    
-    analytics = {
-        "data_loaded": {
-            "customers": customers_df is not None and len(customers_df) > 0,
-            "products": products_df is not None and len(products_df) > 0, 
-            "interactions": interactions_df is not None and len(interactions_df) > 0
-        },
-        "basic_stats": {}
-    }
-    
-    print(f"Data loaded status: {analytics['data_loaded']}")
-    
-    try:
-        if interactions_df is None:
-            print("ERROR: interactions_df is None")
-            analytics["error"] = "No interaction data available - DataFrame is None"
-            return analytics
-            
-        if len(interactions_df) == 0:
-            print("ERROR: interactions_df is empty")
-            analytics["error"] = "No interaction data available - DataFrame is empty"
-            return analytics
-        
-        print(f"Interactions shape: {interactions_df.shape}")
-        print(f"Interactions columns: {interactions_df.columns.tolist()}")
-        print(f"Interactions dtypes:\n{interactions_df.dtypes}")
-        
-        # Create working copy and ensure data quality
-        print("Creating working copy...")
-        working_df = interactions_df.copy()
-        print(f"Working copy created with shape: {working_df.shape}")
-        
-        # Clean and validate required columns
-        required_columns = {
-            InteractionHeaders.CUSTOMER_ID: str,
-            InteractionHeaders.PRODUCT_ID: str,
-            InteractionHeaders.PURCHASES: int,
-            InteractionHeaders.RATINGS: float
-        }
-        
-        print("Validating required columns...")
-        for col, dtype in required_columns.items():
-            print(f"Processing column: {col}")
-            
-            if col not in working_df.columns:
-                print(f"Column {col} missing, creating with defaults...")
-                if col == InteractionHeaders.PURCHASES:
-                    working_df[col] = 1
-                elif col == InteractionHeaders.RATINGS:
-                    working_df[col] = 4.0
-                else:
-                    print(f"ERROR: Missing required column: {col}")
-                    analytics["error"] = f"Missing required column: {col}"
-                    return analytics
-            
-            print(f"Converting {col} to {dtype}")
-            # Convert data types and handle nulls more carefully
-            if dtype == int:
-                print(f"  Before conversion - {col} unique values: {working_df[col].unique()[:10]}")
-                # Handle None, NaN, and string values
-                working_df[col] = pd.to_numeric(working_df[col], errors='coerce')
-                working_df[col] = working_df[col].fillna(1)
-                working_df[col] = working_df[col].astype(int)
-                print(f"  After conversion - {col} unique values: {working_df[col].unique()[:10]}")
-                # Filter out invalid purchases using boolean indexing
-                print(f"  Filtering {col} > 0...")
-                valid_mask = working_df[col] > 0
-                working_df = working_df[valid_mask].copy()
-                print(f"  After filtering shape: {working_df.shape}")
-            elif dtype == float:
-                print(f"  Before conversion - {col} unique values: {working_df[col].unique()[:10]}")
-                # Handle None, NaN, and string values  
-                working_df[col] = pd.to_numeric(working_df[col], errors='coerce')
-                working_df[col] = working_df[col].fillna(4.0)
-                working_df[col] = working_df[col].clip(1, 5)  # Ensure ratings are 1-5
-                print(f"  After conversion - {col} unique values: {working_df[col].unique()[:10]}")
-            else:
-                print(f"  Converting {col} to string...")
-                # Handle string columns
-                working_df[col] = working_df[col].fillna('Unknown').astype(str)
-                print(f"  After conversion - {col} sample values: {working_df[col].unique()[:5]}")
-        
-        if len(working_df) == 0:
-            print("ERROR: No valid data after cleaning")
-            analytics["error"] = "No valid data after cleaning"
-            return analytics
-        
-        print(f"Cleaned data shape: {working_df.shape}")
-        print("Sample cleaned data:")
-        print(working_df.head())
-        
-        # 1. BASIC COUNTS
-        print("Calculating basic counts...")
-        analytics["basic_stats"]["unique_users"] = int(working_df[InteractionHeaders.CUSTOMER_ID].nunique())
-        analytics["basic_stats"]["unique_products"] = int(working_df[InteractionHeaders.PRODUCT_ID].nunique())
-        analytics["basic_stats"]["total_purchases"] = int(working_df[InteractionHeaders.PURCHASES].sum())
-        print(f"Basic counts: {analytics['basic_stats']}")
-        
-        # 2. USER ENGAGEMENT METRICS
-        print("Calculating user engagement metrics...")
-        user_purchases = working_df.groupby(InteractionHeaders.CUSTOMER_ID)[InteractionHeaders.PURCHASES].sum()
-        print(f"User purchases calculated: {len(user_purchases)} users")
-        
-        if len(user_purchases) > 0:
-            # Average purchases per user
-            avg_purchases = user_purchases.mean()
-            analytics["basic_stats"]["average_purchases_per_user"] = round(float(avg_purchases), 2) if pd.notna(avg_purchases) else 0
-            
-            # Retention metrics - handle None values carefully
-            repeat_customers = 0
-            total_customers = len(user_purchases)
-            
-            for purchase_count in user_purchases:
-                if pd.notna(purchase_count) and purchase_count > 1:
-                    repeat_customers += 1
-            
-            retention_rate = (repeat_customers / total_customers * 100) if total_customers > 0 else 0
-            
-            analytics["basic_stats"]["repeat_customers"] = repeat_customers
-            analytics["basic_stats"]["total_customers"] = total_customers
-            analytics["basic_stats"]["retention_rate_percentage"] = round(retention_rate, 2)
-        else:
-            analytics["basic_stats"]["average_purchases_per_user"] = 0
-            analytics["basic_stats"]["repeat_customers"] = 0
-            analytics["basic_stats"]["total_customers"] = 0
-            analytics["basic_stats"]["retention_rate_percentage"] = 0
-        
-        print(f"User engagement metrics: {analytics['basic_stats']}")
-        
-        # 3. RATING ANALYTICS
-        print("Calculating rating analytics...")
-        # Filter for valid ratings (not null and between 1-5)
-        valid_ratings_mask = (
-            working_df[InteractionHeaders.RATINGS].notna() & 
-            (working_df[InteractionHeaders.RATINGS] >= 1) & 
-            (working_df[InteractionHeaders.RATINGS] <= 5)
-        )
-        valid_ratings = working_df[valid_ratings_mask]
-        print(f"Valid ratings found: {len(valid_ratings)}")
-        
-        if len(valid_ratings) > 0:
-            avg_rating = valid_ratings[InteractionHeaders.RATINGS].mean()
-            analytics["basic_stats"]["average_rating_overall"] = round(float(avg_rating), 2) if pd.notna(avg_rating) else 0
-            analytics["basic_stats"]["total_ratings_given"] = len(valid_ratings)
-            
-            # Rating distribution
-            rating_dist = valid_ratings[InteractionHeaders.RATINGS].value_counts().sort_index()
-            analytics["basic_stats"]["rating_distribution"] = {int(k): int(v) for k, v in rating_dist.items() if pd.notna(k)}
-        else:
-            analytics["basic_stats"]["average_rating_overall"] = 0
-            analytics["basic_stats"]["total_ratings_given"] = 0
-            analytics["basic_stats"]["rating_distribution"] = {}
-        
-        print(f"Rating analytics: {analytics['basic_stats']}")
-        
-        # 4. PRODUCT PERFORMANCE
-        print("Calculating product performance...")
-        # Top sold product by total purchases
-        product_sales = working_df.groupby(InteractionHeaders.PRODUCT_ID)[InteractionHeaders.PURCHASES].sum().sort_values(ascending=False)
-        print(f"Product sales calculated for {len(product_sales)} products")
-        
-        if len(product_sales) > 0:
-            top_product_id = product_sales.index[0]
-            top_sold_info = {
-                "product_id": str(top_product_id),
-                "total_purchases": int(product_sales.iloc[0])
-            }
-            
-            # Add product details if available
-            if products_df is not None and len(products_df) > 0:
-                print(f"Adding product details for {top_product_id}")
-                product_detail = products_df[products_df[ProductHeaders.PRODUCT_ID] == top_product_id]
-                if not product_detail.empty:
-                    if ProductHeaders.CATEGORY in product_detail.columns:
-                        category = product_detail.iloc[0][ProductHeaders.CATEGORY]
-                        if pd.notna(category):
-                            top_sold_info["category"] = str(category)
-                    
-                    if ProductHeaders.PRICE in product_detail.columns:
-                        price = pd.to_numeric(product_detail.iloc[0][ProductHeaders.PRICE], errors='coerce')
-                        if pd.notna(price) and price > 0:
-                            top_sold_info["price"] = round(float(price), 2)
-            
-            analytics["basic_stats"]["top_sold_product"] = top_sold_info
-        
-        # Top rated product (minimum 2 ratings for reliability)
-        print("Calculating top rated product...")
-        try:
-            product_ratings = working_df.groupby(InteractionHeaders.PRODUCT_ID)[InteractionHeaders.RATINGS].agg(['mean', 'count']).reset_index()
-            print(f"Product ratings calculated for {len(product_ratings)} products")
-            
-            # Safely filter products with sufficient ratings
-            qualified_mask = product_ratings['count'] >= 2
-            qualified_products = product_ratings[qualified_mask]
-            print(f"Qualified products (>=2 ratings): {len(qualified_products)}")
-            
-            if not qualified_products.empty and len(qualified_products) > 0:
-                # Find product with highest average rating
-                max_rating_idx = qualified_products['mean'].idxmax()
-                if pd.notna(max_rating_idx):
-                    top_rated = qualified_products.loc[max_rating_idx]
-                    
-                    top_rated_info = {
-                        "product_id": str(top_rated[InteractionHeaders.PRODUCT_ID]),
-                        "average_rating": round(float(top_rated['mean']), 2) if pd.notna(top_rated['mean']) else 0,
-                        "rating_count": int(top_rated['count']) if pd.notna(top_rated['count']) else 0
-                    }
-                    
-                    # Add product details
-                    if products_df is not None and len(products_df) > 0:
-                        product_detail = products_df[products_df[ProductHeaders.PRODUCT_ID] == top_rated[InteractionHeaders.PRODUCT_ID]]
-                        if not product_detail.empty:
-                            if ProductHeaders.CATEGORY in product_detail.columns:
-                                category = product_detail.iloc[0][ProductHeaders.CATEGORY]
-                                if pd.notna(category):
-                                    top_rated_info["category"] = str(category)
-                            
-                            if ProductHeaders.PRICE in product_detail.columns:
-                                price = pd.to_numeric(product_detail.iloc[0][ProductHeaders.PRICE], errors='coerce')
-                                if pd.notna(price) and price > 0:
-                                    top_rated_info["price"] = round(float(price), 2)
-                    
-                    analytics["basic_stats"]["top_rated_product"] = top_rated_info
-                else:
-                    analytics["basic_stats"]["top_rated_product"] = {"message": "No products with sufficient ratings (min 2)"}
-            else:
-                analytics["basic_stats"]["top_rated_product"] = {"message": "No products with sufficient ratings (min 2)"}
-        except Exception as e:
-            print(f"Error calculating top rated product: {e}")
-            traceback.print_exc()
-            analytics["basic_stats"]["top_rated_product"] = {"message": f"Error calculating top rated product: {str(e)}"}
-        
-        # Continue with simplified calculations for now
-        print("Setting basic defaults for remaining metrics...")
-        analytics["basic_stats"]["top_5_products_by_sales"] = []
-        analytics["basic_stats"]["total_revenue"] = 0
-        analytics["basic_stats"]["average_spending_per_user"] = 0
-        analytics["basic_stats"]["customer_demographics"] = {
-            "gender_distribution": {},
-            "age_group_distribution": {}
-        }
-        
-        print("Analytics calculation completed successfully")
-        print(f"Final analytics: {analytics}")
-        return analytics
-        
-    except Exception as e:
-        print(f"CRITICAL ERROR in analytics calculation: {e}")
-        print(f"Error type: {type(e)}")
-        traceback.print_exc()
-        analytics["error"] = f"Analytics calculation failed: {str(e)}"
-        return analytics
+    analytics = compute_basic_analytics(
+        dataset.frame('interactions'), dataset.frame('customers'), dataset.frame('products')
+    )
+    if "error" in analytics:
+        log.error("Analytics calculation failed: %s", analytics['error'])
+    return analytics
 
 
 @app.route('/upload_data', methods=['POST'])
 def upload_data_json(num_of_rewards=3):
     """Upload CSV data as JSON strings and return basic analytics"""
-    global customers_df, products_df, interactions_df
-    
-    print("=== UPLOAD ENDPOINT HIT ===")
-    
     try:
-        print("Step 1: Checking request data...")
         # Check if request has data
         if not request.data:
-            print("ERROR: No request data")
+            log.warning("Upload rejected: no request data")
             return jsonify({"error": "No data received", "status": "error"}), 400
         
-        print("Step 2: Checking content length...")
         # Get content length to check size
         content_length = request.content_length
         # max_content_length = app.config.get('MAX_CONTENT_LENGTH') or (16 * 1024 * 1024)  # Default to 16MB
@@ -336,195 +93,420 @@ def upload_data_json(num_of_rewards=3):
         #         "status": "error"
         #     }), 413
         
-        print("Step 3: Parsing JSON...")
         data = request.get_json()
         if not data:
-            print("ERROR: Invalid JSON data")
+            log.warning("Upload rejected: invalid JSON data")
             return jsonify({"error": "Invalid JSON data", "status": "error"}), 400
         
-        print(f"Received data keys: {list(data.keys())}")
+        log.debug("Received data keys: %s", list(data.keys()))
         
         uploaded_data = {}
         debug_info = {}
-        
-        print("Step 4: Processing uploaded data...")
+        frames = {}
         
         # Process customers data
         if 'customers' in data and data['customers']:
-            print("Processing customers data...")
             try:
-                customers_df = pd.read_csv(io.StringIO(data['customers']))
+                customers_df = read_csv_text(data['customers'], 'customers', debug_info)
+                frames['customers'] = customers_df
                 uploaded_data['customers'] = f"Loaded {len(customers_df)} customer records"
                 debug_info['customers_headers'] = list(customers_df.columns)
-                print(f"Customers loaded: {len(customers_df)} records")
-                print(f"Customers columns: {customers_df.columns.tolist()}")
+                log.info("Customers loaded: %d records", len(customers_df))
+                log.debug("Customers columns: %s", customers_df.columns.tolist())
             except Exception as e:
-                print(f"Error processing customers: {e}")
+                log.warning("Error processing customers: %s", e)
                 return jsonify({"error": f"Error processing customers data: {str(e)}", "status": "error"}), 400
         
         # Process products data
         if 'products' in data and data['products']:
-            print("Processing products data...")
             try:
-                products_df = pd.read_csv(io.StringIO(data['products']))
+                products_df = read_csv_text(data['products'], 'products', debug_info)
+                frames['products'] = products_df
                 uploaded_data['products'] = f"Loaded {len(products_df)} product records"
                 debug_info['products_headers'] = list(products_df.columns)
-                print(f"Products loaded: {len(products_df)} records")
-                print(f"Products columns: {products_df.columns.tolist()}")
+                log.info("Products loaded: %d records", len(products_df))
+                log.debug("Products columns: %s", products_df.columns.tolist())
             except Exception as e:
-                print(f"Error processing products: {e}")
+                log.warning("Error processing products: %s", e)
                 return jsonify({"error": f"Error processing products data: {str(e)}", "status": "error"}), 400
         
         # Process interactions data
         if 'interactions' in data and data['interactions']:
-            print("Processing interactions data...")
             try:
-                # Read CSV and immediately handle duplicate columns
-                csv_data = data['interactions']
-                print("Raw CSV first few lines:")
-                print('\n'.join(csv_data.split('\n')[:3]))
-                
-                interactions_df = pd.read_csv(io.StringIO(csv_data))
-                
-                print(f"Loaded {len(interactions_df)} interaction records")
-                print("Original headers:", interactions_df.columns.tolist())
-                print("Column counts:", interactions_df.columns.value_counts().to_dict())
-                
-                # Clean up column names (strip whitespace)
-                interactions_df.columns = interactions_df.columns.str.strip()
-                
-                # Handle duplicate columns by renaming them
-                cols = interactions_df.columns.tolist()
-                seen = {}
-                new_cols = []
-                for col in cols:
-                    if col in seen:
-                        seen[col] += 1
-                        new_cols.append(f"{col}_{seen[col]}")
-                        print(f"Renamed duplicate column '{col}' to '{col}_{seen[col]}'")
-                    else:
-                        seen[col] = 0
-                        new_cols.append(col)
-                
-                interactions_df.columns = new_cols
-                print("Headers after duplicate handling:", interactions_df.columns.tolist())
-                
-                # Remove any completely empty columns
-                interactions_df = interactions_df.dropna(axis=1, how='all')
-                print("Headers after removing empty columns:", interactions_df.columns.tolist())
-                
-                # Auto-fix common header variations and map to our expected headers
-                header_mapping = {
-                    # Current header -> Our expected header
-                    'Rating': InteractionHeaders.RATINGS,
-                    'Rating_1': InteractionHeaders.RATINGS,  # Handle duplicate
-                    'rating': InteractionHeaders.RATINGS,
-                    'ratings': InteractionHeaders.RATINGS,
-                    'NumberOfPurchases': InteractionHeaders.PURCHASES,
-                    'Purchases': InteractionHeaders.PURCHASES,
-                    'purchase': InteractionHeaders.PURCHASES,
-                    'Purchase': InteractionHeaders.PURCHASES,
-                    'PurchaseCount': InteractionHeaders.PURCHASES,
-                    'Email': InteractionHeaders.EMAIL,
-                    'email': InteractionHeaders.EMAIL,
-                    'CustomerID': InteractionHeaders.CUSTOMER_ID,
-                    'ProductID': InteractionHeaders.PRODUCT_ID
-                }
-                
-                # Apply header mapping
-                rename_dict = {}
-                for current_col in interactions_df.columns:
-                    if current_col in header_mapping:
-                        rename_dict[current_col] = header_mapping[current_col]
-                
-                interactions_df.rename(columns=rename_dict, inplace=True)
-                print("Headers after mapping:", interactions_df.columns.tolist())
-                
-                # Handle Email column
-                if InteractionHeaders.EMAIL not in interactions_df.columns:
-                    interactions_df[InteractionHeaders.EMAIL] = "No Email Provided"
-                else:
-                    interactions_df[InteractionHeaders.EMAIL] = interactions_df[InteractionHeaders.EMAIL].fillna("No Email Provided")
-                
-                # Create missing required columns with default values
-                required_columns = {
-                    InteractionHeaders.PURCHASES: 1, 
-                    InteractionHeaders.RATINGS: 4
-                }
-                
-                columns_created = []
-                for col_name, default_value in required_columns.items():
-                    if col_name not in interactions_df.columns:
-                        interactions_df[col_name] = default_value
-                        columns_created.append(f"'{col_name}' (default: {default_value})")
-                
-                if columns_created:
-                    debug_info['columns_auto_created'] = f"Auto-created columns: {', '.join(columns_created)}"
-                
-                # Ensure we have the core required columns
-                required_core_columns = [InteractionHeaders.CUSTOMER_ID, InteractionHeaders.PRODUCT_ID]
-                missing_core = [col for col in required_core_columns if col not in interactions_df.columns]
-                if missing_core:
-                    raise ValueError(f"Missing required columns: {missing_core}")
-                
-                # Convert numeric columns
-                numeric_columns = [InteractionHeaders.PURCHASES, InteractionHeaders.RATINGS]
-                for col in numeric_columns:
-                    if col in interactions_df.columns:
-                        interactions_df[col] = pd.to_numeric(interactions_df[col], errors='coerce').fillna(1 if col == InteractionHeaders.PURCHASES else 4)
-                
-                print("Final headers:", interactions_df.columns.tolist())
-                print("Final data types:", interactions_df.dtypes.to_dict())
-                print("Sample processed data:")
-                print(interactions_df.head())
+                # Headers are resolved from the first line and only known columns are parsed
+                interactions_df = read_csv_text(data['interactions'], 'interactions', debug_info)
+                frames['interactions'] = interactions_df
+                log.info("Interactions loaded: %d records", len(interactions_df))
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Final data types: %s", interactions_df.dtypes.to_dict())
                 
                 uploaded_data['interactions'] = f"Loaded {len(interactions_df)} interaction records"
                 debug_info['interactions_headers'] = list(interactions_df.columns)
                 
             except Exception as e:
-                print(f"Error processing interactions: {e}")
-                traceback.print_exc()
+                log.warning("Error processing interactions: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
                 return jsonify({"error": f"Error processing interactions data: {str(e)}", "status": "error"}), 400
         
-        print("Debug info:", debug_info)
+        log.debug("Debug info: %s", debug_info)
         
         if not uploaded_data:
-            print("ERROR: No valid CSV data provided")
+            log.warning("Upload rejected: no valid CSV data provided")
             return jsonify({"error": "No valid CSV data provided", "status": "error"}), 400
         
-        print("Step 5: Data upload successful. Processing analytics...")
-        
-        # Calculate analytics after upload
-        analytics = calculate_basic_analytics()
-        
-        print("Step 6: Analytics completed, returning response...")
-        recommended_rewards = train_model(interactions_df, customers_df, products_df, num_of_rewards)
+        dataset = publish_dataset(frames)
+        return analytics_and_training_response(dataset, uploaded_data, debug_info, num_of_rewards)
+    
+    except Exception as e:
+        log.exception("Error in upload endpoint")
+        return jsonify({"error": str(e), "status": "error"}), 400
+
+def analytics_and_training_response(dataset, uploaded_data, debug_info, num_of_rewards, analytics=None):
+    """Calculate analytics for the published dataset, queue model training and build the upload response
+
+    Data and settings identical to an earlier upload reuse its analytics and training job instead.
+    `analytics` already computed while streaming the upload are used as they are.
+    """
+    with span("fingerprint"):
+        key = fingerprint({kind: dataset.frame(kind) for kind in FRAME_KINDS}, training_hyperparameters(num_of_rewards))
+    cached = find_cached_run(key)
+    inc("training_cache_lookups_total", result="miss" if cached is None else "hit")
+    if cached is not None:
+        log.info("Identical upload seen before, reusing training job %s (model %s)", cached['job_id'], cached['model_id'])
+        job = get_job(cached['job_id'])
         return jsonify({
-            "message": "Data uploaded successfully", 
+            "message": "Data uploaded successfully, reusing the model trained on identical data",
             "status": "success",
+            "cached": True,
+            "model_id": cached['model_id'],
+            "dataset_id": dataset.dataset_id,
             "uploaded": uploaded_data,
-            "debug_info": debug_info,  # Show actual headers for debugging
-            "analytics": analytics,
-            "recommended_rewards": recommended_rewards
+            "debug_info": debug_info,
+            "analytics": cached['analytics'],
+            "training_job": {
+                "job_id": cached['job_id'],
+                "state": job['state'],
+                "status_url": f"/jobs/{cached['job_id']}"
+            }
         })
     
+    # Calculate analytics after upload
+    if analytics is None:
+        analytics = calculate_basic_analytics(dataset)
+    
+    # Training runs in the background; poll /jobs/<job_id> for progress and the model_id
+    job_id = submit_training(
+        dataset.frame('interactions'), dataset.frame('customers'), dataset.frame('products'), num_of_rewards
+    )
+    remember_run(key, job_id, analytics)
+    return jsonify({
+        "cached": False,
+        "dataset_id": dataset.dataset_id,
+        "message": "Data uploaded successfully", 
+        "status": "success",
+        "uploaded": uploaded_data,
+        "debug_info": debug_info,  # Show actual headers for debugging
+        "analytics": analytics,
+        "training_job": {
+            "job_id": job_id,
+            "state": "queued",
+            "status_url": f"/jobs/{job_id}"
+        }
+    })
+
+@app.route('/upload_files', methods=['POST'])
+def upload_data_files(num_of_rewards=3):
+    """Upload CSV files (optionally gzip-compressed) as multipart form data and return basic analytics
+
+    Files are spooled to disk and parsed in chunks, so the request body is never held in memory.
+    With aggregate=true (or AGGREGATE_INTERACTIONS set) interactions are streamed into one row per
+    customer-product pair and analytics are computed on the way, for files larger than memory.
+    """
+    uploaded_data = {}
+    debug_info = {}
+    frames = {}
+    extras = None
+    aggregate = request.values.get('aggregate', str(AGGREGATE_INTERACTIONS)).lower() in ('1', 'true', 'yes')
+    spool_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+    
+    try:
+        for kind in ('customers', 'products', 'interactions'):
+            file = request.files.get(kind)
+            if file is None or not file.filename:
+                continue
+            if not allowed_file(file.filename):
+                return jsonify({"error": f"Unsupported file type for {kind}: {file.filename}", "status": "error"}), 400
+            
+            try:
+                path = os.path.join(spool_dir, f"{kind}_{secure_filename(file.filename)}")
+                size = spool_to_disk(file, path)
+                log.debug("Spooled %s upload (%d bytes) to %s", kind, size, path)
+                if kind == 'interactions' and aggregate:
+                    df, analytics_state, aggregator = read_interactions_aggregated(
+                        path, debug_info=debug_info, products_df=frames.get('products')
+                    )
+                    # Appends fold into the same analytics state and pairs
+                    extras = {'analytics': analytics_state, 'aggregated': aggregator}
+                    uploaded_data[kind] = f"Loaded {aggregator.rows} interaction records as {len(df)} customer-product pairs"
+                else:
+                    df = read_csv_file(path, kind, debug_info=debug_info)
+                    uploaded_data[kind] = f"Loaded {len(df)} {kind[:-1]} records"
+                frames[kind] = df
+                
+                debug_info[f'{kind}_headers'] = list(df.columns)
+            except Exception as e:
+                log.warning("Error processing %s: %s", kind, e, exc_info=log.isEnabledFor(logging.DEBUG))
+                return jsonify({"error": f"Error processing {kind} data: {str(e)}", "status": "error"}), 400
+        
+        if not uploaded_data:
+            log.warning("Upload rejected: no valid CSV files provided")
+            return jsonify({"error": "No valid CSV files provided", "status": "error"}), 400
+        
+        log.info("File upload parsed: %s", uploaded_data)
+        with dataset_lock():
+            current = current_dataset()
+            if 'interactions' not in frames and current is not None and current.extras.get('aggregated') is not None:
+                # The stored interactions stay aggregated pairs, so their state carries over for later appends
+                extras = current.extras
+                if 'products' in frames:
+                    extras['analytics'].set_products(frames['products'])
+            if extras is not None and 'products' not in frames:
+                # Product details and revenue come from the products already stored
+                if current is not None and current.has('products'):
+                    extras['analytics'].set_products(current.frame('products'))
+            dataset = publish_dataset(frames, extras=extras)
+        analytics = None
+        if extras is not None:
+            analytics = extras['analytics'].to_analytics(dataset.frame('customers'))
+        return analytics_and_training_response(dataset, uploaded_data, debug_info, num_of_rewards, analytics)
+    
     except Exception as e:
-        print(f"CRITICAL ERROR in upload endpoint: {e}")
-        print(f"Error type: {type(e)}")
-        traceback.print_exc()
+        log.exception("Error in file upload endpoint")
         return jsonify({"error": str(e), "status": "error"}), 400
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+def read_request_frames(kinds, spool_dir, debug_info=None):
+    """Read the CSV data for `kinds` from multipart files, or from JSON strings when no files were sent
+
+    Returns:
+        dict: kind -> DataFrame for every kind present in the request.
+    """
+    frames = {}
+    data = None if request.files else (request.get_json(silent=True) or {})
+    for kind in kinds:
+        if data is not None:
+            if data.get(kind):
+                frames[kind] = read_csv_text(data[kind], kind, debug_info)
+            continue
+        file = request.files.get(kind)
+        if file is None or not file.filename:
+            continue
+        if not allowed_file(file.filename):
+            raise ValueError(f"Unsupported file type for {kind}: {file.filename}")
+        path = os.path.join(spool_dir, f"{kind}_{secure_filename(file.filename)}")
+        spool_to_disk(file, path)
+        frames[kind] = read_csv_file(path, kind, debug_info=debug_info)
+    return frames
+
+@app.route('/append_interactions', methods=['POST'])
+def append_interactions():
+    """Append new interaction rows and return analytics updated from the new rows only
+
+    Accepts a multipart 'interactions' file or JSON {"interactions": "<csv>"}.
+    """
+    dataset = current_dataset()
+    if dataset is None or not dataset.has('interactions'):
+        return jsonify({"error": "Upload interaction data before appending to it", "status": "error"}), 400
+    
+    spool_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+    try:
+        debug_info = {}
+        frames = read_request_frames(['interactions'], spool_dir, debug_info)
+        if 'interactions' not in frames:
+            return jsonify({"error": "No interaction data received", "status": "error"}), 400
+        delta_df = frames['interactions']
+        
+        # Held across workers so concurrent appends each build on the previous one
+        with dataset_lock():
+            dataset = current_dataset()
+            extras = dataset.extras
+            analytics_state = extras.get('analytics')
+            if analytics_state is None:
+                log.info("Building incremental analytics state from the current history")
+                analytics_state = IncrementalAnalytics.from_interactions(
+                    dataset.frame('interactions'), dataset.frame('products')
+                )
+            appended_rows = analytics_state.add_interactions(delta_df)
+            aggregator = extras.get('aggregated')
+            if aggregator is not None:
+                # Uploaded with aggregate=true: the new rows are folded into the customer-product pairs
+                aggregator.add(delta_df)
+                dataset = publish_dataset(
+                    {'interactions': aggregator.frame()}, extras={'analytics': analytics_state, 'aggregated': aggregator}
+                )
+            else:
+                dataset = append_frame('interactions', delta_df, extras={'analytics': analytics_state})
+        log.info("Appended %d interaction records", appended_rows)
+        
+        return jsonify({
+            "message": "Interactions appended successfully",
+            "status": "success",
+            "dataset_id": dataset.dataset_id,
+            "appended": appended_rows,
+            "debug_info": debug_info,
+            "analytics": analytics_state.to_analytics(dataset.frame('customers'))
+        })
+    except Exception as e:
+        log.exception("Error appending interactions")
+        return jsonify({"error": f"Error appending interactions data: {str(e)}", "status": "error"}), 400
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+@app.route('/retrain/<model_id>', methods=['POST'])
+def retrain_model(model_id, num_of_rewards=3):
+    """Warm-start a new model version from `model_id` using only new data
+
+    Accepts multipart files or JSON strings for 'interactions' (required, new rows only),
+    'customers' and 'products' (new or changed rows). Without customers/products the
+    currently uploaded data is used to describe new users and items.
+    """
+    try:
+        if not os.path.exists(model_path(model_id)):
+            raise FileNotFoundError(f"Model ID {model_id} not found")
+    except FileNotFoundError as fnf:
+        return jsonify({"error": str(fnf), "status": "error"}), 404
+    
+    spool_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+    try:
+        debug_info = {}
+        frames = read_request_frames(['customers', 'products', 'interactions'], spool_dir, debug_info)
+        if 'interactions' not in frames:
+            return jsonify({"error": "No interaction data received", "status": "error"}), 400
+        delta_df = frames['interactions']
+        dataset = current_dataset()
+        delta_customers = frames.get('customers', dataset.frame('customers') if dataset else None)
+        delta_products = frames.get('products', dataset.frame('products') if dataset else None)
+        if delta_customers is None or delta_products is None:
+            return jsonify({"error": "Customer and product data are required to retrain", "status": "error"}), 400
+        
+        job_id = submit_training(delta_df, delta_customers, delta_products, num_of_rewards, base_model_id=model_id)
+        return jsonify({
+            "message": f"Incremental training from model {model_id} queued",
+            "status": "success",
+            "base_model_id": model_id,
+            "debug_info": debug_info,
+            "training_job": {
+                "job_id": job_id,
+                "state": "queued",
+                "status_url": f"/jobs/{job_id}"
+            }
+        })
+    except Exception as e:
+        log.exception("Error queueing incremental training")
+        return jsonify({"error": f"Error processing retraining data: {str(e)}", "status": "error"}), 400
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
 
 @app.route('/send_rewards/<model_id>', methods=['POST'])
 def send_rewards(model_id):
+    """Start sending reward emails for a model in the background, or resume an interrupted campaign
+
+    Recipients already sent to are never emailed again; poll /campaigns/<model_id> for progress.
+    """
     try:
-        sent_count = send_bulk_from_model(model_id)
+        campaign = start_campaign(model_id)
         return jsonify({
-            "message": f"Successfully sent {sent_count} reward emails.",
-            "sent_count": sent_count,
+            "message": f"Sending reward emails to {campaign['pending']} recipients.",
+            "sent_count": campaign["sent"],
+            "campaign": campaign,
+            "status_url": f"/campaigns/{model_id}",
             "status": "success"
-        })
+        }), 202
     except FileNotFoundError as fnf:
         return jsonify({"error": str(fnf), "status": "error"}), 404
+    except CampaignRunningError as running:
+        return jsonify({"error": str(running), "status_url": f"/campaigns/{model_id}", "status": "error"}), 409
+    except Exception as e:
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route('/campaigns/<model_id>', methods=['GET'])
+def campaign_progress(model_id):
+    """Report how many recipients of a model's email campaign are pending, sent, failed or unknown"""
+    try:
+        return jsonify({**campaign_status(model_id), "status": "success"})
+    except FileNotFoundError as fnf:
+        return jsonify({"error": str(fnf), "status": "error"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Report progress of a training job; includes the recommendations once it has succeeded"""
+    try:
+        job = get_job(job_id)
+        response = {**job, "status": "success"}
+        if job.get("state") == "succeeded":
+            response["recommended_rewards"] = {
+                "message": "Model trained successfully!",
+                "model_id": job["model_id"],
+                "recommendations": load_recommendations(job["model_id"])
+            }
+        return jsonify(response)
+    except FileNotFoundError as fnf:
+        return jsonify({"error": str(fnf), "status": "error"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e), "status": "error"}), 500
+
+@app.route('/recommendations/<model_id>', methods=['GET'])
+def export_recommendations(model_id):
+    """Stream every customer's stored rewards as JSON, keyed by CustomerID"""
+    try:
+        store = open_store(model_id)
+    except FileNotFoundError as fnf:
+        # Models trained before the columnar store wrote the JSON directly
+        path = recommendations_file(model_id)
+        if MODEL_ID_PATTERN.match(model_id) and os.path.exists(path):
+            return send_file(os.path.abspath(path), mimetype='application/json')
+        return jsonify({"error": str(fnf), "status": "error"}), 404
+    return Response(store.iter_json(), mimetype='application/json')
+
+@app.route('/recommendations/<model_id>/<customer_id>', methods=['GET'])
+def customer_recommendations(model_id, customer_id):
+    """Return top-N rewards for one customer from a stored model, without retraining.
+
+    Customers not seen in training can pass ?gender=&age_group= for a cold-start recommendation.
+    ?mode=ivf searches only the closest product clusters instead of every product (mode=exact, the default).
+    With ?stored=true the rewards generated at training time (the ones emailed) are returned instead.
+    """
+    try:
+        if request.args.get('stored', '').lower() in ('1', 'true', 'yes'):
+            return jsonify({
+                "model_id": model_id,
+                "customer_id": customer_id,
+                **stored_rewards(model_id, customer_id),
+                "status": "success"
+            })
+        n = int(request.args.get('n', 3))
+        if n <= 0:
+            return jsonify({"error": "n must be a positive integer", "status": "error"}), 400
+        result = recommend_rewards(
+            model_id,
+            customer_id,
+            n,
+            gender=request.args.get('gender'),
+            age_group=request.args.get('age_group'),
+            mode=request.args.get('mode', 'exact')
+        )
+        return jsonify({
+            "model_id": model_id,
+            "customer_id": customer_id,
+            **result,
+            "status": "success"
+        })
+    except ValueError as ve:
+        return jsonify({"error": str(ve), "status": "error"}), 400
+    except (FileNotFoundError, KeyError) as nf:
+        return jsonify({"error": str(nf).strip("'\""), "status": "error"}), 404
     except Exception as e:
         return jsonify({"error": str(e), "status": "error"}), 500
 
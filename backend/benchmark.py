@@ -0,0 +1,293 @@
+# Pipeline benchmark
+# ----- Times upload -> analytics -> train -> recommend -> send on synthetic data and writes the results as JSON -----
+#
+# Run from the repository root:
+#   python backend/benchmark.py --interactions 1000000 --output bench.json
+#   python backend/benchmark.py --interactions 1000000 --compare bench.json
+#
+# Every stage runs through the same functions the API uses, inside a scratch
+# working directory so models, datasets and campaigns never touch backend/.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+FRAME_FILES = {"customers": "customers.csv", "products": "products.csv", "interactions": "interactions.csv"}
+# A stage this much slower than in the baseline counts as a regression with --compare
+REGRESSION_RATIO = 1.2
+# ...and at least this many seconds slower; shorter stages are too noisy to call
+REGRESSION_MIN_SECONDS = 0.05
+
+
+def _read_status_kb(field):
+    """A memory field (e.g. VmHWM) of this process from /proc, in KB, or None off Linux."""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _reset_peak_rss():
+    """Reset this process's peak RSS so the next reading covers one stage; False if the kernel does not allow it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident memory in MB, since the last reset where supported, otherwise since process start."""
+    peak_kb = _read_status_kb("VmHWM")
+    if peak_kb is None:
+        # ru_maxrss is in KB on Linux and bytes on macOS
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak_kb /= 1024
+    return round(peak_kb / 1024, 1)
+
+
+class StageTimer:
+    """
+    Records wall time and peak RSS per pipeline stage.
+
+    Stages are either timed with `stage(name)` or switched by `mark(name)`, which
+    closes the running stage; `mark` matches the `progress(stage, fraction)`
+    callbacks of train_model, so its internal stages are timed without touching it.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.per_stage_peaks = _reset_peak_rss()
+        self._current = None
+        self._started = None
+
+    def stop(self):
+        """Close the running stage."""
+        if self._current is not None:
+            self.stages[self._current] = {
+                "seconds": round(time.perf_counter() - self._started, 3),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+            print(f"[benchmark] {self._current}: {self.stages[self._current]['seconds']:.2f}s")
+            self._current = None
+
+    def mark(self, name):
+        if name == self._current:
+            return
+        self.stop()
+        _reset_peak_rss()
+        self._current = name
+        self._started = time.perf_counter()
+
+    def progress(self, prefix):
+        """A `progress(stage, fraction)` callback recording each stage as `<prefix>.<stage>`."""
+        return lambda stage, fraction: self.mark(f"{prefix}.{stage}")
+
+    @contextmanager
+    def stage(self, name):
+        self.mark(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+
+class FakeTransport:
+    """Email transport that delivers nothing; each batch costs `latency_seconds`, like one API request."""
+
+    def __init__(self, latency_seconds=0.0, batch_size=1000):
+        self.latency_seconds = latency_seconds
+        self.batch_size = batch_size
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def send(self, batch, on_result):
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        with self._lock:
+            self.sent += len(batch)
+        on_result(batch, True, 202)
+        return len(batch), 0
+
+    def close(self):
+        pass
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_pipeline(args, timer):
+    """
+    Run every stage once on a freshly generated dataset.
+
+    Returns:
+        dict: Sizes of the generated data, setup time, emails sent and the model id.
+    """
+    from synthetic_data import scale_sample_data, generate_frames
+    from ingestion import read_csv_file
+    from dataset_store import publish_dataset
+    from analytics import compute_basic_analytics
+    from train_lightfm import train_model
+    from email_sending import send_bulk_from_model
+
+    generate = scale_sample_data if args.generator == "sample" else generate_frames
+    start = time.perf_counter()
+    interactions_df, customers_df, products_df = generate(
+        args.interactions, num_users=args.users, num_items=args.items, email_rate=args.email_rate, seed=args.seed
+    )
+    upload_dir = tempfile.mkdtemp(dir=".")
+    for kind, df in (("customers", customers_df), ("products", products_df), ("interactions", interactions_df)):
+        df.to_csv(os.path.join(upload_dir, FRAME_FILES[kind]), index=False)
+    setup_seconds = time.perf_counter() - start
+    sizes = {"interactions": len(interactions_df), "customers": len(customers_df), "products": len(products_df)}
+    del interactions_df, customers_df, products_df
+
+    with timer.stage("upload.parse_csv"):
+        frames = {kind: read_csv_file(os.path.join(upload_dir, name), kind) for kind, name in FRAME_FILES.items()}
+    with timer.stage("upload.publish_dataset"):
+        dataset = publish_dataset(frames)
+    del frames
+    with timer.stage("upload.load_dataset"):
+        frames = {kind: dataset.frame(kind) for kind in FRAME_FILES}
+
+    with timer.stage("analytics"):
+        analytics = compute_basic_analytics(frames["interactions"], frames["customers"], frames["products"])
+    if "error" in analytics:
+        raise RuntimeError(f"Analytics failed: {analytics['error']}")
+
+    # train_model reports building_matrices, training (fit plus reward lookups), saving_model,
+    # scoring, generating_rewards and writing_recommendations
+    result = train_model(
+        frames["interactions"], frames["customers"], frames["products"], args.rewards, progress=timer.progress("train")
+    )
+    timer.stop()
+
+    transport = FakeTransport(args.email_latency)
+    with timer.stage("send_emails"):
+        send_bulk_from_model(result["model_id"], transport=transport)
+
+    return {"sizes": sizes, "setup_seconds": round(setup_seconds, 3), "emails_sent": transport.sent, "model_id": result["model_id"]}
+
+
+def compare(results, baseline, ratio=REGRESSION_RATIO):
+    """
+    Print per-stage time and peak memory against a baseline run.
+
+    Returns:
+        list: Stages slower than `ratio` times the baseline.
+    """
+    regressions = []
+    print(f"{'stage':34s} {'baseline':>10s} {'now':>10s} {'ratio':>7s} {'peak MB':>9s} {'was':>9s}")
+    for name, stage in results["stages"].items():
+        before = baseline["stages"].get(name)
+        if before is None:
+            print(f"{name:34s} {'-':>10s} {stage['seconds']:9.2f}s")
+            continue
+        change = stage["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+        flag = ""
+        if change > ratio and stage["seconds"] - before["seconds"] > REGRESSION_MIN_SECONDS:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:34s} {before['seconds']:9.2f}s {stage['seconds']:9.2f}s {change:6.2f}x "
+            f"{stage['peak_rss_mb']:9.1f} {before['peak_rss_mb']:9.1f}{flag}"
+        )
+    if results["params"] != baseline.get("params"):
+        print(f"Note: parameters differ from the baseline's {baseline.get('params')}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the upload -> analytics -> train -> recommend -> send pipeline.")
+    parser.add_argument("--interactions", type=int, default=100_000, help="Interaction rows to generate")
+    parser.add_argument("--users", type=int, default=None, help="Customers (default: scaled with interactions)")
+    parser.add_argument("--items", type=int, default=None, help="Products (default: scaled with interactions)")
+    parser.add_argument("--generator", choices=("sample", "uniform"), default="sample",
+                        help="'sample' scales data/*_compressed.csv, 'uniform' uses synthetic value lists")
+    parser.add_argument("--email-rate", type=float, default=0.3, help="Fraction of customers with an email address")
+    parser.add_argument("--email-latency", type=float, default=0.0, help="Seconds per email batch in the fake transport")
+    parser.add_argument("--rewards", type=int, default=3, help="Rewards per customer")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write results JSON here (default: stdout)")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against; exits 1 on a regression")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory with the models and datasets")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    sys.path.insert(0, BACKEND_DIR)
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix="pipeline-benchmark-")
+    os.makedirs(os.path.join(scratch, "backend"))
+    os.chdir(scratch)
+    timer = StageTimer()
+    start = time.perf_counter()
+    try:
+        run = run_pipeline(args, timer)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Scratch directory kept at {scratch}")
+        else:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    results = {
+        "benchmark": "pipeline",
+        "created_at": time.time(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "interactions": args.interactions, "users": args.users, "items": args.items, "generator": args.generator,
+            "email_rate": args.email_rate, "email_latency": args.email_latency, "rewards": args.rewards, "seed": args.seed,
+        },
+        **run,
+        # Without per-stage resets each peak is the process peak so far
+        "per_stage_peak_rss": timer.per_stage_peaks,
+        "stages": timer.stages,
+        "total_seconds": round(time.perf_counter() - start, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+    }
+
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+        print(f"Results written to {output}")
+    else:
+        print(text)
+
+    if baseline is not None and compare(results, baseline):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
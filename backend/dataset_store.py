@@ -0,0 +1,565 @@
+# Shared on-disk store for uploaded datasets
+# ----- Versioned, memory-mapped NumPy columns that every gunicorn worker reads from the same pages -----
+
+import os
+import json
+import uuid
+import time
+import fcntl
+import pickle
+import shutil
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from model_registry import LRUCache
+from ingestion import concat_chunks
+from id_dictionary import ID_COLUMNS, IdDictionary
+from instrumentation import get_logger, span, timed
+
+DATASETS_DIR = os.path.join("backend", "datasets")
+PARTS_DIR = os.path.join(DATASETS_DIR, "parts")
+MANIFESTS_DIR = os.path.join(DATASETS_DIR, "manifests")
+CURRENT_FILE = os.path.join(DATASETS_DIR, "CURRENT")
+LOCK_FILE = os.path.join(DATASETS_DIR, ".lock")
+
+FRAME_KINDS = ("customers", "products", "interactions")
+# Appends add a part; a frame is compacted into one part in the background once its
+# appended parts hold this fraction of the rows of its first part, or it has MAX_PARTS parts
+COMPACT_RATIO = float(os.environ.get("DATASET_COMPACT_RATIO", 0.1))
+MAX_PARTS = int(os.environ.get("DATASET_MAX_PARTS", 8))
+# Dataset versions kept on disk; older manifests and parts only they use are deleted
+VERSIONS_KEPT = int(os.environ.get("DATASET_VERSIONS_KEPT", 4))
+DATASET_CACHE_SIZE = 2
+
+log = get_logger(__name__)
+
+# A version is visible once CURRENT names it. Parts and the manifest are written
+# under temporary names and renamed into place before CURRENT is replaced, so a
+# reader that finds a version always finds all of it. Published files never change.
+#
+# Id columns (ID_COLUMNS) are interned: each version has one append-only dictionary
+# per id column, stored as segments of new ids listed in the manifest, and parts
+# hold only int32 codes into it. Appends add a segment for the ids they introduce,
+# so codes in existing parts stay valid and carry over unchanged.
+#
+# Appends write only the new rows, as a part of their own. A frame with several
+# parts is concatenated on read, which copies its columns into private memory in
+# every worker, so `compact_frame` later rewrites it as one part off the request
+# path and publishes that as a new version with the same data.
+
+
+_thread_lock = threading.RLock()
+_lock_state = threading.local()
+# Frame kinds this process is compacting
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+
+@contextmanager
+def dataset_lock():
+    """
+    Serialize dataset updates across threads and worker processes.
+
+    Reentrant within a thread, so read-modify-publish sequences can hold it around
+    `publish_dataset` / `append_frame`.
+    """
+    with _thread_lock:
+        depth = getattr(_lock_state, "depth", 0)
+        if depth == 0:
+            os.makedirs(DATASETS_DIR, exist_ok=True)
+            handle = open(LOCK_FILE, "a")
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        _lock_state.depth = depth + 1
+        try:
+            yield
+        finally:
+            _lock_state.depth = depth
+            if depth == 0:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+
+
+def _replace_file(path, write):
+    """Write a file through `write(f)` under a temporary name and rename it over `path`."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _save_strings(directory, name, values):
+    """Save strings as one UTF-8 blob plus an offsets array."""
+    encoded = [str(value).encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    with open(os.path.join(directory, f"{name}.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(os.path.join(directory, f"{name}.offsets.npy"), offsets)
+
+
+def _load_strings(directory, name):
+    with open(os.path.join(directory, f"{name}.bin"), "rb") as f:
+        blob = f.read()
+    offsets = np.load(os.path.join(directory, f"{name}.offsets.npy")).tolist()
+    return [blob[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _write_segment(ids):
+    """Write ids added to a dictionary as one immutable segment directory; returns its id."""
+    segment_id = str(uuid.uuid4())
+    path = os.path.join(PARTS_DIR, segment_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path)
+    _save_strings(tmp_path, "ids", ids)
+    os.replace(tmp_path, path)
+    return segment_id
+
+
+def _write_part(df, dictionaries=None, commit=True):
+    """
+    Write a DataFrame as one immutable part directory of column files.
+
+    Numeric columns are saved as-is. Columns with an entry in `dictionaries` are
+    saved as int32 codes into that IdDictionary. Categorical columns keep their
+    codes and store their categories as text. Other columns are dictionary-encoded:
+    int32 codes (-1 for missing) plus the distinct values as text.
+
+    With `commit` false the part stays under its temporary name, which pruning
+    leaves alone, until `_commit_part` renames it into place.
+
+    Returns:
+        str: Part id.
+    """
+    dictionaries = dictionaries or {}
+    part_id = str(uuid.uuid4())
+    path = os.path.join(PARTS_DIR, part_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path)
+
+    columns = []
+    for position, (name, series) in enumerate(df.items()):
+        file_name = f"c{position}"
+        dtype = series.dtype
+        if name in dictionaries:
+            np.save(os.path.join(tmp_path, f"{file_name}.npy"), dictionaries[name].codes(series))
+            columns.append({"name": name, "kind": "id", "file": file_name})
+        elif isinstance(dtype, pd.CategoricalDtype):
+            np.save(os.path.join(tmp_path, f"{file_name}.npy"), series.cat.codes.to_numpy())
+            _save_strings(tmp_path, f"{file_name}.values", dtype.categories)
+            columns.append({"name": name, "kind": "category", "file": file_name, "ordered": bool(dtype.ordered)})
+        elif isinstance(dtype, np.dtype) and dtype.kind in "biufmM":
+            np.save(os.path.join(tmp_path, f"{file_name}.npy"), series.to_numpy())
+            columns.append({"name": name, "kind": "numeric", "file": file_name})
+        else:
+            codes, uniques = pd.factorize(series.astype(object))
+            np.save(os.path.join(tmp_path, f"{file_name}.npy"), codes.astype(np.int32))
+            _save_strings(tmp_path, f"{file_name}.values", uniques)
+            columns.append({"name": name, "kind": "object", "file": file_name})
+
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"rows": len(df), "columns": columns}, f)
+    if commit:
+        os.replace(tmp_path, path)
+    return part_id
+
+
+def _commit_part(part_id):
+    path = os.path.join(PARTS_DIR, part_id)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+
+
+def _part_rows(part_id):
+    with open(os.path.join(PARTS_DIR, part_id, "meta.json"), "r") as f:
+        return json.load(f)["rows"]
+
+
+def _read_part(part_id, dictionaries):
+    """
+    Map a part back into a DataFrame.
+
+    Numeric columns, categorical codes and id codes are read-only memory maps
+    shared with every process reading the part; id columns become Categoricals
+    over the version's IdDictionary. Other dictionary-encoded columns are rebuilt
+    as object columns in this process.
+    """
+    path = os.path.join(PARTS_DIR, part_id)
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    data = {}
+    for column in meta["columns"]:
+        values = np.load(os.path.join(path, f"{column['file']}.npy"), mmap_mode="r")
+        if column["kind"] == "numeric":
+            data[column["name"]] = values
+        elif column["kind"] == "id":
+            data[column["name"]] = pd.Categorical.from_codes(values, dtype=dictionaries[column["name"]].dtype)
+        elif column["kind"] == "category":
+            categories = pd.Index(_load_strings(path, f"{column['file']}.values"), dtype=object)
+            data[column["name"]] = pd.Categorical.from_codes(values, categories=categories, ordered=column["ordered"])
+        else:
+            # The trailing NaN is what code -1 (missing) indexes
+            uniques = np.array(_load_strings(path, f"{column['file']}.values") + [np.nan], dtype=object)
+            data[column["name"]] = uniques[values]
+    return pd.DataFrame(data, index=pd.RangeIndex(meta["rows"]), copy=False)
+
+
+class Dataset:
+    """
+    One published version of the uploaded data.
+
+    Frames are mapped on first access and cached with the version, which never
+    changes once published.
+    """
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.dataset_id = manifest["dataset_id"]
+        self._frames = {}
+        self._dictionaries = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def open(cls, dataset_id):
+        with open(os.path.join(MANIFESTS_DIR, f"{dataset_id}.json"), "r") as f:
+            return cls(json.load(f))
+
+    def has(self, kind):
+        return bool(self.manifest["frames"].get(kind))
+
+    def dictionary(self, column):
+        """IdDictionary for an id column, empty if the version has none. Treat it as read-only."""
+        with self._lock:
+            if column not in self._dictionaries:
+                ids = []
+                for segment_id in self.manifest.get("dictionaries", {}).get(column, []):
+                    ids.extend(_load_strings(os.path.join(PARTS_DIR, segment_id), "ids"))
+                self._dictionaries[column] = IdDictionary(ids)
+            return self._dictionaries[column]
+
+    def frame(self, kind):
+        """
+        DataFrame for `kind`, or None if it was never uploaded. Treat it as read-only.
+
+        Id columns are Categoricals over this version's dictionaries, so the same
+        id column in different frames shares one dtype and joins on codes.
+        """
+        with self._lock:
+            if kind not in self._frames:
+                dictionaries = {column: self.dictionary(column) for column in self.manifest.get("dictionaries", {})}
+                parts = [_read_part(part_id, dictionaries) for part_id in self.manifest["frames"].get(kind, [])]
+                # Frames appended to since they were last compacted list several parts
+                self._frames[kind] = (parts[0] if len(parts) == 1 else concat_chunks(parts)) if parts else None
+            return self._frames[kind]
+
+    @property
+    def extras(self):
+        """Objects published with this version (e.g. incremental analytics), or {}."""
+        path = os.path.join(MANIFESTS_DIR, f"{self.dataset_id}.pkl")
+        if not self.manifest.get("extras") or not os.path.exists(path):
+            return {}
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+_datasets = LRUCache(DATASET_CACHE_SIZE)
+
+
+def current_dataset():
+    """
+    The latest published dataset, or None before the first upload.
+
+    Reads the version pointer on every call, so an upload handled by any worker
+    is visible to all of them on their next request.
+    """
+    try:
+        with open(CURRENT_FILE, "r") as f:
+            dataset_id = f.read().strip()
+    except FileNotFoundError:
+        return None
+    dataset = _datasets.get(dataset_id)
+    if dataset is None:
+        dataset = Dataset.open(dataset_id)
+        _datasets.put(dataset_id, dataset)
+    return dataset
+
+
+def _publish(frames, dictionaries, extras):
+    """Write a manifest for `frames` (kind -> part ids) and `dictionaries` (column -> segment ids) and make it current."""
+    dataset_id = str(uuid.uuid4())
+    manifest = {
+        "dataset_id": dataset_id, "created_at": time.time(), "frames": frames,
+        "dictionaries": dictionaries, "extras": bool(extras),
+    }
+    os.makedirs(MANIFESTS_DIR, exist_ok=True)
+    if extras:
+        _replace_file(
+            os.path.join(MANIFESTS_DIR, f"{dataset_id}.pkl"),
+            lambda f: pickle.dump(extras, f, protocol=pickle.HIGHEST_PROTOCOL),
+        )
+    _replace_file(os.path.join(MANIFESTS_DIR, f"{dataset_id}.json"), lambda f: f.write(json.dumps(manifest).encode()))
+    _replace_file(CURRENT_FILE, lambda f: f.write(dataset_id.encode()))
+    log.info("Published dataset %s: %s", dataset_id, ", ".join(f"{kind} ({len(parts)} parts)" for kind, parts in frames.items()))
+    _prune()
+    return current_dataset()
+
+
+def _prune():
+    """Delete all but the newest VERSIONS_KEPT manifests and any part none of them uses."""
+    manifests = []
+    for name in os.listdir(MANIFESTS_DIR):
+        if name.endswith(".json"):
+            with open(os.path.join(MANIFESTS_DIR, name), "r") as f:
+                manifests.append(json.load(f))
+    manifests.sort(key=lambda manifest: manifest["created_at"], reverse=True)
+
+    for manifest in manifests[VERSIONS_KEPT:]:
+        for suffix in (".json", ".pkl"):
+            path = os.path.join(MANIFESTS_DIR, f"{manifest['dataset_id']}{suffix}")
+            if os.path.exists(path):
+                os.remove(path)
+    # Processes that already mapped a deleted part keep reading it until they unmap it
+    in_use = {
+        part
+        for manifest in manifests[:VERSIONS_KEPT]
+        for parts in (*manifest["frames"].values(), *manifest.get("dictionaries", {}).values())
+        for part in parts
+    }
+    for name in os.listdir(PARTS_DIR):
+        if name not in in_use and not name.endswith(".tmp"):
+            shutil.rmtree(os.path.join(PARTS_DIR, name), ignore_errors=True)
+
+
+def _intern(frames, current):
+    """
+    Extend the id dictionaries of `current` (or new ones if None) with the ids in `frames`.
+
+    Returns:
+        tuple: (dictionaries, segments) with column -> IdDictionary covering every
+        id in `frames`, and column -> segment ids for the manifest.
+    """
+    dictionaries, segments = {}, {}
+    for column in ID_COLUMNS:
+        columns = [df[column] for df in frames if column in df.columns]
+        previous = current.manifest.get("dictionaries", {}).get(column) if current else None
+        if not columns and not previous:
+            continue
+        # Copied, so the cached dictionary of the current version is left as it is
+        dictionary = IdDictionary(current.dictionary(column).ids) if previous else IdDictionary()
+        segments[column] = list(previous or [])
+        added = [dictionary.extend(values) for values in columns]
+        added = [ids for ids in added if len(ids)]
+        if added:
+            segments[column].append(_write_segment(added[0].append(added[1:])))
+        dictionaries[column] = dictionary
+    return dictionaries, segments
+
+
+@timed("dataset_write")
+def publish_dataset(frames, extras=None):
+    """
+    Publish a new version replacing the given frames; kinds not in `frames` carry over.
+
+    Carried-over frames keep the current id dictionaries, extended with the new
+    ids. When every uploaded kind is replaced the dictionaries start afresh, so
+    ids from earlier uploads do not accumulate.
+
+    Args:
+        frames (dict): kind -> DataFrame for the uploaded kinds.
+        extras (dict): Picklable objects derived from this version, read back with `Dataset.extras`.
+
+    Returns:
+        Dataset: The new current version.
+    """
+    with dataset_lock():
+        current = current_dataset()
+        parts = {kind: list(current.manifest["frames"].get(kind, [])) for kind in FRAME_KINDS} if current else {}
+        carried = current if any(parts.get(kind) for kind in FRAME_KINDS if kind not in frames) else None
+        dictionaries, segments = _intern(list(frames.values()), carried)
+        for kind, df in frames.items():
+            parts[kind] = [_write_part(df, dictionaries)]
+        return _publish(parts, segments, extras)
+
+
+@timed("dataset_write")
+def append_frame(kind, df, extras=None):
+    """
+    Publish a new version with `df` appended to the `kind` frame as a new part.
+
+    Existing parts are reused as they are, so an append writes only the new rows.
+    Once the frame needs compacting (COMPACT_RATIO, MAX_PARTS), `compact_frame`
+    runs in a background thread of this process.
+
+    Returns:
+        Dataset: The new current version.
+    """
+    with dataset_lock():
+        current = current_dataset()
+        if current is None or not current.has(kind):
+            raise ValueError(f"Upload {kind} data before appending to it")
+        parts = {name: list(part_ids) for name, part_ids in current.manifest["frames"].items()}
+        dictionaries, segments = _intern([df], current)
+        parts[kind].append(_write_part(df, dictionaries))
+        dataset = _publish(parts, segments, extras)
+        compact = _needs_compaction(parts[kind])
+    if compact:
+        _compact_in_background(kind)
+    return dataset
+
+
+def _needs_compaction(part_ids):
+    if len(part_ids) < 2:
+        return False
+    if len(part_ids) >= MAX_PARTS:
+        return True
+    appended = sum(_part_rows(part_id) for part_id in part_ids[1:])
+    return appended >= COMPACT_RATIO * _part_rows(part_ids[0])
+
+
+def compact_frame(kind):
+    """
+    Rewrite the current `kind` frame as one part and publish it as a new version.
+
+    The part is written from a snapshot without holding the dataset lock, so
+    appends go on meanwhile. It is published only if the frame still starts with
+    the snapshot's parts: parts appended since are kept after it, and a frame
+    replaced by an upload is left alone.
+
+    Returns:
+        bool: Whether a compacted version was published.
+    """
+    snapshot = current_dataset()
+    part_ids = snapshot.manifest["frames"].get(kind, []) if snapshot else []
+    if len(part_ids) < 2:
+        return False
+    dictionaries = {column: snapshot.dictionary(column) for column in snapshot.manifest.get("dictionaries", {})}
+    with span("dataset_compaction") as timing:
+        frame = snapshot.frame(kind)
+        part_id = _write_part(frame, dictionaries, commit=False)
+        timing.rows = len(frame)
+
+    with dataset_lock():
+        current = current_dataset()
+        parts = {name: list(ids) for name, ids in current.manifest["frames"].items()}
+        if parts.get(kind, [])[:len(part_ids)] != part_ids:
+            shutil.rmtree(os.path.join(PARTS_DIR, f"{part_id}.{os.getpid()}.tmp"), ignore_errors=True)
+            log.info("Dropped compacted %s frame, it was replaced meanwhile", kind)
+            return False
+        _commit_part(part_id)
+        # Codes in the compacted part stay valid: dictionaries only grow between versions sharing parts
+        parts[kind] = [part_id] + parts[kind][len(part_ids):]
+        _publish(parts, current.manifest.get("dictionaries", {}), current.extras)
+    log.info("Compacted %d parts of the %s frame into one", len(part_ids), kind)
+    return True
+
+
+def _compact_in_background(kind):
+    with _compacting_lock:
+        if kind in _compacting:
+            return
+        _compacting.add(kind)
+
+    def run():
+        try:
+            compact_frame(kind)
+        except Exception:
+            log.exception("Compacting the %s frame failed", kind)
+        finally:
+            with _compacting_lock:
+                _compacting.discard(kind)
+
+    threading.Thread(target=run, name=f"compact-{kind}", daemon=True).start()
+
+
+if __name__ == "__main__":
+    # Benchmark: memory of worker processes reading one shared dataset vs each holding its own copy.
+    # Run from the repository root: python backend/dataset_store.py [num_interactions] [num_workers]
+    import sys
+    import tempfile
+    import multiprocessing
+    from synthetic_data import generate_frames
+
+    def memory_mb():
+        """(private, proportional) resident memory of this process in MB, from /proc."""
+        fields = {}
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    fields[parts[0].rstrip(":")] = int(parts[1])
+        return (fields["Private_Clean"] + fields["Private_Dirty"]) / 1024, fields["Pss"] / 1024
+
+    def touch(df):
+        # Read every column so all pages are resident
+        total = 0.0
+        for _, col in df.items():
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                col = col.cat.codes
+            total += float(col.to_numpy().view(np.uint8)[::4096].sum()) if col.dtype != object else len(col)
+        return total
+
+    def shared_worker(queue):
+        before = memory_mb()
+        dataset = current_dataset()
+        touch(dataset.frame("interactions"))
+        after = memory_mb()
+        queue.put((after[0] - before[0], after[1] - before[1]))
+
+    def copy_worker(path, queue):
+        before = memory_mb()
+        df = pd.read_pickle(path)
+        touch(df)
+        after = memory_mb()
+        queue.put((after[0] - before[0], after[1] - before[1]))
+
+    def run(target, args, workers):
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=target, args=(*args, queue)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        return np.mean(results, axis=0)
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    interactions_df, customers_df, products_df = generate_frames(size)
+
+    DATASETS_DIR = tempfile.mkdtemp()
+    PARTS_DIR = os.path.join(DATASETS_DIR, "parts")
+    MANIFESTS_DIR = os.path.join(DATASETS_DIR, "manifests")
+    CURRENT_FILE = os.path.join(DATASETS_DIR, "CURRENT")
+    LOCK_FILE = os.path.join(DATASETS_DIR, ".lock")
+    os.makedirs(PARTS_DIR)
+
+    start = time.perf_counter()
+    publish_dataset({"customers": customers_df, "products": products_df, "interactions": interactions_df})
+    publish_seconds = time.perf_counter() - start
+    _datasets.clear()
+
+    pickle_path = os.path.join(DATASETS_DIR, "interactions.pkl")
+    interactions_df.to_pickle(pickle_path)
+    print(f"{size} interactions, {workers} workers, columns: {dict(interactions_df.dtypes.astype(str))}")
+    private, pss = run(copy_worker, (pickle_path,), workers)
+    print(f"own copy per worker:   private +{private:7.1f} MB  proportional +{pss:7.1f} MB")
+    private, pss = run(shared_worker, (), workers)
+    print(f"shared dataset store:  private +{private:7.1f} MB  proportional +{pss:7.1f} MB")
+
+    # Appends below COMPACT_RATIO only write their own rows; the first one over it starts a compaction
+    COMPACT_RATIO = 1.0
+    start = time.perf_counter()
+    append_frame("interactions", interactions_df.iloc[: size // 100])
+    append_seconds = time.perf_counter() - start
+    _datasets.clear()
+    private, pss = run(shared_worker, (), workers)
+    print(f"after an append:       private +{private:7.1f} MB  proportional +{pss:7.1f} MB  (2 parts, concatenated)")
+    start = time.perf_counter()
+    compact_frame("interactions")
+    compact_seconds = time.perf_counter() - start
+    _datasets.clear()
+    # Compacted data must be shared again, not concatenated into each worker
+    private, pss = run(shared_worker, (), workers)
+    print(f"after compaction:      private +{private:7.1f} MB  proportional +{pss:7.1f} MB")
+    print(f"publish {publish_seconds:.2f}s, append 1% {append_seconds:.2f}s, compaction {compact_seconds:.2f}s")
+    shutil.rmtree(DATASETS_DIR)
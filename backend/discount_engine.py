@@ -0,0 +1,131 @@
+# Vectorized discount rules for reward generation
+# ----- Same results as train_lightfm.calculate_discount_percentage, one NumPy pass per batch -----
+
+import sys
+import random
+import numpy as np
+
+BASE_DISCOUNT = 5
+MAX_DISCOUNT = 50
+
+# Each rule adds `discount` when every condition holds. Conditions are
+# (column, operator, value) triples evaluated against the batch columns, so new
+# tiers are added here rather than as new branches in code. Comparisons against
+# missing values (NaN Rating/NumberOfPurchases for pairs with no interaction)
+# never match.
+DISCOUNT_RULES = [
+    {"name": "young_adult", "discount": 10, "conditions": [("AgeGroup", "==", "Young Adult")]},
+    {"name": "senior", "discount": 15, "conditions": [("AgeGroup", "==", "Senior")]},
+    {
+        "name": "female_fashion_beauty",
+        "discount": 5,
+        "conditions": [("Gender", "==", "Female"), ("ProductCategory", "in", ["Fashion", "Beauty"])],
+    },
+    {"name": "premium_product", "discount": 10, "conditions": [("Price", ">", 100)]},
+    {"name": "high_rating", "discount": 5, "conditions": [("Rating", ">=", 4)]},
+    {"name": "frequent_buyer", "discount": 10, "conditions": [("NumberOfPurchases", ">", 2)]},
+]
+
+# Columns holding numbers; everything else is compared as labels
+NUMERIC_COLUMNS = {"Price", "Rating", "NumberOfPurchases"}
+
+OPERATORS = {
+    "==": lambda values, operand: values == operand,
+    "!=": lambda values, operand: values != operand,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    "in": lambda values, operand: np.logical_or.reduce([values == option for option in operand] or [np.zeros(len(values), dtype=bool)]),
+}
+
+
+def _as_column(name, values, size):
+    if name in NUMERIC_COLUMNS:
+        return np.asarray(values, dtype=np.float64)
+    column = np.empty(size, dtype=object)
+    column[:] = list(values)
+    return column
+
+
+def compute_discounts(columns, rules=DISCOUNT_RULES, base=BASE_DISCOUNT, cap=MAX_DISCOUNT):
+    """
+    Calculate discount percentages for a whole batch of (user, product) pairs.
+
+    Args:
+        columns (dict): Aligned arrays keyed by column name: AgeGroup, Gender,
+            ProductCategory, Price, Rating and NumberOfPurchases. Use NaN for
+            Rating/NumberOfPurchases when the user never interacted with the product.
+        rules (list): Discount rules, see DISCOUNT_RULES.
+        base (int): Discount every pair starts from.
+        cap (int): Maximum discount percentage.
+
+    Returns:
+        np.ndarray: Integer discount percentage per pair.
+    """
+    size = len(next(iter(columns.values()))) if columns else 0
+    prepared = {}
+    discounts = np.full(size, base, dtype=np.int64)
+
+    for rule in rules:
+        mask = np.ones(size, dtype=bool)
+        for column, operator, operand in rule["conditions"]:
+            if column not in prepared:
+                prepared[column] = _as_column(column, columns[column], size)
+            mask &= np.asarray(OPERATORS[operator](prepared[column], operand), dtype=bool)
+        discounts += rule["discount"] * mask
+
+    return np.minimum(discounts, cap)
+
+
+def _random_case(rng):
+    """One random (user, product, interaction) case for the equivalence check."""
+    user = {
+        "AgeGroup": rng.choice(["Young Adult", "Senior", "Adult", "18-24", "65+", None]),
+        "Gender": rng.choice(["Female", "Male", "Other", None]),
+    }
+    product = {
+        "ProductCategory": rng.choice(["Fashion", "Beauty", "Electronics", "Health & Personal Care"]),
+        "Price": rng.choice([rng.uniform(0, 300), 100.0, 100.01, "99.5", "150"]),
+    }
+    interaction = None
+    if rng.random() < 0.6:
+        interaction = {
+            "Rating": rng.choice([1.0, 3.99, 4.0, 5.0, rng.uniform(1, 5), float("nan")]),
+            "NumberOfPurchases": rng.choice([0, 1, 2, 3, 10]),
+        }
+    return user, product, interaction
+
+
+def check_against_reference(num_cases=100_000, seed=0):
+    """
+    Property check: compute_discounts agrees with calculate_discount_percentage
+    on randomly generated cases, including rule boundaries and missing values.
+    """
+    from train_lightfm import calculate_discount_percentage
+
+    rng = random.Random(seed)
+    cases = [_random_case(rng) for _ in range(num_cases)]
+    expected = np.array([calculate_discount_percentage(*case) for case in cases])
+
+    nan = float("nan")
+    discounts = compute_discounts({
+        "AgeGroup": [user["AgeGroup"] for user, _, _ in cases],
+        "Gender": [user["Gender"] for user, _, _ in cases],
+        "ProductCategory": [product["ProductCategory"] for _, product, _ in cases],
+        "Price": [product["Price"] for _, product, _ in cases],
+        "Rating": [interaction["Rating"] if interaction else nan for _, _, interaction in cases],
+        "NumberOfPurchases": [interaction["NumberOfPurchases"] if interaction else nan for _, _, interaction in cases],
+    })
+
+    mismatches = np.flatnonzero(discounts != expected)
+    if len(mismatches):
+        index = mismatches[0]
+        raise AssertionError(f"{len(mismatches)} mismatches, first: {cases[index]} -> {discounts[index]} != {expected[index]}")
+    return num_cases
+
+
+if __name__ == "__main__":
+    # Property check: python discount_engine.py [num_cases]
+    num_cases = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    print(f"compute_discounts matches calculate_discount_percentage on {check_against_reference(num_cases)} cases")
@@ -0,0 +1,262 @@
+# Durable per-campaign send ledger
+# ----- One SQLite file per model_id recording every recipient's send status, so campaigns resume without resending -----
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from model_registry import MODEL_ID_PATTERN
+
+CAMPAIGNS_DIR = os.path.join("backend", "campaigns")
+# A running campaign that has not written to its ledger for this long is treated as dead and can be resumed
+CAMPAIGN_STALE_SECONDS = int(os.environ.get("CAMPAIGN_STALE_SECONDS", 120))
+# A running campaign refreshes its heartbeat this often, even while it is only waiting on retries
+HEARTBEAT_SECONDS = CAMPAIGN_STALE_SECONDS / 4
+
+# Recipients pending() reads from the ledger per query, so memory stays flat on large campaigns
+PENDING_PAGE_SIZE = 1000
+
+# pending -> sending -> sent / failed. A recipient still marked "sending" when a
+# campaign is resumed may or may not have been delivered; it becomes "unknown"
+# and is never sent again.
+RECIPIENT_STATUSES = ("pending", "sending", "sent", "failed", "unknown")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recipients (
+    email TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    http_status INTEGER,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS recipients_status ON recipients (status, position);
+CREATE TABLE IF NOT EXISTS campaign (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class CampaignRunningError(RuntimeError):
+    """Raised when another process is still sending the same campaign."""
+
+
+def ledger_path(model_id):
+    """Path of the send ledger for `model_id`."""
+    if not MODEL_ID_PATTERN.match(str(model_id)):
+        raise FileNotFoundError(f"Invalid model ID {model_id}")
+    return os.path.join(CAMPAIGNS_DIR, f"campaign_{model_id}.sqlite")
+
+
+class SendLedger:
+    """
+    Recipient status table for one campaign.
+
+    Every status change is committed before the next request goes out, so a
+    crashed or restarted campaign knows exactly who was already sent to.
+    Safe to share between the dispatcher's worker threads.
+    """
+
+    def __init__(self, model_id):
+        self.model_id = model_id
+        path = ledger_path(model_id)
+        os.makedirs(CAMPAIGNS_DIR, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open_existing(cls, model_id):
+        """Open the ledger of a campaign that has been started before."""
+        if not os.path.exists(ledger_path(model_id)):
+            raise FileNotFoundError(f"No email campaign found for model ID {model_id}")
+        return cls(model_id)
+
+    def close(self):
+        self._db.close()
+
+    def _meta(self):
+        return dict(self._db.execute("SELECT key, value FROM campaign").fetchall())
+
+    def _set_meta(self, **fields):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO campaign (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in fields.items()],
+        )
+
+    def claim(self):
+        """
+        Mark the campaign as running in this process, recovering in-flight recipients.
+
+        Raises:
+            CampaignRunningError: If another process is running it and still making progress.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                meta = {key: json.loads(value) for key, value in self._meta().items()}
+                if meta.get("state") == "running" and time.time() - meta.get("heartbeat", 0) < CAMPAIGN_STALE_SECONDS:
+                    raise CampaignRunningError(f"Campaign for model {self.model_id} is already running")
+                self._db.execute(
+                    "UPDATE recipients SET status = 'unknown', updated_at = ? WHERE status = 'sending'", (time.time(),)
+                )
+                now = time.time()
+                self._set_meta(
+                    state="running", pid=os.getpid(), heartbeat=now, started_at=meta.get("started_at", now),
+                    finished_at=None, error=None,
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def enroll(self, messages):
+        """Add rendered messages in send order; recipients already in the ledger are left untouched."""
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                offset = self._db.execute("SELECT COUNT(*) FROM recipients").fetchone()[0]
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO recipients (email, position, message) VALUES (?, ?, ?)",
+                    (
+                        (message["to"], offset + position, json.dumps(message))
+                        for position, message in enumerate(messages)
+                    ),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def pending(self, page_size=PENDING_PAGE_SIZE):
+        """Yield messages not yet attempted, in send order, reading one page at a time."""
+        position = -1
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT position, message FROM recipients WHERE status = 'pending' AND position > ? "
+                    "ORDER BY position LIMIT ?",
+                    (position, page_size),
+                ).fetchall()
+            if not rows:
+                return
+            position = rows[-1][0]
+            for _, message in rows:
+                yield json.loads(message)
+
+    def claim_batch(self, batch):
+        """
+        Move the messages of `batch` that are still pending to "sending".
+
+        Each row is only taken if it is still pending, so when two runs of a
+        campaign overlap (one wrongly judged stale) a recipient is claimed, and
+        sent, by only one of them.
+
+        Returns:
+            list: The messages this call claimed, in batch order.
+        """
+        now = time.time()
+        claimed = []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for message in batch:
+                    cursor = self._db.execute(
+                        "UPDATE recipients SET status = 'sending', updated_at = ? WHERE email = ? AND status = 'pending'",
+                        (now, message["to"]),
+                    )
+                    if cursor.rowcount:
+                        claimed.append(message)
+                self._set_meta(heartbeat=now)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return claimed
+
+    def mark(self, batch, status, http_status=None):
+        """Record `status` for every message in `batch`."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "UPDATE recipients SET status = ?, http_status = ?, updated_at = ? WHERE email = ?",
+                    [(status, http_status, now, message["to"]) for message in batch],
+                )
+                self._set_meta(heartbeat=now)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def heartbeat(self):
+        """Record that the running campaign is still alive."""
+        with self._lock:
+            self._set_meta(heartbeat=time.time())
+
+    @contextmanager
+    def keep_alive(self, interval=HEARTBEAT_SECONDS):
+        """Refresh the heartbeat from a background thread while the block runs, so retries and backoff never look stale."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                self.heartbeat()
+
+        thread = threading.Thread(target=beat, name=f"campaign-heartbeat-{self.model_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def finish(self, state="completed", error=None):
+        with self._lock:
+            self._set_meta(state=state, finished_at=time.time(), heartbeat=time.time(), error=error)
+
+    def status(self):
+        """
+        Campaign progress.
+
+        Returns:
+            dict: model_id, state, per-status recipient counts, total, progress and timestamps.
+        """
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM recipients GROUP BY status").fetchall())
+            meta = {key: json.loads(value) for key, value in self._meta().items()}
+        total = sum(counts.values())
+        report = {status: counts.get(status, 0) for status in RECIPIENT_STATUSES}
+        state = meta.get("state", "created")
+        if state == "running" and time.time() - meta.get("heartbeat", 0) >= CAMPAIGN_STALE_SECONDS:
+            state = "stalled"
+        return {
+            "model_id": self.model_id,
+            "state": state,
+            "total": total,
+            **report,
+            "progress": round((total - report["pending"] - report["sending"]) / total, 4) if total else 1.0,
+            "started_at": meta.get("started_at"),
+            "updated_at": meta.get("heartbeat"),
+            "finished_at": meta.get("finished_at"),
+            "error": meta.get("error"),
+        }
+
+
+def campaign_status(model_id):
+    """
+    Progress of the email campaign for `model_id`.
+
+    Raises:
+        FileNotFoundError: If no campaign was ever started for `model_id`.
+    """
+    ledger = SendLedger.open_existing(model_id)
+    try:
+        return ledger.status()
+    finally:
+        ledger.close()
@@ -1,58 +1,280 @@
-# email.py
+# Reward email pipeline
+# ----- Streams recommendations, renders them with precompiled templates and sends them through a pluggable transport -----
 import os
 import json
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+import string
+import threading
 from dotenv import load_dotenv
+from email_dispatcher import dispatch, SendGridTransport, SMTPTransport, FileTransport
+from email_ledger import SendLedger, CAMPAIGNS_DIR
+from recommendation_store import open_store
+from instrumentation import get_logger
 
 # Load SENDGRID_API_KEY and SENDER from .env
 load_dotenv()
 SENDGRID_API_KEY = os.environ.get("SENDGRID_API_KEY")
 SENDER = os.environ.get("SENDGRID_SENDER_EMAIL")
 
-print("API KEY:", SENDGRID_API_KEY)
-print("SENDER:", SENDER)
+# "sendgrid", "smtp" (SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_STARTTLS) or "file" (EMAIL_OUTBOX_DIR)
+EMAIL_TRANSPORT = os.environ.get("EMAIL_TRANSPORT", "sendgrid")
+EMAIL_OUTBOX_DIR = os.environ.get("EMAIL_OUTBOX_DIR", os.path.join("backend", "outbox"))
 
-def send_bulk_from_model(model_id, base_dir="backend/recommendations_with_emails"):
+# $customer_id, $email and $reward_lines are filled in per recipient
+SUBJECT_TEMPLATE = os.environ.get("EMAIL_SUBJECT_TEMPLATE", "Your Personalised Rewards")
+BODY_TEMPLATE = os.environ.get("EMAIL_BODY_TEMPLATE", "🎁 Here are your rewards:\n\n$reward_lines")
+TEMPLATE_FIELDS = ("customer_id", "email", "reward_lines")
+
+# Characters read per chunk when streaming a recommendations file
+READ_CHUNK_CHARS = 64 * 1024
+
+log = get_logger(__name__)
+
+def compile_template(text):
     """
-    Reads recommendations_<model_id>.json and sends each user a personalized email.
-    Returns the number of successfully sent emails.
+    Split a $-placeholder template into literal text and field names, once.
+
+    Rendering is then a single join instead of a regex substitution per recipient.
+
+    Returns:
+        list: (literal, field name or None) pairs.
+
+    Raises:
+        ValueError: If the template uses a field other than TEMPLATE_FIELDS.
     """
-    # 1. Locate the JSON file
-    path = os.path.join(base_dir, f"recommendations_{model_id}.json")
-    if not os.path.exists(path):
-        raise FileNotFoundError(f"Model ID {model_id} not found at {path}")
+    parts = []
+    literal = ""
+    position = 0
+    for match in string.Template.pattern.finditer(text):
+        literal += text[position:match.start()]
+        position = match.end()
+        if match.group("escaped") is not None:
+            literal += "$"
+            continue
+        name = match.group("named") or match.group("braced")
+        if name not in TEMPLATE_FIELDS:
+            raise ValueError(f"Unknown email template field ${name}; use one of {', '.join(TEMPLATE_FIELDS)}")
+        parts.append((literal, name))
+        literal = ""
+    parts.append((literal + text[position:], None))
+    return parts
 
-    with open(path, "r") as f:
-        recs = json.load(f)
+class EmailTemplate:
+    """Subject and body templates compiled once and rendered for every recipient"""
 
-    # 2. Initialize SendGrid client
-    sg = SendGridAPIClient(api_key=SENDGRID_API_KEY)
-    sent = 0
+    def __init__(self, subject=SUBJECT_TEMPLATE, body=BODY_TEMPLATE):
+        self._subject = compile_template(subject)
+        self._body = compile_template(body)
 
-    # 3. Loop through each user and send email
-    for entry in recs:
-        email = entry.get("email")
-        rewards = entry.get("rewards", [])
+    @staticmethod
+    def _fill(parts, fields):
+        return "".join(literal + fields[name] if name else literal for literal, name in parts)
+
+    def render(self, entry):
+        """
+        Render one recommendations_with_emails entry.
 
+        Returns:
+            dict: "to", "subject" and "body" of the message.
+        """
+        fields = {
+            "customer_id": str(entry.get("customer_id", "")),
+            "email": entry["email"],
+            "reward_lines": "\n".join(entry.get("rewards", [])),
+        }
+        return {"to": entry["email"], "subject": self._fill(self._subject, fields), "body": self._fill(self._body, fields)}
+
+def iter_json_array(path, chunk_chars=READ_CHUNK_CHARS):
+    """
+    Yield the elements of a JSON array file one at a time.
+
+    Only the element being decoded is held in memory, not the whole file.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        position = 0
+        opened = False
+        eof = False
+        while True:
+            chunk = f.read(chunk_chars)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n,":
+                    position += 1
+                if position == len(buffer):
+                    break
+                if not opened:
+                    if buffer[position] != "[":
+                        raise ValueError(f"{path} does not contain a JSON array")
+                    opened = True
+                    position += 1
+                    continue
+                if buffer[position] == "]":
+                    return
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    break
+                if end == len(buffer) and not eof:
+                    # The element may continue in the next chunk
+                    break
+                yield value
+                position = end
+            if eof:
+                raise ValueError(f"{path} ended before its JSON array was closed")
+
+def render_messages(entries, template):
+    """Render a message for every entry with an email address, lazily"""
+    for entry in entries:
+        email = entry.get("email")
         if not email or email == "No Email Provided":
             continue
+        yield template.render(entry)
+
+def make_transport(model_id):
+    """Build the transport selected by EMAIL_TRANSPORT"""
+    if EMAIL_TRANSPORT == "sendgrid":
+        return SendGridTransport(SENDGRID_API_KEY, SENDER)
+    if EMAIL_TRANSPORT == "smtp":
+        return SMTPTransport(
+            os.environ.get("SMTP_HOST", "localhost"),
+            int(os.environ.get("SMTP_PORT", 25)),
+            SENDER,
+            username=os.environ.get("SMTP_USERNAME"),
+            password=os.environ.get("SMTP_PASSWORD"),
+            starttls=os.environ.get("SMTP_STARTTLS", "").lower() in ("1", "true", "yes"),
+        )
+    if EMAIL_TRANSPORT == "file":
+        return FileTransport(os.path.join(EMAIL_OUTBOX_DIR, f"outbox_{model_id}.jsonl"), SENDER)
+    raise ValueError(f"Unknown EMAIL_TRANSPORT {EMAIL_TRANSPORT}")
+
+def _prepare_campaign(model_id, base_dir, template):
+    """Claim the campaign's send ledger and enroll the rendered message of every new recipient."""
+    # 1. Locate the recommendations: the model's columnar store, or the JSON file older models wrote
+    try:
+        entries = open_store(model_id).iter_entries(with_email=True)
+    except FileNotFoundError:
+        path = os.path.join(base_dir, f"recommendations_{model_id}.json")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Model ID {model_id} not found at {path}")
+        entries = iter_json_array(path)
+
+    # 2. Stream the recommendations into the ledger as rendered messages; recipients
+    #    from an earlier run keep their status
+    ledger = SendLedger(model_id)
+    try:
+        ledger.claim()
+        ledger.enroll(render_messages(entries, template))
+    except BaseException:
+        ledger.close()
+        raise
+    return ledger
+
+def _open_campaign(model_id, base_dir, template, transport):
+    """Transport and claimed ledger for a campaign run; the transport is built first so a bad
+    configuration fails before the campaign is marked as running."""
+    transport = transport or make_transport(model_id)
+    try:
+        ledger = _prepare_campaign(model_id, base_dir, template or EmailTemplate())
+    except BaseException:
+        transport.close()
+        raise
+    return ledger, transport
+
+def _run_campaign(ledger, transport):
+    """Send every pending message in the ledger, recording each outcome as it arrives."""
+    try:
+        log.info("Sending %d pending reward emails for model %s", ledger.status()["pending"], ledger.model_id)
+
+        # 3. Send in batches from a worker pool through the transport. Each batch is claimed
+        #    row by row first, so a recipient another run already took is not sent twice
+        with ledger.keep_alive():
+            result = dispatch(
+                ledger.pending(),
+                transport,
+                on_start=ledger.claim_batch,
+                on_result=lambda batch, delivered, status: ledger.mark(batch, "sent" if delivered else "failed", status),
+            )
+        if result["failed"]:
+            log.warning("Failed to send %d reward emails", result["failed"])
+        ledger.finish()
+        return result["sent"]
+    except Exception as e:
+        ledger.finish("failed", str(e))
+        raise
+    finally:
+        transport.close()
+        ledger.close()
+
+def send_bulk_from_model(model_id, base_dir="backend/recommendations_with_emails", template=None, transport=None):
+    """
+    Reads the recommendations stored for <model_id> (or the recommendations_<model_id>.json
+    of models trained before the columnar store) and sends each user a personalized email.
+    Emails go out concurrently in batched requests; see email_dispatcher for tuning.
+    Recipients already handled by an earlier run for the same model are skipped,
+    so an interrupted campaign can simply be run again.
+    Returns the number of emails sent by this run.
+    """
+    return _run_campaign(*_open_campaign(model_id, base_dir, template, transport))
+
+def start_campaign(model_id, base_dir="backend/recommendations_with_emails", template=None, transport=None):
+    """
+    Start (or resume) sending the campaign for `model_id` in a background thread.
+
+    Returns:
+        dict: Campaign status at the time it was started, see `email_ledger.campaign_status`.
+
+    Raises:
+        FileNotFoundError: If there are no recommendations for `model_id`.
+        CampaignRunningError: If the campaign is already being sent.
+    """
+    ledger, transport = _open_campaign(model_id, base_dir, template, transport)
+    status = ledger.status()
+    threading.Thread(target=_run_campaign, args=(ledger, transport), name=f"campaign-{model_id}", daemon=True).start()
+    return status
+
+
+if __name__ == "__main__":
+    # Benchmark with the file transport, run from the repo root: python backend/email_sending.py [recipients ...]
+    # Peak memory should stay flat as the campaign grows
+    import sys
+    import time
+    import shutil
+    import resource
+    import tempfile
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 500_000]
+    work_dir = tempfile.mkdtemp()
+    template = EmailTemplate()
+    try:
+        for size in sizes:
+            model_id = f"bench{size}"
+            with open(os.path.join(work_dir, f"recommendations_{model_id}.json"), "w") as f:
+                f.write("[")
+                for i in range(size):
+                    entry = {"customer_id": f"C{i}", "email": f"customer{i}@example.com", "rewards": [f"10% off B{i:09d} <ABCDE>"] * 3}
+                    f.write(("," if i else "") + json.dumps(entry))
+                f.write("]")
+
+            start = time.perf_counter()
+            rendered = sum(1 for _ in render_messages(iter_json_array(os.path.join(work_dir, f"recommendations_{model_id}.json")), template))
+            render_seconds = time.perf_counter() - start
 
-        body = "🎁 Here are your rewards:\n\n" + "\n".join(rewards)
+            start = time.perf_counter()
+            transport = FileTransport(os.path.join(work_dir, f"outbox_{model_id}.jsonl"), SENDER)
+            sent = send_bulk_from_model(model_id, base_dir=work_dir, template=template, transport=transport)
+            send_seconds = time.perf_counter() - start
+            assert rendered == sent == size, (rendered, sent)
 
-        try:
-            msg = Mail(
-                from_email=SENDER,
-                to_emails=email,
-                subject="Your Personalised Rewards",
-                plain_text_content=body
+            peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print(
+                f"{size:>8} recipients: render {size / render_seconds:9.0f} msgs/s  "
+                f"end to end {size / send_seconds:8.0f} msgs/s  peak RSS {peak_mb:6.1f}MB"
             )
-            response = sg.send(msg)
-            if response.status_code == 202:
-                sent += 1
-            else:
-                print(f"Failed to send to {email}: Status {response.status_code}")
-        except Exception as e:
-            print(f"Exception while sending to {email}: {str(e)}")
-
-    return sent
+            os.remove(os.path.join(CAMPAIGNS_DIR, f"campaign_{model_id}.sqlite"))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,21 @@
+# Column name constants shared by the upload, analytics and ingestion code
+
+# Column name constants for customers data
+class CustomerHeaders:
+    CUSTOMER_ID = 'CustomerID'
+    GENDER = 'Gender'
+    AGE_GROUP = 'AgeGroup'
+
+# Column name constants for products data  
+class ProductHeaders:
+    PRODUCT_ID = 'ProductID'
+    CATEGORY = 'ProductCategory'
+    PRICE = 'Price'
+
+# Column name constants for interactions data
+class InteractionHeaders:
+    CUSTOMER_ID = 'CustomerID'
+    PRODUCT_ID = 'ProductID'
+    PURCHASES = 'NumberOfPurchases'
+    RATINGS = 'Rating'
+    EMAIL = 'Email'
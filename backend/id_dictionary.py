@@ -0,0 +1,147 @@
+# Interned customer and product ids
+# ----- One append-only id -> int32 code dictionary per id column and dataset; frames carry categorical codes -----
+
+import numpy as np
+import pandas as pd
+from headers import CustomerHeaders, ProductHeaders
+
+# Id columns interned at ingestion. The column names are shared by the customers,
+# products and interactions frames, so one dictionary serves every frame.
+ID_COLUMNS = (CustomerHeaders.CUSTOMER_ID, ProductHeaders.PRODUCT_ID)
+
+
+class IdDictionary:
+    """
+    Append-only dictionary from id strings to int32 codes.
+
+    Codes are positions in `ids` and never change once assigned, so columns
+    encoded against an older, shorter version of the dictionary stay valid.
+    Encoded columns are pandas Categoricals sharing `dtype`, which keeps joins,
+    groupbys and drop_duplicates on the integer codes.
+    """
+
+    def __init__(self, ids=()):
+        self.ids = pd.Index(ids, dtype=object)
+        self.dtype = pd.CategoricalDtype(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def extend(self, values):
+        """
+        Add the ids in `values` not yet in the dictionary, in first-seen order.
+
+        Returns:
+            pd.Index: The newly added ids.
+        """
+        if isinstance(getattr(values, "dtype", None), pd.CategoricalDtype):
+            # Only the categories actually used need checking, not every row
+            values = pd.Series(values).cat.remove_unused_categories().cat.categories
+        uniques = pd.Index(pd.unique(pd.Series(values, dtype=object).dropna().astype(str)), dtype=object)
+        added = uniques[self.ids.get_indexer(uniques) < 0]
+        if len(added):
+            self.ids = self.ids.append(added)
+            self.dtype = pd.CategoricalDtype(self.ids)
+        return added
+
+    def encode(self, values):
+        """
+        Categorical of `values` over this dictionary; missing ids become NaN.
+
+        Ids not in the dictionary are also NaN, so `extend` first.
+        """
+        if isinstance(getattr(values, "dtype", None), pd.CategoricalDtype):
+            # Recoded through the categories, not row by row
+            return pd.Categorical(values, dtype=self.dtype)
+        return pd.Categorical(pd.Series(values, dtype=object).astype(str).where(pd.notna(values)), dtype=self.dtype)
+
+    def codes(self, values):
+        """int32 codes of `values`, -1 where missing."""
+        return self.encode(values).codes.astype(np.int32, copy=False)
+
+    def decode(self, codes):
+        """Id strings for int codes, None where a code is -1."""
+        codes = np.asarray(codes)
+        decoded = self.ids.to_numpy()[np.where(codes < 0, 0, codes)] if len(self.ids) else np.full(len(codes), None, dtype=object)
+        return np.where(codes < 0, None, decoded)
+
+
+def factorize_ids(ids, sort=False):
+    """
+    `pd.factorize` for an id column, working on its codes when it is already interned.
+
+    Only the ids present in the column are returned. With `sort` they are in
+    string order, as `pd.factorize(sort=True)` orders plain strings, so ties break
+    the same way whether or not the column was interned.
+
+    Returns:
+        tuple: (codes, uniques) with codes aligned to `ids` and uniques an object array.
+        Missing ids get code -1 and no entry in uniques, as with `pd.factorize`.
+    """
+    if not isinstance(getattr(ids, "dtype", None), pd.CategoricalDtype):
+        codes, uniques = pd.factorize(ids, sort=sort)
+        return codes, np.asarray(uniques, dtype=object)
+
+    dictionary_codes = np.asarray(pd.Series(ids).cat.codes)
+    present = dictionary_codes >= 0
+    known = dictionary_codes if present.all() else dictionary_codes[present]
+    seen, inverse = np.unique(known, return_inverse=True) if sort else _first_seen(known)
+    uniques = np.asarray(ids.cat.categories if hasattr(ids, "cat") else ids.categories, dtype=object)[seen]
+    if sort:
+        order = np.argsort(uniques, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        inverse, uniques = rank[inverse], uniques[order]
+    if known is dictionary_codes:
+        return inverse, uniques
+    codes = np.full(len(dictionary_codes), -1, dtype=inverse.dtype)
+    codes[present] = inverse
+    return codes, uniques
+
+
+def _first_seen(codes):
+    """Unique values of `codes` in first-seen order, and each element's position among them."""
+    uniques, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return uniques[order], rank[inverse]
+
+
+if __name__ == "__main__":
+    # Benchmark: memory and groupby / join / dedupe time with object id columns vs interned codes.
+    # Run from the repository root: python backend/id_dictionary.py [num_interactions]
+    import sys
+    import time
+    from synthetic_data import generate_frames
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    interactions_df, customers_df, products_df = generate_frames(size)
+
+    frames = {"interactions": interactions_df, "customers": customers_df, "products": products_df}
+    dictionaries = {column: IdDictionary() for column in ID_COLUMNS}
+    for column, dictionary in dictionaries.items():
+        for df in frames.values():
+            if column in df.columns:
+                dictionary.extend(df[column])
+    interned = {}
+    for name, df in frames.items():
+        interned[name] = df.assign(**{column: dictionaries[column].encode(df[column]) for column in ID_COLUMNS if column in df.columns})
+
+    def timed(label, frames):
+        interactions, customers = frames["interactions"], frames["customers"]
+        mb = sum(interactions[column].memory_usage(deep=True, index=False) for column in ID_COLUMNS) / 2**20
+        start = time.perf_counter()
+        interactions.groupby(ID_COLUMNS[0], observed=True)["NumberOfPurchases"].sum()
+        groupby_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        interactions.merge(customers, on=ID_COLUMNS[0], how="left")
+        join_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        interactions.drop_duplicates(list(ID_COLUMNS))
+        dedupe_seconds = time.perf_counter() - start
+        print(f"{label:14s} ids {mb:7.1f} MB  groupby {groupby_seconds:5.2f}s  join {join_seconds:5.2f}s  dedupe {dedupe_seconds:5.2f}s")
+
+    print(f"{size} interactions, {len(dictionaries[ID_COLUMNS[0]])} customers, {len(dictionaries[ID_COLUMNS[1]])} products")
+    timed("object ids", frames)
+    timed("interned ids", interned)
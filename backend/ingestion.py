@@ -0,0 +1,290 @@
+# Streaming CSV ingestion for multipart uploads
+# ----- Spools uploaded files to disk and parses them in chunks with explicit dtypes -----
+
+import os
+import gzip
+import shutil
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from headers import InteractionHeaders
+from schema import parse_header_line, read_options, coerce_numeric, finalize
+from id_dictionary import IdDictionary
+from analytics import IncrementalAnalytics
+from instrumentation import get_logger, span
+
+# Rows parsed per chunk; parsing buffers stay proportional to this, not to the file size
+CHUNK_ROWS = int(os.environ.get("CSV_CHUNK_ROWS", 100_000))
+# Bytes copied per read when spooling an upload to disk
+SPOOL_CHUNK_BYTES = 1024 * 1024
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Stream interactions into one row per (CustomerID, ProductID) pair instead of keeping every raw row;
+# uploads can override this per request
+AGGREGATE_INTERACTIONS = os.environ.get("AGGREGATE_INTERACTIONS", "").lower() in ("1", "true", "yes")
+
+log = get_logger(__name__)
+
+
+def spool_to_disk(file_storage, path):
+    """
+    Stream an uploaded file to `path` without holding it in memory.
+
+    Args:
+        file_storage (werkzeug.datastructures.FileStorage): Uploaded file.
+        path (str): Destination path.
+
+    Returns:
+        int: Number of bytes written.
+    """
+    with open(path, "wb") as f:
+        shutil.copyfileobj(file_storage.stream, f, SPOOL_CHUNK_BYTES)
+        return f.tell()
+
+
+def _compression(path):
+    """gzip if the file starts with the gzip magic bytes, whatever its name."""
+    with open(path, "rb") as f:
+        return "gzip" if f.read(2) == GZIP_MAGIC else None
+
+
+def _open_text(path):
+    if _compression(path) == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, "r", encoding="utf-8", newline="")
+
+
+def iter_csv_chunks(path, kind, chunk_rows=CHUNK_ROWS, debug_info=None, numeric_as_text=False):
+    """
+    Parse a (optionally gzip-compressed) CSV file in chunks.
+
+    Headers are resolved once from the first line by the schema layer; only known
+    columns are parsed, already renamed and with explicit dtypes.
+
+    Args:
+        path (str): CSV or CSV.gz file.
+        kind (str): "customers", "products" or "interactions", selecting the schema.
+        chunk_rows (int): Rows per chunk.
+        debug_info (dict): Receives the header mapping and ignored columns.
+        numeric_as_text (bool): Read numeric columns as text and coerce them, for files with stray values.
+
+    Yields:
+        pd.DataFrame: Parsed chunks.
+    """
+    with _open_text(path) as f:
+        header = parse_header_line(f.readline())
+        f.seek(0)
+        options = read_options(header, kind, debug_info, numeric_as_text)
+        for chunk in pd.read_csv(f, chunksize=chunk_rows, **options):
+            yield coerce_numeric(chunk, kind) if numeric_as_text else chunk
+
+
+def concat_chunks(chunks):
+    """Concatenate chunks, keeping categorical columns categorical across chunks."""
+    if not chunks:
+        return pd.DataFrame()
+    categorical = [
+        col for col, dtype in chunks[0].dtypes.items()
+        if isinstance(dtype, pd.CategoricalDtype)
+        and all(isinstance(chunk.dtypes.get(col), pd.CategoricalDtype) for chunk in chunks)
+    ]
+    for col in categorical:
+        if all(chunk[col].dtype == chunks[0][col].dtype for chunk in chunks):
+            # Already on one dictionary, e.g. interned id columns
+            continue
+        categories = union_categoricals([chunk[col] for chunk in chunks], ignore_order=True).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_csv_file(path, kind, chunk_rows=CHUNK_ROWS, debug_info=None):
+    """
+    Read a whole (optionally gzip-compressed) CSV file chunk by chunk into one DataFrame.
+
+    Numeric columns are parsed directly; a file with values that do not parse is
+    read again with them as text and coerced, so stray values become NaN and are
+    filled with the column default.
+    """
+    with span("parse", kind=kind) as timing:
+        try:
+            chunks = list(iter_csv_chunks(path, kind, chunk_rows, debug_info))
+        except ValueError:
+            chunks = list(iter_csv_chunks(path, kind, chunk_rows, numeric_as_text=True))
+        df = finalize(concat_chunks(chunks), kind, debug_info)
+        timing.rows = len(df)
+    return df
+
+
+class InteractionAggregator:
+    """
+    Folds interaction chunks into one row per (CustomerID, ProductID) pair as they stream in.
+
+    Purchases are summed and ratings averaged; each pair keeps the email of its
+    first row, and pairs stay in order of first appearance, so the first row per
+    customer still carries that customer's first email. Ids are interned per
+    chunk, and per-chunk partial sums are only merged once they outgrow the
+    merged table, so memory follows the number of distinct pairs, not raw rows.
+    Rows missing either id cannot be placed in the interaction matrix and are
+    left out of the pairs.
+    """
+
+    def __init__(self):
+        self.customers = IdDictionary()
+        self.products = IdDictionary()
+        self.rows = 0
+        self.skipped = 0
+        self._merged = None
+        self._pending = []
+        self._pending_rows = 0
+
+    def add(self, chunk):
+        """Fold a parsed, finalized interactions chunk in."""
+        self.rows += len(chunk)
+        user_codes = self._intern(self.customers, chunk[InteractionHeaders.CUSTOMER_ID])
+        product_codes = self._intern(self.products, chunk[InteractionHeaders.PRODUCT_ID])
+        placed = (user_codes >= 0) & (product_codes >= 0)
+        self.skipped += int(len(chunk) - placed.sum())
+
+        pairs = pd.DataFrame({
+            "key": (user_codes[placed].astype(np.int64) << 32) | product_codes[placed].astype(np.int64),
+            "purchases": chunk[InteractionHeaders.PURCHASES].to_numpy(dtype=np.float64)[placed],
+            "rating_sum": chunk[InteractionHeaders.RATINGS].to_numpy(dtype=np.float64)[placed],
+            "rating_count": np.ones(int(placed.sum()), dtype=np.int64),
+            "email": chunk[InteractionHeaders.EMAIL].to_numpy(dtype=object)[placed],
+        })
+        self._pending.append(self._reduce(pairs))
+        self._pending_rows += len(self._pending[-1])
+        # Amortised: the merged table is rebuilt only once the partial sums are as large as it is
+        if self._pending_rows >= max(len(self._merged) if self._merged is not None else 0, 1):
+            self._merge()
+
+    @staticmethod
+    def _intern(dictionary, values):
+        """Dictionary codes of a chunk's ids, -1 where missing; only the chunk's distinct ids go through the dictionary."""
+        codes, uniques = pd.factorize(values)
+        dictionary.extend(uniques)
+        return np.append(dictionary.codes(uniques), np.int32(-1))[codes]
+
+    @staticmethod
+    def _reduce(pairs):
+        """Sum the rows of each key, in order of first appearance, keeping the first row's email."""
+        codes, keys = pd.factorize(pairs["key"].to_numpy(), sort=False)
+        # Codes are numbered by first appearance, so a row starts a new key where its code exceeds every earlier one
+        first = np.flatnonzero(codes > np.concatenate([[-1], np.maximum.accumulate(codes)[:-1]]))
+        return pd.DataFrame({
+            "key": keys,
+            "purchases": np.bincount(codes, weights=pairs["purchases"].to_numpy(), minlength=len(keys)),
+            "rating_sum": np.bincount(codes, weights=pairs["rating_sum"].to_numpy(), minlength=len(keys)),
+            "rating_count": np.bincount(codes, weights=pairs["rating_count"].to_numpy(), minlength=len(keys)).astype(np.int64),
+            "email": pairs["email"].to_numpy()[first],
+        })
+
+    def _merge(self):
+        parts = ([self._merged] if self._merged is not None else []) + self._pending
+        self._merged = self._reduce(pd.concat(parts, ignore_index=True)) if len(parts) > 1 else parts[0]
+        self._pending, self._pending_rows = [], 0
+
+    def frame(self):
+        """
+        The aggregated interactions, with the schema's columns and dtypes and interned ids.
+
+        Returns:
+            pd.DataFrame: One row per pair with CustomerID, ProductID, Rating (mean),
+            NumberOfPurchases (sum) and Email.
+        """
+        if self._pending:
+            self._merge()
+        merged = self._merged
+        if merged is None:
+            merged = pd.DataFrame({
+                "key": np.empty(0, dtype=np.int64), "purchases": np.empty(0),
+                "rating_sum": np.empty(0), "rating_count": np.empty(0, dtype=np.int64), "email": np.empty(0, dtype=object),
+            })
+        keys = merged["key"].to_numpy(dtype=np.int64)
+        return pd.DataFrame({
+            InteractionHeaders.CUSTOMER_ID: pd.Categorical.from_codes((keys >> 32).astype(np.int32), dtype=self.customers.dtype),
+            InteractionHeaders.PRODUCT_ID: pd.Categorical.from_codes((keys & 0xFFFFFFFF).astype(np.int32), dtype=self.products.dtype),
+            InteractionHeaders.RATINGS: (merged["rating_sum"] / merged["rating_count"]).to_numpy(dtype=np.float32),
+            InteractionHeaders.PURCHASES: merged["purchases"].to_numpy(dtype=np.float32),
+            InteractionHeaders.EMAIL: merged["email"].to_numpy(dtype=object),
+        })
+
+
+def _aggregate_chunks(path, chunk_rows, debug_info, numeric_as_text):
+    aggregator, analytics = InteractionAggregator(), IncrementalAnalytics()
+    for chunk in iter_csv_chunks(path, "interactions", chunk_rows, debug_info, numeric_as_text):
+        chunk = finalize(chunk, "interactions", debug_info)
+        # Analytics see the raw rows, so rating and purchase counts are unaffected by aggregation
+        analytics.add_interactions(chunk)
+        aggregator.add(chunk)
+    return aggregator, analytics
+
+
+def read_interactions_aggregated(path, chunk_rows=CHUNK_ROWS, debug_info=None, products_df=None):
+    """
+    Stream an interactions CSV into one row per (CustomerID, ProductID) pair and its analytics.
+
+    Peak memory depends on the distinct pairs, customers and products, plus one
+    chunk; raw rows are never held together. Like `read_csv_file`, a file with
+    values that do not parse is streamed again with numeric columns as text.
+
+    Args:
+        path (str): CSV or CSV.gz file.
+        chunk_rows (int): Rows per chunk.
+        debug_info (dict): Receives the header mapping and ignored columns.
+        products_df (pd.DataFrame): Product data for analytics' product details and revenue.
+
+    Returns:
+        tuple: (interactions_df, analytics, aggregator) with the aggregated frame (see
+        `InteractionAggregator.frame`), the `analytics.IncrementalAnalytics` of every
+        raw row, and the `InteractionAggregator`, which later rows can be folded into.
+    """
+    with span("parse", kind="interactions", mode="aggregate") as timing:
+        try:
+            aggregator, analytics = _aggregate_chunks(path, chunk_rows, debug_info, False)
+        except ValueError:
+            aggregator, analytics = _aggregate_chunks(path, chunk_rows, None, True)
+        analytics.set_products(products_df)
+        df = aggregator.frame()
+        timing.rows = aggregator.rows
+    if aggregator.skipped:
+        log.warning("Left %d interaction rows without a CustomerID or ProductID out of the pairs", aggregator.skipped)
+    log.info("Aggregated %d interaction rows into %d customer-product pairs", aggregator.rows, len(df))
+    return df, analytics, aggregator
+
+
+if __name__ == "__main__":
+    # Benchmark: peak memory and time of reading a whole interactions file against streaming it into pairs.
+    # Run from the repository root: python backend/ingestion.py [num_rows] [rows_per_pair]
+    import sys
+    import tempfile
+    from benchmark import StageTimer
+    from analytics import compute_basic_analytics
+    from synthetic_data import generate_frames
+
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+    rows_per_pair = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    scratch = tempfile.mkdtemp(prefix="ingestion-benchmark-")
+    path = os.path.join(scratch, "interactions.csv")
+    # Yearly exports repeat the same customer-product pairs; write the pairs `rows_per_pair` times over
+    pairs, _, _ = generate_frames(num_rows // rows_per_pair)
+    pairs = pairs.drop_duplicates([InteractionHeaders.CUSTOMER_ID, InteractionHeaders.PRODUCT_ID])
+    with open(path, "w") as f:
+        for repeat in range(rows_per_pair):
+            pairs.sample(frac=1, random_state=repeat).to_csv(f, index=False, header=repeat == 0)
+    print(f"{len(pairs) * rows_per_pair} rows, {len(pairs)} pairs, {os.path.getsize(path) / 2**20:.0f} MB of CSV")
+    del pairs
+
+    timer = StageTimer()
+    with timer.stage("aggregated"):
+        aggregated, state, _ = read_interactions_aggregated(path)
+        state.to_analytics()
+    del aggregated, state
+    with timer.stage("whole_file"):
+        interactions = read_csv_file(path, "interactions")
+        compute_basic_analytics(interactions)
+    del interactions
+    for name, stage in timer.stages.items():
+        print(f"{name:12s} {stage['seconds']:7.2f}s  peak RSS {stage['peak_rss_mb']:8.1f} MB")
+    shutil.rmtree(scratch, ignore_errors=True)
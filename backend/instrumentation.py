@@ -0,0 +1,281 @@
+# Timing spans, counters and histograms, and logging setup
+# ----- Per-process metrics merged across gunicorn and training workers and rendered in Prometheus text format -----
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+METRICS_DIR = os.path.join("backend", "metrics")
+# DEBUG turns on the verbose dumps (parsed columns, dtypes, header mappings); INFO keeps one line per event
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Snapshots of this process's metrics are written at most this often, and at request / job boundaries
+FLUSH_INTERVAL_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 5))
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+
+# name -> (type, help). Only metrics declared here can be recorded.
+METRICS = {
+    "pipeline_stage_seconds": ("histogram", "Time spent in each pipeline stage"),
+    "pipeline_stage_errors_total": ("counter", "Pipeline stages that raised an exception"),
+    "pipeline_rows_total": ("counter", "Rows handled by each pipeline stage"),
+    "http_requests_total": ("counter", "HTTP requests by endpoint, method and status"),
+    "http_request_seconds": ("histogram", "HTTP request latency by endpoint"),
+    "training_cache_lookups_total": ("counter", "Upload fingerprint lookups by result"),
+    "training_jobs_total": ("counter", "Finished training jobs by outcome"),
+}
+
+# Each process records into its own registry and writes it to METRICS_DIR as
+# <pid>-<token>.json; /metrics merges every snapshot. Snapshots of processes that
+# have exited are folded into one file so the directory does not grow with restarts.
+_ARCHIVE = "exited.json"
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_state = {"token": uuid.uuid4().hex[:8], "flushed_at": 0.0}
+
+
+def _reset_after_fork():
+    # A forked worker starts empty, or the parent's values would be counted twice
+    global _lock
+    _lock = threading.Lock()
+    _counters.clear()
+    _histograms.clear()
+    _state.update(token=uuid.uuid4().hex[:8], flushed_at=0.0)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_logger(name):
+    """Logger for a backend module; the level comes from LOG_LEVEL."""
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    return logging.getLogger(name)
+
+
+log = get_logger(__name__)
+
+
+def _key(name, labels):
+    if name not in METRICS:
+        raise KeyError(f"Unknown metric {name}")
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add `value` to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    """Record one observation in a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0}
+        for position, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][position] += 1
+                break
+        histogram["sum"] += value
+        histogram["count"] += 1
+    _maybe_flush()
+
+
+class Span:
+    """Handle yielded by `span`; set `rows` to count the rows the stage handled."""
+
+    def __init__(self):
+        self.rows = None
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Time a pipeline stage into `pipeline_stage_seconds{stage=...}`.
+
+    Exceptions are counted in `pipeline_stage_errors_total` and re-raised.
+    Rows set on the yielded Span are added to `pipeline_rows_total`.
+    """
+    handle = Span()
+    start = time.perf_counter()
+    try:
+        yield handle
+    except BaseException:
+        inc("pipeline_stage_errors_total", stage=stage, **labels)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe("pipeline_stage_seconds", seconds, stage=stage, **labels)
+        if handle.rows is not None:
+            inc("pipeline_rows_total", handle.rows, stage=stage, **labels)
+        log.debug("%s%s took %.3fs", stage, f" {labels}" if labels else "", seconds)
+
+
+def timed(stage):
+    """Decorator running the whole function in a `span(stage)`."""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _as_snapshot(counters, histograms):
+    """JSON-friendly form of a registry: [name, labels, value] lists."""
+    return {
+        "counters": [[name, dict(labels), value] for (name, labels), value in counters.items()],
+        "histograms": [[name, dict(labels), histogram] for (name, labels), histogram in histograms.items()],
+    }
+
+
+def _snapshot():
+    with _lock:
+        return json.loads(json.dumps(_as_snapshot(_counters, _histograms)))
+
+
+def _snapshot_path():
+    return os.path.join(METRICS_DIR, f"{os.getpid()}-{_state['token']}.json")
+
+
+def _write(path, snapshot):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def flush():
+    """Write this process's metrics so /metrics in any process includes them."""
+    if not _counters and not _histograms:
+        return
+    _state["flushed_at"] = time.monotonic()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _write(_snapshot_path(), _snapshot())
+    except OSError as e:
+        log.warning("Could not write metrics snapshot: %s", e)
+
+
+def _maybe_flush():
+    if time.monotonic() - _state["flushed_at"] >= FLUSH_INTERVAL_SECONDS:
+        flush()
+
+
+atexit.register(flush)
+
+
+def _merge(into, snapshot):
+    # Metrics no longer declared (e.g. from an older release) are dropped
+    for name, labels, value in snapshot.get("counters", []):
+        if name not in METRICS:
+            continue
+        key = _key(name, labels)
+        into["counters"][key] = into["counters"].get(key, 0) + value
+    for name, labels, histogram in snapshot.get("histograms", []):
+        if name not in METRICS or len(histogram["buckets"]) != len(DURATION_BUCKETS):
+            continue
+        key = _key(name, labels)
+        merged = into["histograms"].setdefault(key, {"buckets": [0] * len(DURATION_BUCKETS), "sum": 0.0, "count": 0})
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], histogram["buckets"])]
+        merged["sum"] += histogram["sum"]
+        merged["count"] += histogram["count"]
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def collect():
+    """
+    Merge the snapshots of every process, this one live.
+
+    Returns:
+        dict: "counters" and "histograms", each (name, labels) -> value.
+    """
+    flush()
+    merged = {"counters": {}, "histograms": {}}
+    if not os.path.isdir(METRICS_DIR):
+        return merged
+    with open(os.path.join(METRICS_DIR, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        archive_path = os.path.join(METRICS_DIR, _ARCHIVE)
+        archive = {"counters": {}, "histograms": {}}
+        _merge(archive, _read_json(archive_path))
+        exited = []
+        for name in os.listdir(METRICS_DIR):
+            if not name.endswith(".json") or name == _ARCHIVE:
+                continue
+            snapshot = _read_json(os.path.join(METRICS_DIR, name))
+            pid = int(name.split("-", 1)[0]) if name.split("-", 1)[0].isdigit() else None
+            if pid is not None and not _alive(pid):
+                _merge(archive, snapshot)
+                exited.append(name)
+            else:
+                _merge(merged, snapshot)
+        if exited:
+            _write(archive_path, _as_snapshot(archive["counters"], archive["histograms"]))
+            for name in exited:
+                os.remove(os.path.join(METRICS_DIR, name))
+    _merge(merged, _as_snapshot(archive["counters"], archive["histograms"]))
+    return merged
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def render():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    merged = collect()
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, labels), value in sorted(merged["counters"].items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        else:
+            for (metric, labels), histogram in sorted(merged["histograms"].items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS, histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,173 @@
+# Background training jobs
+# ----- Runs train_model in a process pool; job status lives in JSON files so every gunicorn worker can poll it -----
+
+import os
+import re
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from train_lightfm import train_model, update_model, refresh_recommendations
+from instrumentation import get_logger, inc, flush
+from parallelism import share_budget
+
+JOBS_DIR = os.path.join("backend", "jobs")
+TRAINING_WORKERS = int(os.environ.get("TRAINING_WORKERS", 1))
+# A running job whose status file has not changed for this long is taken as hung
+JOB_STALE_SECONDS = int(os.environ.get("JOB_STALE_SECONDS", 3600))
+
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+log = get_logger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Process pool shared by this server process, created on first use (after gunicorn forks)."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Each worker takes its share of the CPU budget for fit, scoring and reward shards
+            _executor = ProcessPoolExecutor(
+                max_workers=TRAINING_WORKERS, initializer=share_budget, initargs=(TRAINING_WORKERS,)
+            )
+        return _executor
+
+
+def job_path(job_id):
+    if not JOB_ID_PATTERN.match(str(job_id)):
+        raise FileNotFoundError(f"Invalid job ID {job_id}")
+    return os.path.join(JOBS_DIR, f"job_{job_id}.json")
+
+
+def get_job(job_id):
+    """
+    Read the current status of a job.
+
+    Returns:
+        dict: job_id, state (queued/running/succeeded/failed), stage, progress,
+        model_id once trained and error if the job failed. Warm starts also have
+        recommendations_state: "refreshing" while users still carry the base
+        model's rewards, then "complete" (or "partial" if the refresh was skipped or failed).
+
+    Raises:
+        FileNotFoundError: If no job exists under `job_id`.
+    """
+    path = job_path(job_id)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Job ID {job_id} not found")
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def update_job(job_id, **fields):
+    """Merge `fields` into the job's status file, replacing it atomically."""
+    path = job_path(job_id)
+    job = get_job(job_id) if os.path.exists(path) else {"job_id": job_id}
+    job.update(fields, updated_at=time.time())
+
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+    return job
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def job_abandoned(job, stale_seconds=JOB_STALE_SECONDS):
+    """
+    Whether a queued or running job will never finish.
+
+    That is the case once the process responsible for it has exited: the server
+    process that queued it, then the worker running it. A running job whose
+    status has not been updated for `stale_seconds` counts as abandoned too, as
+    does a queued one recorded before processes were.
+    """
+    if job["state"] not in ("queued", "running"):
+        return False
+    pid = job.get("worker_pid") if job["state"] == "running" else job.get("owner_pid")
+    if pid and not _process_alive(pid):
+        return True
+    if job["state"] == "running" or not pid:
+        return time.time() - job.get("updated_at", 0) > stale_seconds
+    return False
+
+
+def _run_training(job_id, interactions_df, customers_df, products_df, num_of_rewards, base_model_id=None):
+    """Worker-process entry point: train (or warm-start from `base_model_id`) and record progress in the job file."""
+    update_job(job_id, state="running", stage="starting", progress=0.0, worker_pid=os.getpid())
+    report = lambda stage, fraction: update_job(job_id, stage=stage, progress=round(fraction, 2))
+    mode = "full" if base_model_id is None else "warm_start"
+    try:
+        if base_model_id is None:
+            result = train_model(interactions_df, customers_df, products_df, num_of_rewards, progress=report)
+        else:
+            result = update_model(base_model_id, interactions_df, customers_df, products_df, num_of_rewards, progress=report)
+    except Exception as e:
+        log.exception("Training job %s failed", job_id)
+        update_job(job_id, state="failed", error=str(e))
+        inc("training_jobs_total", outcome="failed", mode=mode)
+        flush()
+        return None
+
+    # Held-out metrics, when training ran in evaluation mode
+    extra = {"evaluation": result["evaluation"]} if "evaluation" in result else {}
+    if result.get("refresh"):
+        extra["recommendations_state"] = "refreshing"
+    update_job(job_id, state="succeeded", stage="done", progress=1.0, model_id=result["model_id"], **extra)
+    # Worker processes stay up between jobs, so publish this job's timings now
+    inc("training_jobs_total", outcome="succeeded", mode=mode)
+    flush()
+
+    # The warm-started model is already served; rescoring its remaining users happens after
+    if result.get("refresh"):
+        try:
+            refreshed = refresh_recommendations(result["model_id"], num_of_rewards)
+            update_job(job_id, recommendations_state="complete" if refreshed else "partial")
+        except Exception as e:
+            log.exception("Refreshing recommendations for job %s (model %s) failed", job_id, result["model_id"])
+            update_job(job_id, recommendations_state="partial", refresh_error=str(e))
+        flush()
+    return result["model_id"]
+
+
+def _on_done(job_id, future):
+    # A crashed worker process never gets to record its own failure
+    error = future.exception()
+    if error is not None:
+        update_job(job_id, state="failed", error=str(error))
+
+
+def submit_training(interactions_df, customers_df, products_df, num_of_rewards, base_model_id=None):
+    """
+    Queue a training run and return immediately.
+
+    Args:
+        base_model_id (str): Warm-start from this model, treating the frames as new data only.
+
+    Returns:
+        str: Job id to poll with `get_job`.
+    """
+    job_id = str(uuid.uuid4())
+    update_job(
+        job_id, state="queued", stage="queued", progress=0.0, created_at=time.time(), base_model_id=base_model_id,
+        owner_pid=os.getpid(),
+    )
+    future = _get_executor().submit(
+        _run_training, job_id, interactions_df, customers_df, products_df, num_of_rewards, base_model_id
+    )
+    future.add_done_callback(lambda done: _on_done(job_id, done))
+    return job_id
@@ -0,0 +1,338 @@
+# Columnar construction of LightFM interaction and feature matrices
+# ----- Drop-in replacement for the iterrows() + lightfm.data.Dataset path -----
+
+import sys
+import time
+import itertools
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import sklearn.preprocessing
+from instrumentation import span, timed
+
+
+class ColumnarDataset:
+    """
+    Id and feature mappings with the same layout as `lightfm.data.Dataset`.
+
+    Identity features come first in the feature mappings, followed by the
+    feature names in first-seen order, exactly as `Dataset.fit` assigns them.
+    """
+
+    def __init__(self, user_id_mapping, user_feature_mapping, item_id_mapping, item_feature_mapping):
+        self._user_id_mapping = user_id_mapping
+        self._user_feature_mapping = user_feature_mapping
+        self._item_id_mapping = item_id_mapping
+        self._item_feature_mapping = item_feature_mapping
+
+    def mapping(self):
+        """Return (user id map, user feature map, item id map, item feature map)."""
+        return (
+            self._user_id_mapping,
+            self._user_feature_mapping,
+            self._item_id_mapping,
+            self._item_feature_mapping,
+        )
+
+    def interactions_shape(self):
+        return (len(self._user_id_mapping), len(self._item_id_mapping))
+
+    def user_features_shape(self):
+        return (len(self._user_id_mapping), len(self._user_feature_mapping))
+
+    def item_features_shape(self):
+        return (len(self._item_id_mapping), len(self._item_feature_mapping))
+
+
+def _ordered_mapping(*columns):
+    """Map values to indices in first-seen order, like repeated `dict.setdefault`."""
+    keys = dict.fromkeys(itertools.chain.from_iterable(columns))
+    return {key: index for index, key in enumerate(keys)}
+
+
+def _codes(values, mapping, entity_type):
+    """
+    Translate a column of ids or feature names into internal indices.
+
+    Args:
+        values (array-like): Raw ids or feature names; interned id columns are translated
+            through their dictionary codes without materializing the strings.
+        mapping (dict): Value -> internal index mapping.
+        entity_type (str): Name used in error messages.
+
+    Returns:
+        np.ndarray: int32 internal indices, aligned with `values`.
+    """
+    if isinstance(getattr(values, "dtype", None), pd.CategoricalDtype):
+        values = pd.Categorical(values)
+        # The trailing -1 is what code -1 (missing) indexes
+        category_index = np.fromiter(
+            itertools.chain((mapping.get(key, -1) for key in values.categories), [-1]),
+            dtype=np.int32, count=len(values.categories) + 1,
+        )
+        codes = category_index[values.codes]
+        missing = codes < 0
+        if missing.any():
+            raise ValueError(f"{entity_type} {values[np.argmax(missing)]} not in {entity_type} mappings.")
+        return codes
+
+    categories = [key for key in mapping if not pd.isna(key)]
+    codes = pd.Categorical(values, categories=categories).codes
+    missing = codes < 0
+    if missing.any():
+        first_missing = np.asarray(values)[np.argmax(missing)]
+        raise ValueError(f"{entity_type} {first_missing} not in {entity_type} mappings.")
+    category_index = np.fromiter((mapping[key] for key in categories), dtype=np.int32, count=len(categories))
+    return category_index[codes]
+
+
+def _build_features(num_ids, feature_mapping, row_codes, feature_codes, entity_type):
+    """Build an l1-normalized CSR feature matrix with identity features first."""
+    identity = np.arange(num_ids, dtype=np.int32)
+    rows = np.concatenate([identity] + [row_codes] * len(feature_codes))
+    cols = np.concatenate([identity] + list(feature_codes))
+    data = np.ones(len(rows), dtype=np.float32)
+    features = sp.coo_matrix((data, (rows, cols)), shape=(num_ids, len(feature_mapping))).tocsr()
+    if np.any(features.getnnz(1) == 0):
+        raise ValueError(
+            f"Cannot normalize {entity_type} feature matrix: some rows have zero norm. "
+            "Ensure that features were provided for all entries."
+        )
+    sklearn.preprocessing.normalize(features, norm="l1", copy=False)
+    return features
+
+
+@timed("matrix_build")
+def build_matrices(interactions_df, user_features_df, item_features_df):
+    """
+    Build LightFM interaction and feature matrices directly from DataFrame columns.
+
+    Produces the same mappings and matrices as fitting a `lightfm.data.Dataset`
+    on the same frames and feeding it `iterrows()` generators.
+
+    Args:
+        interactions_df (pd.DataFrame): CustomerID, ProductID, Rating, NumberOfPurchases.
+        user_features_df (pd.DataFrame): CustomerID, Gender, AgeGroup.
+        item_features_df (pd.DataFrame): ProductID, ProductCategory, Price.
+
+    Returns:
+        tuple: (dataset, interactions, weights, user_features, item_features) where
+        dataset is a `ColumnarDataset`, interactions/weights are COO matrices and
+        the feature matrices are CSR.
+    """
+    user_ids = user_features_df["CustomerID"].to_numpy()
+    genders = user_features_df["Gender"].to_numpy()
+    age_groups = user_features_df["AgeGroup"].to_numpy()
+    item_ids = item_features_df["ProductID"].to_numpy()
+    categories = item_features_df["ProductCategory"].to_numpy()
+    prices = item_features_df["Price"].astype(str).to_numpy()
+
+    # Mappings: the equivalent of lightfm's Dataset.fit
+    with span("dataset_fit"):
+        user_id_mapping = _ordered_mapping(user_ids)
+        item_id_mapping = _ordered_mapping(pd.concat([interactions_df["ProductID"], item_features_df["ProductID"]]).unique())
+        user_feature_mapping = _ordered_mapping(user_id_mapping, pd.unique(genders), pd.unique(age_groups))
+        item_feature_mapping = _ordered_mapping(item_id_mapping, pd.unique(categories), pd.unique(prices))
+        dataset = ColumnarDataset(user_id_mapping, user_feature_mapping, item_id_mapping, item_feature_mapping)
+
+    # Interactions: one entry per row, duplicates kept as in Dataset.build_interactions
+    interaction_rows = _codes(interactions_df["CustomerID"], user_id_mapping, "User id")
+    interaction_cols = _codes(interactions_df["ProductID"], item_id_mapping, "Item id")
+    shape = dataset.interactions_shape()
+    interactions = sp.coo_matrix(
+        (np.ones(len(interaction_rows), dtype=np.int32), (interaction_rows, interaction_cols)), shape=shape
+    )
+    weight_values = (interactions_df["Rating"] + interactions_df["NumberOfPurchases"]).to_numpy(dtype=np.float32)
+    weights = sp.coo_matrix((weight_values, (interaction_rows, interaction_cols)), shape=shape)
+
+    user_features = _build_features(
+        len(user_id_mapping),
+        user_feature_mapping,
+        _codes(user_ids, user_id_mapping, "User id"),
+        [_codes(genders, user_feature_mapping, "Feature"), _codes(age_groups, user_feature_mapping, "Feature")],
+        "user",
+    )
+    item_features = _build_features(
+        len(item_id_mapping),
+        item_feature_mapping,
+        _codes(item_ids, item_id_mapping, "Item id"),
+        [_codes(categories, item_feature_mapping, "Feature"), _codes(prices, item_feature_mapping, "Feature")],
+        "item",
+    )
+
+    return dataset, interactions, weights, user_features, item_features
+
+
+def _extend_mapping(mapping, *columns):
+    """Copy `mapping` and append unseen values in first-seen order, like `Dataset.fit_partial`."""
+    extended = dict(mapping)
+    for key in itertools.chain.from_iterable(columns):
+        extended.setdefault(key, len(extended))
+    return extended
+
+
+def _extend_features(previous, id_mapping, feature_mapping, row_ids, feature_columns, entity_type):
+    """
+    Feature matrix for an extended mapping.
+
+    Rows for ids in `row_ids` and for ids added since `previous` was built are
+    rebuilt (identity feature plus the given feature columns); every other row
+    is carried over from `previous` unchanged.
+
+    Args:
+        previous (scipy.sparse.csr_matrix): Feature matrix of the previous mapping.
+        id_mapping (dict): Extended id -> internal index mapping.
+        feature_mapping (dict): Extended feature -> internal index mapping.
+        row_ids (np.ndarray): Ids the feature columns describe.
+        feature_columns (list): Feature values aligned with `row_ids`.
+        entity_type (str): "user" or "item", used in error messages.
+
+    Returns:
+        scipy.sparse.csr_matrix: l1-normalized (num_ids, num_features) feature matrix.
+    """
+    id_name = "User id" if entity_type == "user" else "Item id"
+    num_ids, num_features = len(id_mapping), len(feature_mapping)
+    num_previous = previous.shape[0]
+
+    added_ids = list(itertools.islice(id_mapping, num_previous, None))
+    rebuilt_ids = pd.unique(np.concatenate([np.asarray(row_ids, dtype=object), np.array(added_ids, dtype=object)]))
+    identity_rows = _codes(rebuilt_ids, id_mapping, id_name)
+    identity_cols = _codes(rebuilt_ids, feature_mapping, "Feature")
+    row_codes = _codes(row_ids, id_mapping, id_name)
+
+    rows = np.concatenate([identity_rows] + [row_codes] * len(feature_columns))
+    cols = np.concatenate([identity_cols] + [_codes(values, feature_mapping, "Feature") for values in feature_columns])
+    rebuilt = sp.coo_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(num_ids, num_features)
+    ).tocsr()
+    sklearn.preprocessing.normalize(rebuilt, norm="l1", copy=False)
+
+    keep = np.zeros(num_ids, dtype=np.float32)
+    keep[:num_previous] = 1
+    keep[identity_rows] = 0
+    carried = sp.vstack([
+        sp.csr_matrix((previous.data, previous.indices, previous.indptr), shape=(num_previous, num_features)),
+        sp.csr_matrix((num_ids - num_previous, num_features), dtype=np.float32),
+    ]).tocsr()
+    features = (sp.diags(keep) @ carried + rebuilt).tocsr().astype(np.float32)
+    features.eliminate_zeros()
+    return features
+
+
+@timed("matrix_build")
+def extend_matrices(dataset, user_features, item_features, interactions_df, user_features_df, item_features_df):
+    """
+    Extend a trained dataset with new users, items and features and build matrices for a delta.
+
+    Existing ids and features keep their internal indices; new ones are appended
+    after them, as `lightfm.data.Dataset.fit_partial` would. The interaction
+    matrices only hold the delta rows, ready for `LightFM.fit_partial`.
+
+    Args:
+        dataset (ColumnarDataset): Dataset the previous model was trained with.
+        user_features (scipy.sparse.csr_matrix): User features matrix of the previous model.
+        item_features (scipy.sparse.csr_matrix): Item features matrix of the previous model.
+        interactions_df (pd.DataFrame): New interactions only.
+        user_features_df (pd.DataFrame): Customers whose features are new or changed; must
+            cover every customer in `interactions_df` that the dataset does not know yet.
+        item_features_df (pd.DataFrame): Products whose features are new or changed.
+
+    Returns:
+        tuple: (dataset, interactions, weights, user_features, item_features), laid out
+        like `build_matrices`.
+    """
+    previous_user_ids, previous_user_features, previous_item_ids, previous_item_features = dataset.mapping()
+
+    user_ids = user_features_df["CustomerID"].to_numpy()
+    genders = user_features_df["Gender"].to_numpy()
+    age_groups = user_features_df["AgeGroup"].to_numpy()
+    item_ids = item_features_df["ProductID"].to_numpy()
+    categories = item_features_df["ProductCategory"].to_numpy()
+    prices = item_features_df["Price"].astype(str).to_numpy()
+    # Mappings: the equivalent of lightfm's Dataset.fit
+    with span("dataset_fit"):
+        new_item_ids = pd.concat([interactions_df["ProductID"], item_features_df["ProductID"]]).unique()
+        user_id_mapping = _extend_mapping(previous_user_ids, pd.unique(user_ids))
+        item_id_mapping = _extend_mapping(previous_item_ids, new_item_ids)
+        user_feature_mapping = _extend_mapping(
+            previous_user_features, user_id_mapping, pd.unique(genders), pd.unique(age_groups)
+        )
+        item_feature_mapping = _extend_mapping(
+            previous_item_features, item_id_mapping, pd.unique(categories), pd.unique(prices)
+        )
+        dataset = ColumnarDataset(user_id_mapping, user_feature_mapping, item_id_mapping, item_feature_mapping)
+
+    interaction_rows = _codes(interactions_df["CustomerID"], user_id_mapping, "User id")
+    interaction_cols = _codes(interactions_df["ProductID"], item_id_mapping, "Item id")
+    shape = dataset.interactions_shape()
+    interactions = sp.coo_matrix(
+        (np.ones(len(interaction_rows), dtype=np.int32), (interaction_rows, interaction_cols)), shape=shape
+    )
+    weight_values = (interactions_df["Rating"] + interactions_df["NumberOfPurchases"]).to_numpy(dtype=np.float32)
+    weights = sp.coo_matrix((weight_values, (interaction_rows, interaction_cols)), shape=shape)
+
+    user_features = _extend_features(
+        user_features, user_id_mapping, user_feature_mapping, user_ids, [genders, age_groups], "user"
+    )
+    item_features = _extend_features(
+        item_features, item_id_mapping, item_feature_mapping, item_ids, [categories, prices], "item"
+    )
+
+    return dataset, interactions, weights, user_features, item_features
+
+
+def build_matrices_with_dataset(interactions_df, user_features_df, item_features_df):
+    """Reference implementation: the original `lightfm.data.Dataset` + iterrows() path."""
+    from lightfm.data import Dataset
+
+    dataset = Dataset()
+    dataset.fit(
+        users=user_features_df["CustomerID"],
+        items=pd.concat([interactions_df["ProductID"], item_features_df["ProductID"]]).unique(),
+        user_features=user_features_df["Gender"].unique().tolist() + user_features_df["AgeGroup"].unique().tolist(),
+        item_features=item_features_df["ProductCategory"].unique().tolist() + item_features_df["Price"].astype(str).unique().tolist()
+    )
+    (interactions, weights) = dataset.build_interactions([
+        (row["CustomerID"], row["ProductID"], row["Rating"] + row["NumberOfPurchases"])
+        for _, row in interactions_df.iterrows()
+    ])
+    user_features = dataset.build_user_features([
+        (row["CustomerID"], [row["Gender"], row["AgeGroup"]])
+        for _, row in user_features_df.iterrows()
+    ])
+    item_features = dataset.build_item_features([
+        (row["ProductID"], [row["ProductCategory"], str(row["Price"])])
+        for _, row in item_features_df.iterrows()
+    ])
+    return dataset, interactions, weights, user_features, item_features
+
+
+def _assert_same_output(columnar, reference):
+    """Raise AssertionError unless both builders produced identical mappings and matrices."""
+    assert columnar[0].mapping() == reference[0].mapping(), "mappings differ"
+    for name, left, right in zip(("interactions", "weights", "user_features", "item_features"), columnar[1:], reference[1:]):
+        assert left.shape == right.shape and left.dtype == right.dtype, f"{name} shape/dtype differ"
+        assert (left.tocsr() != right.tocsr()).nnz == 0, f"{name} values differ"
+
+
+if __name__ == "__main__":
+    # Benchmark: python matrix_builder.py [num_interactions ...]
+    from synthetic_data import generate_frames
+
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    for size in sizes:
+        frames = generate_frames(size)
+
+        start = time.perf_counter()
+        reference = build_matrices_with_dataset(*frames)
+        dataset_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        columnar = build_matrices(*frames)
+        columnar_seconds = time.perf_counter() - start
+
+        _assert_same_output(columnar, reference)
+        print(
+            f"{size:>9} interactions: Dataset {dataset_seconds:8.3f}s  "
+            f"columnar {columnar_seconds:8.3f}s  speedup {dataset_seconds / columnar_seconds:6.1f}x"
+        )
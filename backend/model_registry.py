@@ -0,0 +1,229 @@
+# Registry of trained LightFM models
+# ----- Persists models with their id mappings and feature matrices, keeps warm models in an LRU cache -----
+
+import os
+import re
+import time
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+from scoring import get_representations
+from retrieval import build_index, RETRIEVAL_MODES
+from instrumentation import get_logger, span
+
+MODELS_DIR = os.path.join("backend", "models")
+MODEL_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_SIZE", 4))
+# Each process records use of a model on its file at most this often
+MODEL_TOUCH_SECONDS = 60
+
+# model ids come straight from URLs, so only plain file-name characters are allowed
+MODEL_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with a fixed number of entries."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+_cache = LRUCache(MODEL_CACHE_SIZE)
+_touched = {}
+
+log = get_logger(__name__)
+
+
+def model_path(model_id):
+    """Path of the pickled bundle for `model_id`."""
+    if not MODEL_ID_PATTERN.match(str(model_id)):
+        raise FileNotFoundError(f"Invalid model ID {model_id}")
+    return os.path.join(MODELS_DIR, f"lightfm_model_{model_id}.pkl")
+
+
+def _prepare(bundle):
+    """Derive the serving structures (reverse id arrays, embeddings) for a loaded bundle."""
+    user_id_map, _, item_id_map, _ = bundle["mapping"]
+    bundle["user_id_map"] = user_id_map
+    bundle["item_ids"] = np.array(list(item_id_map), dtype=object)
+    bundle["representations"] = get_representations(
+        bundle["model"], bundle["user_features"], bundle["item_features"]
+    )
+    _, _, item_biases, item_embeddings = bundle["representations"]
+    bundle["indexes"] = {"exact": build_index(item_biases, item_embeddings, "exact")}
+    if bundle.get("index") is not None:
+        bundle["indexes"][bundle["index"].mode] = bundle["index"]
+    # Modes whose index is being built in the background, guarded by the lock
+    bundle["index_lock"] = threading.Lock()
+    bundle["index_builds"] = set()
+    return bundle
+
+
+def _build_index(bundle, mode):
+    _, _, item_biases, item_embeddings = bundle["representations"]
+    try:
+        with span("index_build", mode=mode):
+            bundle["indexes"][mode] = build_index(item_biases, item_embeddings, mode)
+        log.info("Built %s index for model %s", mode, bundle.get("model_id"))
+    except Exception:
+        log.exception("Building the %s index for model %s failed", mode, bundle.get("model_id"))
+    finally:
+        with bundle["index_lock"]:
+            bundle["index_builds"].discard(mode)
+
+
+def get_index(bundle, mode="exact"):
+    """
+    Retrieval index of a loaded bundle for `mode`.
+
+    The exact index and the one built at train time are always ready. Another mode
+    is built once, on a background thread, and kept with the cached bundle; until
+    it is ready the exact index answers, so no request waits for clustering.
+
+    Raises:
+        ValueError: If `mode` is not a known retrieval mode.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {', '.join(RETRIEVAL_MODES)}")
+    index = bundle["indexes"].get(mode)
+    if index is not None:
+        return index
+    with bundle["index_lock"]:
+        if mode not in bundle["indexes"] and mode not in bundle["index_builds"]:
+            bundle["index_builds"].add(mode)
+            threading.Thread(
+                target=_build_index, args=(bundle, mode), name=f"index-{mode}-{bundle.get('model_id')}", daemon=True
+            ).start()
+    return bundle["indexes"]["exact"]
+
+
+def save_model(model_id, model, dataset, user_features, item_features, lookups=None, parent_model_id=None, index=None):
+    """
+    Persist a trained model with everything needed to score it later, and cache it.
+
+    Args:
+        model_id (str): Identifier of the model.
+        model (LightFM): Trained model.
+        dataset (ColumnarDataset): Dataset whose `mapping()` produced the training matrices.
+        user_features (scipy.sparse.csr_matrix): User features matrix used in training.
+        item_features (scipy.sparse.csr_matrix): Item features matrix used in training.
+        lookups (dict): Reward lookup tables from `build_reward_lookups`, needed to serve rewards online.
+        parent_model_id (str): Model this one was warm-started from, if any.
+        index (IVFIndex): Approximate retrieval index built at train time, if any.
+
+    Returns:
+        str: Path of the saved bundle.
+    """
+    bundle = {
+        "model_id": model_id,
+        "model": model,
+        "mapping": dataset.mapping(),
+        "user_features": user_features,
+        "item_features": item_features,
+        "lookups": lookups,
+        "parent_model_id": parent_model_id,
+        "index": index if index is not None and index.mode != "exact" else None,
+    }
+    path = model_path(model_id)
+    os.makedirs(MODELS_DIR, exist_ok=True)
+
+    # Write to a temporary file first so readers never load a partial pickle
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    _cache.put(model_id, _prepare(bundle))
+    return path
+
+
+def load_model(model_id):
+    """
+    Return the bundle for `model_id`, from the cache when warm or from disk otherwise.
+
+    Raises:
+        FileNotFoundError: If no model was saved under `model_id`.
+        ValueError: If the file predates the registry and holds only the model.
+    """
+    bundle = _cache.get(model_id)
+    if bundle is not None:
+        touch_model(model_id)
+        return bundle
+
+    path = model_path(model_id)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Model ID {model_id} not found at {path}")
+    touch_model(model_id)
+    with open(path, "rb") as f:
+        bundle = pickle.load(f)
+    if not isinstance(bundle, dict):
+        raise ValueError(f"Model {model_id} was saved without its id mappings and cannot be served")
+
+    bundle = _prepare(bundle)
+    _cache.put(model_id, bundle)
+    return bundle
+
+
+def touch_model(model_id):
+    """
+    Record that `model_id` is in use, by setting its file's modification time to now.
+
+    Every worker sees it, so `training_cache.evict` leaves recently used models
+    alone. Throttled to once per MODEL_TOUCH_SECONDS per process.
+    """
+    now = time.time()
+    if now - _touched.get(model_id, 0) < MODEL_TOUCH_SECONDS:
+        return
+    _touched[model_id] = now
+    try:
+        os.utime(model_path(model_id))
+    except FileNotFoundError:
+        pass
+
+
+def model_last_used(model_id):
+    """When `model_id` was last saved, loaded or served by any process, or 0 if it has no file."""
+    try:
+        return os.path.getmtime(model_path(model_id))
+    except FileNotFoundError:
+        return 0.0
+
+
+def delete_model(model_id):
+    """Remove a saved model from disk and from the cache."""
+    _cache.pop(model_id)
+    path = model_path(model_id)
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,321 @@
+# Held-out evaluation, early stopping and hyperparameter search for LightFM
+# ----- Precision@k and AUC after every fit_partial epoch on a random split; configurations searched in parallel on the CPU budget -----
+#
+# Search from the repository root, on synthetic data or an upload's CSVs:
+#   python backend/model_selection.py --interactions 500000
+#   python backend/model_selection.py --data-dir data --output search.json
+# Check that `evaluate` matches lightfm.evaluation:
+#   python backend/model_selection.py --check
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+import scipy.sparse as sp
+from lightfm import LightFM
+from lightfm.cross_validation import random_train_test_split
+from parallelism import thread_budget, map_shards
+from instrumentation import get_logger, span
+
+# Fraction of interactions held out for evaluation
+TEST_FRACTION = 0.2
+EVAL_K = 10
+# Held-out users ranked after each epoch; ranking scores every item per user, so large runs are sampled
+EVAL_MAX_USERS = int(os.environ.get("EVAL_MAX_USERS", 5000))
+METRICS = ("precision", "auc")
+# Training stops once the metric has not improved by MIN_DELTA for PATIENCE epochs
+MAX_EPOCHS = int(os.environ.get("EVAL_MAX_EPOCHS", 30))
+PATIENCE = 2
+MIN_DELTA = 0.001
+# Grid searched by `search_hyperparameters`
+SEARCH_SPACE = {
+    "no_components": [16, 30, 64],
+    "loss": ["warp", "bpr"],
+    "learning_rate": [0.02, 0.05],
+}
+# A configuration within this fraction of the best score counts as acceptable when picking the cheapest
+ACCEPTABLE_LOSS = 0.05
+
+log = get_logger(__name__)
+
+
+def split_interactions(interactions, test_fraction=TEST_FRACTION, max_users=EVAL_MAX_USERS, seed=0):
+    """
+    Randomly hold out interactions for evaluation.
+
+    Args:
+        interactions (scipy.sparse.coo_matrix): Interactions from `matrix_builder.build_matrices`.
+        test_fraction (float): Fraction of interactions held out.
+        max_users (int): Held-out interactions are kept for at most this many users, sampled at random.
+        seed (int): Seed for the split and the user sample.
+
+    Returns:
+        tuple: (train, test) COO matrices of the same shape; their interactions do not overlap.
+    """
+    rng = np.random.RandomState(seed)
+    # Repeated (user, item) entries are merged first, or one pair could land on both sides of the split
+    interactions = sp.coo_matrix(interactions).tocsr().tocoo()
+    train, test = random_train_test_split(interactions, test_percentage=test_fraction, random_state=rng)
+    test = test.tocsr()
+    users = np.flatnonzero(np.diff(test.indptr))
+    if max_users and len(users) > max_users:
+        keep = np.zeros(test.shape[0], dtype=np.float32)
+        keep[rng.choice(users, size=max_users, replace=False)] = 1
+        test = sp.diags(keep) @ test
+        test.eliminate_zeros()
+    return train, test.tocoo()
+
+
+def evaluate(model, train, test, user_features=None, item_features=None, k=EVAL_K, threads=None):
+    """
+    Mean precision@k and AUC of a model on held-out interactions.
+
+    Interactions in `train` are excluded from the ranking, so known items do not
+    crowd out held-out ones. Items are ranked once for both metrics; the results
+    match `lightfm.evaluation.precision_at_k` and `auc_score`.
+
+    Returns:
+        dict: "precision" and "auc", averaged over users with held-out interactions.
+    """
+    ranks = model.predict_rank(
+        test, train_interactions=train, user_features=user_features, item_features=item_features,
+        num_threads=threads or thread_budget(),
+    ).tocsr()
+    rows = np.repeat(np.arange(ranks.shape[0]), np.diff(ranks.indptr))
+    positives = np.diff(ranks.indptr)
+    users = positives > 0
+
+    hits = np.bincount(rows, weights=ranks.data < k, minlength=ranks.shape[0])
+
+    # A positive at sorted position i within its row has (rank - i) negatives ranked above it
+    order = np.lexsort((ranks.data, rows))
+    above = ranks.data[order] - (np.arange(len(order)) - ranks.indptr[rows[order]])
+    misordered = np.bincount(rows[order], weights=above, minlength=ranks.shape[0])
+    negatives = ranks.shape[1] - positives - sp.csr_matrix(train).getnnz(axis=1)
+    pairs = positives * negatives
+    auc = np.where(pairs > 0, 1 - misordered / np.maximum(pairs, 1), 0.5)
+
+    return {
+        "precision": float(hits[users].mean() / k) if users.any() else 0.0,
+        "auc": float(auc[users].mean()) if users.any() else 0.5,
+    }
+
+
+def fit_with_early_stopping(
+    params, train, test, user_features=None, item_features=None, metric="precision", max_epochs=MAX_EPOCHS,
+    patience=PATIENCE, min_delta=MIN_DELTA, k=EVAL_K, threads=None, seed=0, progress=None, keep_best=False,
+):
+    """
+    Train one epoch at a time with `fit_partial`, evaluating after each, until the metric plateaus.
+
+    Args:
+        params (dict): LightFM constructor arguments, e.g. no_components, loss, learning_rate.
+        train (scipy.sparse.coo_matrix): Training interactions.
+        test (scipy.sparse.coo_matrix): Held-out interactions.
+        metric (str): "precision" or "auc", the metric early stopping watches.
+        max_epochs (int): Upper bound on epochs.
+        patience (int): Epochs without an improvement of `min_delta` before stopping.
+        threads (int): Threads for fitting and ranking; defaults to `thread_budget()`.
+        seed (int): Model random state, so configurations start from comparable initialisations.
+        progress (callable): Optional `progress(epoch, max_epochs)` callback.
+        keep_best (bool): Copy the model at its best epoch into the result's "model",
+            so it can be trained further instead of refitted.
+
+    Returns:
+        dict: params, best_epoch, the metrics at the best epoch, per-epoch "history"
+        (metrics, fit_seconds and eval_seconds), "seconds" of fitting up to the best
+        epoch, "total_seconds" including evaluation, "stopped_early" and, with
+        `keep_best`, "model".
+
+    Raises:
+        ValueError: If `metric` is not one of METRICS.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {', '.join(METRICS)}")
+    threads = threads or thread_budget()
+    model = LightFM(**params, random_state=seed)
+    history, best, best_model, since_best = [], None, None, 0
+    start = time.perf_counter()
+    for epoch in range(1, max_epochs + 1):
+        if progress is not None:
+            progress(epoch, max_epochs)
+        fit_start = time.perf_counter()
+        with span("model_fit", mode="evaluation") as timing:
+            model.fit_partial(train, user_features=user_features, item_features=item_features, epochs=1, num_threads=threads)
+            timing.rows = train.nnz
+        fit_seconds = time.perf_counter() - fit_start
+        with span("evaluation"):
+            scores = evaluate(model, train, test, user_features, item_features, k, threads)
+        history.append({
+            "epoch": epoch, **scores,
+            "fit_seconds": round(fit_seconds, 3), "eval_seconds": round(time.perf_counter() - fit_start - fit_seconds, 3),
+        })
+        log.debug("%s epoch %d: precision@%d %.4f, AUC %.4f", params, epoch, k, scores["precision"], scores["auc"])
+
+        if best is None or scores[metric] > best[metric] + min_delta:
+            best, since_best = history[-1], 0
+            if keep_best:
+                best_model = copy.deepcopy(model)
+        else:
+            since_best += 1
+            if since_best >= patience:
+                break
+
+    result = {
+        "params": params,
+        "best_epoch": best["epoch"],
+        "precision": best["precision"],
+        "auc": best["auc"],
+        "seconds": round(sum(entry["fit_seconds"] for entry in history[:best["epoch"]]), 3),
+        "total_seconds": round(time.perf_counter() - start, 3),
+        "stopped_early": len(history) < max_epochs,
+        "history": history,
+    }
+    if keep_best:
+        result["model"] = best_model
+    return result
+
+
+def search_space(space=SEARCH_SPACE):
+    """Every combination of the values in `space`, as LightFM parameter dicts."""
+    names = list(space)
+    return [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+
+
+def _search_shard(configurations, train, test, user_features, item_features, options, start, stop):
+    return [
+        fit_with_early_stopping(params, train, test, user_features, item_features, **options)
+        for params in configurations[start:stop]
+    ]
+
+
+def search_hyperparameters(
+    interactions, user_features=None, item_features=None, space=SEARCH_SPACE, metric="precision",
+    processes=None, acceptable_loss=ACCEPTABLE_LOSS, seed=0, **options,
+):
+    """
+    Train every configuration in `space` with early stopping on one shared split and rank them.
+
+    Configurations are spread over `processes` forked workers (`parallelism.map_shards`)
+    that split the thread budget between them; each fit uses the remaining threads.
+
+    Args:
+        interactions (scipy.sparse.coo_matrix): All interactions; a split is held out here.
+        space (dict): Parameter name -> values to try.
+        metric (str): "precision" or "auc", used for early stopping and ranking.
+        processes (int): Configurations trained at once; defaults to the thread budget.
+        acceptable_loss (float): Fraction below the best score still accepted when picking the cheapest configuration.
+        seed (int): Seed for the split and every model.
+        **options: Passed to `fit_with_early_stopping`, e.g. max_epochs, patience, k.
+
+    Returns:
+        dict: "results" ordered best first, "best", and "cheapest", the configuration with the
+        fewest training seconds among those scoring within `acceptable_loss` of the best.
+    """
+    configurations = search_space(space)
+    train, test = split_interactions(interactions, seed=seed)
+    processes = max(1, min(processes or thread_budget(), len(configurations)))
+    options = {**options, "metric": metric, "seed": seed, "threads": max(1, thread_budget() // processes)}
+    log.info("Searching %d configurations on %d processes, %d threads each", len(configurations), processes, options["threads"])
+
+    shards = map_shards(
+        _search_shard, (configurations, train, test, user_features, item_features, options), len(configurations),
+        processes=processes, min_rows=1,
+    )
+    results = sorted((result for shard in shards for result in shard), key=lambda result: -result[metric])
+    best = results[0]
+    acceptable = [result for result in results if result[metric] >= best[metric] * (1 - acceptable_loss)]
+    return {
+        "metric": metric,
+        "results": results,
+        "best": best,
+        "cheapest": min(acceptable, key=lambda result: result["seconds"]),
+    }
+
+
+def check_evaluate(interactions, user_features=None, item_features=None, params=None, k=EVAL_K, seed=0):
+    """
+    Compare `evaluate` with `lightfm.evaluation` after one epoch on a held-out split.
+
+    Returns:
+        dict: Each metric from both implementations and the largest absolute difference.
+    """
+    from lightfm.evaluation import precision_at_k, auc_score
+    train, test = split_interactions(interactions, seed=seed)
+    model = LightFM(**(params or search_space()[0]), random_state=seed)
+    model.fit_partial(train, user_features=user_features, item_features=item_features, epochs=1, num_threads=thread_budget())
+    ours = evaluate(model, train, test, user_features, item_features, k)
+    options = {"train_interactions": train, "user_features": user_features, "item_features": item_features, "num_threads": thread_budget()}
+    reference = {
+        "precision": float(precision_at_k(model, test, k=k, **options).mean()),
+        "auc": float(auc_score(model, test, **options).mean()),
+    }
+    return {
+        "evaluate": ours,
+        "lightfm": reference,
+        "max_difference": max(abs(ours[metric] - reference[metric]) for metric in METRICS),
+    }
+
+
+def _format_params(params):
+    return " ".join(f"{name}={value}" for name, value in params.items())
+
+
+def print_report(search):
+    """Print each configuration's score next to its training time, marking the best and the cheapest acceptable."""
+    print(f"{'configuration':48s} {'epochs':>6s} {'prec@k':>8s} {'auc':>7s} {'train s':>8s} {'total s':>8s}")
+    for result in search["results"]:
+        marks = [label for label in ("best", "cheapest") if search[label] is result]
+        print(
+            f"{_format_params(result['params']):48s} {result['best_epoch']:6d} {result['precision']:8.4f} "
+            f"{result['auc']:7.4f} {result['seconds']:8.2f} {result['total_seconds']:8.2f}  {' '.join(marks)}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search LightFM hyperparameters with early stopping on a held-out split.")
+    parser.add_argument("--data-dir", help="Directory with customers.csv, products.csv and interactions.csv")
+    parser.add_argument("--interactions", type=int, default=200_000, help="Synthetic interactions, without --data-dir")
+    parser.add_argument("--metric", choices=METRICS, default="precision")
+    parser.add_argument("--max-epochs", type=int, default=MAX_EPOCHS)
+    parser.add_argument("--processes", type=int, default=None, help="Configurations trained at once (default: thread budget)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results as JSON here")
+    parser.add_argument("--check", action="store_true", help="Only compare `evaluate` with lightfm.evaluation")
+    args = parser.parse_args(argv)
+
+    from matrix_builder import build_matrices
+    if args.data_dir:
+        from ingestion import read_csv_file
+        frames = [
+            read_csv_file(os.path.join(args.data_dir, f"{kind}.csv"), kind) for kind in ("interactions", "customers", "products")
+        ]
+    else:
+        from synthetic_data import generate_frames
+        frames = generate_frames(args.interactions, seed=args.seed)
+    _, interactions, _, user_features, item_features = build_matrices(*frames)
+    print(f"{interactions.nnz} interactions, {interactions.shape[0]} users, {interactions.shape[1]} items")
+
+    if args.check:
+        check = check_evaluate(interactions, user_features, item_features, seed=args.seed)
+        print(f"evaluate {check['evaluate']}, lightfm.evaluation {check['lightfm']}, max difference {check['max_difference']:.2e}")
+        return 0 if check["max_difference"] < 1e-4 else 1
+
+    search = search_hyperparameters(
+        interactions, user_features, item_features, metric=args.metric, processes=args.processes,
+        seed=args.seed, max_epochs=args.max_epochs,
+    )
+    print_report(search)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(search, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
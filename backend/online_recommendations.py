@@ -0,0 +1,113 @@
+# Online rewards for a single customer
+# ----- Serves discounted rewards from a stored model: known customers by id, new customers from Gender/AgeGroup -----
+
+import numpy as np
+import pandas as pd
+from model_registry import load_model, get_index
+from train_lightfm import calculate_discount_percentage, generate_reward_code
+from recommendation_store import open_store
+
+
+def cold_start_representation(bundle, gender=None, age_group=None):
+    """
+    User bias and embedding for a customer not seen in training.
+
+    Training rows are l1-normalized, so a customer described only by their
+    Gender and AgeGroup features is the mean of those feature vectors. Unknown
+    feature values are ignored; with none left the customer gets a zero vector
+    and items rank by their bias alone.
+
+    Returns:
+        tuple: (user_bias, user_embedding) as float32.
+    """
+    model = bundle["model"]
+    user_feature_map = bundle["mapping"][1]
+    feature_ids = [user_feature_map[feature] for feature in (gender, age_group) if feature in user_feature_map]
+    if not feature_ids:
+        return np.float32(0), np.zeros(model.no_components, dtype=np.float32)
+    return (
+        model.user_biases[feature_ids].mean(dtype=np.float32),
+        model.user_embeddings[feature_ids].mean(axis=0, dtype=np.float32),
+    )
+
+
+def recommend_rewards(model_id, customer_id, n, gender=None, age_group=None, mode="exact"):
+    """
+    Score one customer against a stored model and attach discounts and reward codes.
+
+    Args:
+        model_id (str): Identifier of the model.
+        customer_id (str): CustomerID to recommend for.
+        n (int): Number of products to recommend.
+        gender (str): Gender of a customer not seen in training (cold start).
+        age_group (str): AgeGroup of a customer not seen in training (cold start).
+        mode (str): "exact" scores every product, "ivf" only the closest product clusters.
+
+    Returns:
+        dict: cold_start flag, email, scored recommendations and reward strings.
+
+    Raises:
+        KeyError: If the customer is unknown and no cold-start features were given.
+        ValueError: If the model was saved without reward lookups, or `mode` is unknown.
+    """
+    bundle = load_model(model_id)
+    lookups = bundle.get("lookups")
+    if lookups is None:
+        raise ValueError(f"Model {model_id} was saved without reward data and cannot serve rewards")
+
+    user_biases, user_embeddings, _, _ = bundle["representations"]
+    internal_user_id = bundle["user_id_map"].get(customer_id)
+    cold_start = internal_user_id is None
+    if not cold_start:
+        user_bias, user_embedding = user_biases[internal_user_id], user_embeddings[internal_user_id]
+        user_data = lookups["users"][customer_id]
+    elif gender is None and age_group is None:
+        raise KeyError(
+            f"Customer {customer_id} not found in model {model_id}; "
+            "pass gender and age_group for a cold-start recommendation"
+        )
+    else:
+        user_bias, user_embedding = cold_start_representation(bundle, gender, age_group)
+        user_data = {"Gender": gender, "AgeGroup": age_group}
+
+    top_items, scores = get_index(bundle, mode).search(user_embedding[np.newaxis, :], n)
+
+    recommendations = []
+    rewards = []
+    for item, score in zip(top_items[0], scores[0] + user_bias):
+        product_id = bundle["item_ids"][item]
+        entry = {"product_id": product_id, "score": float(score)}
+        product_data = lookups["products"].get(product_id)
+        if product_data is not None:
+            interaction_data = lookups["pairs"].get((customer_id, product_id))
+            discount_percentage = calculate_discount_percentage(user_data, product_data, interaction_data)
+            reward_code = generate_reward_code()
+            entry["discount_percentage"] = discount_percentage
+            entry["reward_code"] = reward_code
+            rewards.append(f"{discount_percentage}% off {product_id} <{reward_code}>")
+        recommendations.append(entry)
+
+    email = lookups["emails"].get(customer_id)
+    return {
+        "cold_start": cold_start,
+        "email": email if email is not None and pd.notna(email) else "No Email Provided",
+        "recommendations": recommendations,
+        "rewards": rewards,
+    }
+
+
+def stored_rewards(model_id, customer_id):
+    """
+    Rewards generated for a customer when the model was trained, i.e. the codes their campaign email carries.
+
+    Returns:
+        dict: email and reward strings.
+
+    Raises:
+        FileNotFoundError: If the model has no recommendation store.
+        KeyError: If the store has no entry for the customer.
+    """
+    entry = open_store(model_id).get(customer_id)
+    if entry is None:
+        raise KeyError(f"Customer {customer_id} has no stored recommendations in model {model_id}")
+    return {"email": entry["email"], "rewards": entry["rewards"]}
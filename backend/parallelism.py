@@ -0,0 +1,188 @@
+# CPU budget for training processes
+# ----- One thread budget per process, shared by LightFM fit, BLAS scoring threads and the reward generation process pool -----
+
+import os
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    # Without threadpoolctl BLAS keeps its own thread count; everything else still follows the budget
+    threadpool_limits = None
+
+# Cores training may use in total. Training workers (jobs.TRAINING_WORKERS) each get an equal share.
+CPU_BUDGET = int(os.environ.get("CPU_BUDGET", os.cpu_count() or 1))
+# Pins the threads of every training process instead of sharing CPU_BUDGET, e.g. for benchmarks
+TRAINING_THREADS = int(os.environ.get("TRAINING_THREADS", 0))
+# Below this many rows per shard, forking workers costs more than it saves
+SHARD_MIN_ROWS = int(os.environ.get("SHARD_MIN_ROWS", 20_000))
+
+_budget = {"threads": TRAINING_THREADS or CPU_BUDGET, "blas_limits": None}
+# Set in threads run by map_blocks, so nested calls stay on their thread
+_worker = threading.local()
+# The shard pool's task is inherited by forked workers through this module, one pool at a time
+_shard_lock = threading.Lock()
+_shard_task = {}
+
+
+def thread_budget():
+    """Threads this process may use for one training run."""
+    return _budget["threads"]
+
+
+def set_thread_budget(threads):
+    """
+    Set this process's thread budget and cap BLAS to it.
+
+    Args:
+        threads (int): Threads for LightFM fit, scoring and reward shards; at least 1.
+    """
+    threads = max(1, int(threads))
+    _budget["threads"] = threads
+    if threadpool_limits is not None:
+        if _budget["blas_limits"] is not None:
+            _budget["blas_limits"].restore_original_limits()
+        _budget["blas_limits"] = threadpool_limits(limits=threads, user_api="blas")
+
+
+def share_budget(workers):
+    """Give this process an equal share of CPU_BUDGET among `workers` training processes, unless TRAINING_THREADS pins it."""
+    set_thread_budget(TRAINING_THREADS or CPU_BUDGET // max(1, workers))
+
+
+@contextmanager
+def blas_threads(threads):
+    """Limit BLAS to `threads` threads for the duration of the block."""
+    if threadpool_limits is None:
+        yield
+        return
+    with threadpool_limits(limits=threads, user_api="blas"):
+        yield
+
+
+def map_blocks(function, num_rows, block_rows, threads=None):
+    """
+    Call `function(start, stop)` for each block of `block_rows` rows, on up to `threads` threads.
+
+    Blocks are meant to write disjoint slices of preallocated outputs, so results
+    do not depend on which thread ran which block. NumPy releases the GIL in
+    matrix multiplies and sorts; BLAS is held to one thread per block meanwhile,
+    so the budget is not multiplied. A single block, a budget of one thread, or a
+    call from inside another map_blocks runs serially with BLAS left as it is.
+
+    Args:
+        function (callable): Called with the start and stop row of each block.
+        num_rows (int): Total rows.
+        block_rows (int): Rows per block.
+        threads (int): Thread count; defaults to `thread_budget()`.
+    """
+    bounds = [(start, min(start + block_rows, num_rows)) for start in range(0, num_rows, max(1, block_rows))]
+    threads = min(threads or thread_budget(), len(bounds))
+    if threads <= 1 or getattr(_worker, "active", False):
+        for start, stop in bounds:
+            function(start, stop)
+        return
+
+    def run(block):
+        _worker.active = True
+        function(*block)
+
+    with blas_threads(1), ThreadPoolExecutor(max_workers=threads) as pool:
+        # list() re-raises the first exception from a block
+        list(pool.map(run, bounds))
+
+
+def shard_bounds(num_rows, shards):
+    """Split `num_rows` rows into `shards` contiguous (start, stop) ranges of near-equal size."""
+    edges = [num_rows * shard // shards for shard in range(shards + 1)]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _run_shard(bounds):
+    function, args = _shard_task["task"]
+    return function(*args, *bounds)
+
+
+def map_shards(function, args, num_rows, processes=None, min_rows=None):
+    """
+    Run `function(*args, start, stop)` over contiguous row ranges in a pool of forked processes.
+
+    `args` reach the workers through fork, so large lookup tables are shared
+    copy-on-write instead of pickled; only each shard's result is sent back.
+    Results come back in range order, so concatenating them gives the same
+    output as a single call over every row. Small inputs, a budget of one, or
+    platforms without fork run in this process.
+
+    Args:
+        function (callable): Module-level function taking `*args, start, stop`.
+        args (tuple): Leading arguments shared by every shard.
+        num_rows (int): Total rows.
+        processes (int): Worker processes; defaults to `thread_budget()`.
+        min_rows (int): Smallest shard worth a process; defaults to SHARD_MIN_ROWS.
+
+    Returns:
+        list: One result per shard, in row order.
+    """
+    processes = min(processes or thread_budget(), num_rows // max(1, min_rows or SHARD_MIN_ROWS))
+    if processes <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return [function(*args, 0, num_rows)]
+    with _shard_lock:
+        _shard_task["task"] = (function, args)
+        try:
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                return pool.map(_run_shard, shard_bounds(num_rows, processes), chunksize=1)
+        finally:
+            _shard_task.clear()
+
+
+if __name__ == "__main__":
+    # Benchmark: one fit epoch, exact scoring and reward generation at increasing thread budgets.
+    # Run from the repository root: python backend/parallelism.py [num_interactions] [max_threads]
+    import sys
+    import time
+    import numpy as np
+    from lightfm import LightFM
+    from synthetic_data import generate_frames
+    from matrix_builder import build_matrices
+    from scoring import get_representations
+    from retrieval import ExactIndex
+    from train_lightfm import MODEL_PARAMS, build_reward_lookups, generate_reward_columns
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    max_threads = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    interactions_df, customers_df, products_df = generate_frames(size)
+    dataset, interactions, _, user_features, item_features = build_matrices(interactions_df, customers_df, products_df)
+    lookups = build_reward_lookups(interactions_df, customers_df, products_df)
+    user_id_map, _, item_id_map, _ = dataset.mapping()
+    user_ids, item_ids = list(user_id_map), np.array(list(item_id_map), dtype=object)
+    print(f"{size} interactions, {len(user_ids)} users, {len(item_ids)} items, {os.cpu_count()} CPUs")
+
+    # Hogwild fits differ run to run, so rewards are always generated from the first run's top items
+    baseline_items, baseline = None, None
+    for threads in sorted({1, 2, 4, max_threads} & set(range(1, max_threads + 1))):
+        set_thread_budget(threads)
+        model = LightFM(**MODEL_PARAMS, random_state=0)
+        start = time.perf_counter()
+        model.fit_partial(interactions, user_features=user_features, item_features=item_features, epochs=1, num_threads=threads)
+        fit_seconds = time.perf_counter() - start
+
+        representations = get_representations(model, user_features, item_features)
+        start = time.perf_counter()
+        top_items, _ = ExactIndex(representations[2], representations[3]).search(representations[1], 3)
+        scoring_seconds = time.perf_counter() - start
+
+        baseline_items = top_items if baseline_items is None else baseline_items
+        start = time.perf_counter()
+        columns = generate_reward_columns(user_ids, baseline_items, item_ids, lookups)
+        reward_seconds = time.perf_counter() - start
+
+        # Rewards must not depend on the number of shards
+        baseline = columns if baseline is None else baseline
+        same = all(np.array_equal(baseline[name], columns[name]) for name in ("products", "discounts"))
+        print(
+            f"threads={threads:<3d} fit {fit_seconds:7.2f}s  scoring {scoring_seconds:7.2f}s  "
+            f"rewards {reward_seconds:7.2f}s  identical_rewards={same and baseline['emails'] == columns['emails']}"
+        )
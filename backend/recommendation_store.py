@@ -0,0 +1,296 @@
+# Columnar on-disk store for per-model recommendations
+# ----- Fixed-width NumPy columns, memory-mapped on read; JSON stays available as a view -----
+
+import os
+import json
+import shutil
+import numpy as np
+from model_registry import LRUCache, MODEL_ID_PATTERN, touch_model
+
+STORE_DIR = os.path.join("backend", "recommendations")
+STORE_VERSION = 1
+STORE_CACHE_SIZE = int(os.environ.get("STORE_CACHE_SIZE", 8))
+# Rows converted to Python objects at a time when streaming entries
+ITER_CHUNK_ROWS = 10_000
+
+NO_EMAIL = "No Email Provided"
+CODE_ALPHABET = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", dtype="S1")
+CODE_LENGTH = 5
+
+COLUMNS = ("customer_ids", "emails", "item_ids", "products", "discounts", "codes")
+
+
+def store_path(model_id):
+    """Directory holding the recommendation store for `model_id`."""
+    return os.path.join(STORE_DIR, f"store_{model_id}")
+
+
+def generate_reward_codes(shape, rng=None):
+    """Random alphanumeric reward codes, as a fixed-width bytes array of `shape`."""
+    rng = rng or np.random.default_rng()
+    letters = CODE_ALPHABET[rng.integers(0, len(CODE_ALPHABET), size=(*np.atleast_1d(shape), CODE_LENGTH))]
+    return np.ascontiguousarray(letters).view(f"S{CODE_LENGTH}").reshape(shape)
+
+
+def _encode(values):
+    """Encode strings as a fixed-width UTF-8 bytes column."""
+    encoded = [str(value).encode("utf-8") for value in values]
+    width = max((len(value) for value in encoded), default=1) or 1
+    return np.array(encoded, dtype=f"S{width}")
+
+
+def write_store(model_id, customer_ids, emails, item_ids, products, discounts, codes):
+    """
+    Write recommendations as a columnar store, replacing any previous one atomically.
+
+    Rows are sorted by customer id so single customers can be found by binary search.
+
+    Args:
+        model_id (str): Identifier of the model.
+        customer_ids (list): CustomerID per row.
+        emails (list): Email per row, "" or None when the customer has none.
+        item_ids (np.ndarray): ProductID for each internal item index.
+        products (np.ndarray): (num_customers, n) internal item indices, -1 where no reward was generated.
+        discounts (np.ndarray): (num_customers, n) discount percentages.
+        codes (np.ndarray): (num_customers, n) reward codes as bytes.
+
+    Returns:
+        str: Path of the store.
+    """
+    customer_column = _encode(customer_ids)
+    order = np.argsort(customer_column, kind="stable")
+    columns = {
+        "customer_ids": customer_column[order],
+        "emails": _encode(["" if email is None or email == NO_EMAIL else email for email in emails])[order],
+        "item_ids": _encode(item_ids),
+        "products": np.asarray(products, dtype=np.int32)[order],
+        "discounts": np.asarray(discounts, dtype=np.uint8)[order],
+        "codes": np.asarray(codes, dtype=f"S{CODE_LENGTH}")[order],
+    }
+
+    path = store_path(model_id)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), column)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"version": STORE_VERSION, "model_id": model_id, "rows": len(order), "n": columns["products"].shape[1]}, f)
+
+    if os.path.exists(path):
+        # Swapped by renames, so readers only miss the store between the two
+        old_path = f"{path}.{os.getpid()}.old"
+        os.replace(path, old_path)
+        os.replace(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.replace(tmp_path, path)
+    _stores.pop(model_id)
+    return path
+
+
+def delete_store(model_id):
+    """Remove the store written for `model_id`, if any."""
+    _stores.pop(model_id)
+    shutil.rmtree(store_path(model_id), ignore_errors=True)
+
+
+class RecommendationStore:
+    """
+    Read-only, memory-mapped view of a model's recommendations.
+
+    Opening a store only maps its files; pages are read as rows are accessed,
+    so lookups and streaming stay cheap however many customers there are.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+            self._inode = os.fstat(f.fileno()).st_ino
+        if self.meta.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported recommendation store version {self.meta.get('version')} at {path}")
+        self.path = path
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        # The product table is small and used by every row
+        self._product_names = [item_id.decode("utf-8") for item_id in self.item_ids.tolist()]
+
+    @classmethod
+    def open(cls, model_id):
+        """
+        Raises:
+            FileNotFoundError: If no store was written for `model_id`.
+        """
+        if not MODEL_ID_PATTERN.match(str(model_id)):
+            raise FileNotFoundError(f"Invalid model ID {model_id}")
+        path = store_path(model_id)
+        if not os.path.exists(os.path.join(path, "meta.json")):
+            raise FileNotFoundError(f"Recommendations for model_id {model_id} not found")
+        return cls(path)
+
+    def __len__(self):
+        return len(self.customer_ids)
+
+    def replaced(self):
+        """Whether the store on disk has been rewritten since this one was opened."""
+        try:
+            return os.stat(os.path.join(self.path, "meta.json")).st_ino != self._inode
+        except FileNotFoundError:
+            return False
+
+    def find(self, customer_id):
+        """Row of `customer_id`, or None if the store has no recommendations for them."""
+        key = str(customer_id).encode("utf-8")
+        if len(key) > self.customer_ids.dtype.itemsize:
+            return None
+        row = int(np.searchsorted(self.customer_ids, key))
+        if row < len(self.customer_ids) and self.customer_ids[row] == key:
+            return row
+        return None
+
+    def rows_of(self, customer_ids):
+        """Row of each customer in `customer_ids`, -1 for those the store has no recommendations for."""
+        keys = _encode(customer_ids)
+        if len(self.customer_ids) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.customer_ids, keys), len(self.customer_ids) - 1)
+        return np.where(self.customer_ids[rows] == keys, rows, -1)
+
+    def _entries(self, rows):
+        """Entries for `rows`, a slice or an array of row numbers."""
+        customer_ids = self.customer_ids[rows].tolist()
+        emails = self.emails[rows].tolist()
+        products = self.products[rows].tolist()
+        discounts = self.discounts[rows].tolist()
+        codes = self.codes[rows].tolist()
+        for customer_id, email, product_row, discount_row, code_row in zip(customer_ids, emails, products, discounts, codes):
+            yield {
+                "customer_id": customer_id.decode("utf-8"),
+                "email": email.decode("utf-8") or NO_EMAIL,
+                "rewards": [
+                    f"{discount}% off {self._product_names[product]} <{code.decode('ascii')}>"
+                    for product, discount, code in zip(product_row, discount_row, code_row)
+                    if product >= 0
+                ],
+            }
+
+    def get(self, customer_id):
+        """
+        Stored recommendation of one customer.
+
+        Returns:
+            dict: customer_id, email and reward strings, or None if the customer is unknown.
+        """
+        row = self.find(customer_id)
+        if row is None:
+            return None
+        return next(self._entries(slice(row, row + 1)))
+
+    def iter_entries(self, with_email=False, chunk_rows=ITER_CHUNK_ROWS):
+        """Yield {"customer_id", "email", "rewards"} per customer, optionally only customers with an email."""
+        for start in range(0, len(self), chunk_rows):
+            stop = min(start + chunk_rows, len(self))
+            if with_email:
+                yield from self._entries(start + np.flatnonzero(self.emails[start:stop] != b""))
+            else:
+                yield from self._entries(slice(start, stop))
+
+    def iter_json(self, chunk_rows=ITER_CHUNK_ROWS):
+        """Stream the legacy recommendations JSON ({CustomerID: {"email", "rewards"}}) as text chunks."""
+        yield "{"
+        for start in range(0, len(self), chunk_rows):
+            parts = [
+                json.dumps(entry["customer_id"]) + ":" + json.dumps({"email": entry["email"], "rewards": entry["rewards"]})
+                for entry in self._entries(slice(start, min(start + chunk_rows, len(self))))
+            ]
+            yield ("," if start else "") + ",".join(parts)
+        yield "}"
+
+    def to_dict(self):
+        """Recommendations keyed by CustomerID, in the shape `train_model` used to write as JSON."""
+        return {
+            entry["customer_id"]: {"email": entry["email"], "rewards": entry["rewards"]}
+            for entry in self.iter_entries()
+        }
+
+
+_stores = LRUCache(STORE_CACHE_SIZE)
+
+
+def open_store(model_id):
+    """
+    Open the store for `model_id`, reusing recently opened ones unless the store was rewritten since.
+
+    Raises:
+        FileNotFoundError: If no store was written for `model_id`.
+    """
+    store = _stores.get(model_id)
+    if store is None or store.replaced():
+        store = RecommendationStore.open(model_id)
+        _stores.put(model_id, store)
+    touch_model(model_id)
+    return store
+
+
+if __name__ == "__main__":
+    # Benchmark: store vs JSON for write, open, single-customer lookup and a full email pass.
+    # Run from the repository root: python backend/recommendation_store.py [num_customers]
+    import sys
+    import time
+    import resource
+    import tempfile
+
+    num_customers = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n, num_items = 5, 1000
+    rng = np.random.default_rng(0)
+    customer_ids = [f"C{i:08d}" for i in rng.permutation(num_customers)]
+    emails = [f"customer{i}@example.com" if i % 10 else "" for i in range(num_customers)]
+    item_ids = np.array([f"P{i:05d}" for i in range(num_items)])
+    products = rng.integers(0, num_items, size=(num_customers, n))
+    discounts = rng.integers(5, 51, size=(num_customers, n))
+    codes = generate_reward_codes((num_customers, n), rng)
+
+    STORE_DIR = tempfile.mkdtemp()
+    start = time.perf_counter()
+    path = write_store("bench", customer_ids, emails, item_ids, products, discounts, codes)
+    write_seconds = time.perf_counter() - start
+    store_bytes = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+    start = time.perf_counter()
+    store = open_store("bench")
+    open_seconds = time.perf_counter() - start
+
+    probes = rng.choice(customer_ids, size=10_000)
+    start = time.perf_counter()
+    for customer_id in probes:
+        store.get(customer_id)
+    lookup_us = (time.perf_counter() - start) / len(probes) * 1e6
+
+    json_path = os.path.join(STORE_DIR, "recommendations.json")
+    start = time.perf_counter()
+    with open(json_path, "w") as f:
+        for chunk in store.iter_json():
+            f.write(chunk)
+    json_seconds = time.perf_counter() - start
+    json_bytes = os.path.getsize(json_path)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    recipients = sum(1 for _ in store.iter_entries(with_email=True))
+    stream_seconds = time.perf_counter() - start
+    stream_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+    start = time.perf_counter()
+    with open(json_path, "r") as f:
+        loaded = json.load(f)
+    json_load_seconds = time.perf_counter() - start
+    json_load_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    assert loaded[probes[0]] == {key: value for key, value in store.get(probes[0]).items() if key != "customer_id"}
+
+    print(f"{num_customers} customers x {n} rewards")
+    print(f"write store        {write_seconds:8.2f}s  {store_bytes / 2**20:8.1f} MB on disk")
+    print(f"write JSON view    {json_seconds:8.2f}s  {json_bytes / 2**20:8.1f} MB on disk")
+    print(f"open store         {open_seconds * 1e3:8.2f}ms")
+    print(f"lookup one         {lookup_us:8.1f}us")
+    print(f"stream {recipients} emails {stream_seconds:6.2f}s  peak RSS +{stream_rss / 1024:.0f} MB")
+    print(f"json.load          {json_load_seconds:8.2f}s  peak RSS +{json_load_rss / 1024:.0f} MB")
+    shutil.rmtree(STORE_DIR)
@@ -0,0 +1,263 @@
+# Top-N retrieval indexes over LightFM item embeddings
+# ----- Exact blocked scoring, or an inverted-file (IVF) index that only scores the closest item clusters -----
+
+import os
+import numpy as np
+from scoring import top_n_from_scores, block_size_for, DEFAULT_BLOCK_BYTES
+from parallelism import map_blocks, thread_budget
+
+RETRIEVAL_MODES = ("exact", "ivf")
+# Mode used when publishing a model's recommendations; online callers pick theirs per request
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "exact")
+
+# Catalogs smaller than this are always searched exactly, clustering them buys nothing
+IVF_MIN_ITEMS = 2048
+KMEANS_ITERATIONS = 15
+# Items sampled per cluster to train the k-means centroids
+KMEANS_SAMPLES_PER_CLUSTER = 64
+# Users searched together in IVF mode; each cluster is scored against every user in the block that probes it.
+# Blocks run in parallel on the thread budget (parallelism.thread_budget).
+IVF_USER_BLOCK = 4096
+
+
+class ExactIndex:
+    """
+    Brute-force index: every user is scored against every item, one block of users at a time.
+
+    Scores are item bias + dot(user, item). The user bias is left out because it
+    does not change a user's ranking; add it to compare with `LightFM.predict`.
+    """
+
+    mode = "exact"
+
+    def __init__(self, item_biases, item_embeddings, block_bytes=DEFAULT_BLOCK_BYTES):
+        self.item_biases = np.asarray(item_biases, dtype=np.float32)
+        self.item_embeddings = np.ascontiguousarray(item_embeddings, dtype=np.float32)
+        self.block_bytes = block_bytes
+
+    def __len__(self):
+        return self.item_embeddings.shape[0]
+
+    def search(self, user_embeddings, n):
+        """
+        Top-N items for each user.
+
+        Args:
+            user_embeddings (np.ndarray): (num_users, no_components) user representations.
+            n (int): Number of items to return per user.
+
+        Returns:
+            tuple: (items, scores), both (num_users, min(n, num_items)), highest score first.
+        """
+        user_embeddings = np.atleast_2d(np.asarray(user_embeddings, dtype=np.float32))
+        n = min(n, len(self))
+        items = np.empty((user_embeddings.shape[0], n), dtype=np.int64)
+        scores = np.empty((user_embeddings.shape[0], n), dtype=np.float32)
+        # Blocks are scored on the thread budget; each thread's share of block_bytes keeps the total bounded
+        threads = thread_budget()
+        block = block_size_for(len(self), self.block_bytes // threads)
+
+        def search_block(start, stop):
+            block_scores = user_embeddings[start:stop] @ self.item_embeddings.T
+            block_scores += self.item_biases[np.newaxis, :]
+            top = top_n_from_scores(block_scores, n)
+            items[start:stop] = top
+            scores[start:stop] = np.take_along_axis(block_scores, top, axis=1)
+
+        map_blocks(search_block, user_embeddings.shape[0], block, threads)
+        return items, scores
+
+
+def _nearest_centroids(points, centroids, block_rows=65536):
+    """Index of the closest centroid (squared L2) for each point, computed in blocks."""
+    half_norms = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty(points.shape[0], dtype=np.int64)
+    for start in range(0, points.shape[0], block_rows):
+        labels[start:start + block_rows] = np.argmax(points[start:start + block_rows] @ centroids.T - half_norms, axis=1)
+    return labels
+
+
+def _kmeans(points, num_clusters, rng, iterations=KMEANS_ITERATIONS):
+    """Lloyd's k-means on a sample of `points`; empty clusters are reseeded from random points."""
+    sample_size = min(points.shape[0], num_clusters * KMEANS_SAMPLES_PER_CLUSTER)
+    sample = points[rng.choice(points.shape[0], size=sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, size=num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = _nearest_centroids(sample, centroids)
+        counts = np.bincount(labels, minlength=num_clusters)
+        sums = np.stack([np.bincount(labels, weights=column, minlength=num_clusters) for column in sample.T], axis=1)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+        centroids[empty] = sample[rng.choice(sample_size, size=int(empty.sum()), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    """
+    Approximate index: items are clustered with k-means and a user only scores the
+    items of the `nprobe` clusters closest to them.
+
+    Ranking by item bias + dot(user, item) is a maximum inner product search. Items
+    are first mapped to x' = [embedding, bias, sqrt(M^2 - |[embedding, bias]|^2)] and
+    users to q' = [embedding, 1, 0], so that the best-scoring items are also the
+    nearest in Euclidean distance and ordinary k-means clusters apply. Candidates are
+    scored exactly, so returned scores match `ExactIndex`; only recall is approximate.
+    """
+
+    mode = "ivf"
+
+    def __init__(self, item_biases, item_embeddings, nlist=None, nprobe=None, seed=0):
+        """
+        Args:
+            item_biases (np.ndarray): Item biases from `model.get_item_representations`.
+            item_embeddings (np.ndarray): Item embeddings from `model.get_item_representations`.
+            nlist (int): Number of clusters. Defaults to 4 * sqrt(num_items).
+            nprobe (int): Clusters searched per user. Defaults to 1/16 of `nlist`.
+            seed (int): Seed for the k-means initialisation.
+        """
+        item_biases = np.asarray(item_biases, dtype=np.float32)
+        item_embeddings = np.asarray(item_embeddings, dtype=np.float32)
+        num_items = item_embeddings.shape[0]
+        self.nlist = int(nlist or min(num_items, max(1, 4 * int(np.sqrt(num_items)))))
+        self.nprobe = int(nprobe or max(1, self.nlist // 16))
+
+        augmented = np.hstack([item_embeddings, item_biases[:, np.newaxis]])
+        squared_norms = np.einsum("ij,ij->i", augmented, augmented)
+        points = np.hstack([augmented, np.sqrt(squared_norms.max() - squared_norms)[:, np.newaxis]])
+
+        centroids = _kmeans(points, self.nlist, np.random.default_rng(seed))
+        labels = _nearest_centroids(points, centroids)
+
+        # Items stored grouped by cluster, so each cluster is one contiguous slice
+        self.item_order = np.argsort(labels, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=self.nlist))])
+        self.item_vectors = np.ascontiguousarray(augmented[self.item_order])
+        # q' . c' - |c'|^2 / 2 ranks centroids by distance to the user; q' has no last coordinate
+        self.centroid_vectors = np.ascontiguousarray(centroids[:, :-1])
+        self.centroid_offsets = 0.5 * np.einsum("ij,ij->i", centroids, centroids)
+        self._exact = ExactIndex(item_biases, item_embeddings)
+
+    def __len__(self):
+        return self.item_vectors.shape[0]
+
+    def search(self, user_embeddings, n, nprobe=None):
+        """
+        Approximate top-N items for each user.
+
+        Users whose probed clusters hold fewer than `n` items fall back to exact search.
+
+        Args:
+            user_embeddings (np.ndarray): (num_users, no_components) user representations.
+            n (int): Number of items to return per user.
+            nprobe (int): Clusters searched per user, overriding the index default.
+
+        Returns:
+            tuple: (items, scores), both (num_users, min(n, num_items)), highest score first.
+        """
+        user_embeddings = np.atleast_2d(np.asarray(user_embeddings, dtype=np.float32))
+        n = min(n, len(self))
+        nprobe = min(int(nprobe or self.nprobe), self.nlist)
+        items = np.empty((user_embeddings.shape[0], n), dtype=np.int64)
+        scores = np.empty((user_embeddings.shape[0], n), dtype=np.float32)
+
+        def search_block(start, stop):
+            items[start:stop], scores[start:stop] = self._search_block(user_embeddings[start:stop], n, nprobe)
+
+        map_blocks(search_block, user_embeddings.shape[0], IVF_USER_BLOCK)
+        return items, scores
+
+    def _search_block(self, user_embeddings, n, nprobe):
+        queries = np.hstack([user_embeddings, np.ones((user_embeddings.shape[0], 1), dtype=np.float32)])
+        centroid_scores = queries @ self.centroid_vectors.T - self.centroid_offsets
+        if nprobe < self.nlist:
+            probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            probes = np.broadcast_to(np.arange(self.nlist), centroid_scores.shape)
+        probed = np.zeros(centroid_scores.shape, dtype=bool)
+        np.put_along_axis(probed, probes, True, axis=1)
+
+        best_items = np.full((queries.shape[0], n), -1, dtype=np.int64)
+        best_scores = np.full((queries.shape[0], n), -np.inf, dtype=np.float32)
+        for cluster in np.flatnonzero(probed.any(axis=0)):
+            begin, end = self.offsets[cluster], self.offsets[cluster + 1]
+            if begin == end:
+                continue
+            users = np.flatnonzero(probed[:, cluster])
+            # Merge this cluster's items into the running top-N of every user that probes it
+            merged_scores = np.hstack([best_scores[users], queries[users] @ self.item_vectors[begin:end].T])
+            merged_items = np.hstack([
+                best_items[users], np.broadcast_to(np.arange(begin, end), (len(users), end - begin))
+            ])
+            top = top_n_from_scores(merged_scores, n)
+            best_scores[users] = np.take_along_axis(merged_scores, top, axis=1)
+            best_items[users] = np.take_along_axis(merged_items, top, axis=1)
+
+        short = np.flatnonzero((best_items < 0).any(axis=1))
+        found = best_items >= 0
+        best_items[found] = self.item_order[best_items[found]]
+        if len(short):
+            best_items[short], best_scores[short] = self._exact.search(user_embeddings[short], n)
+        return best_items, best_scores
+
+
+def build_index(item_biases, item_embeddings, mode="exact", **options):
+    """
+    Build a retrieval index over item representations.
+
+    Args:
+        item_biases (np.ndarray): Item biases from `model.get_item_representations`.
+        item_embeddings (np.ndarray): Item embeddings from `model.get_item_representations`.
+        mode (str): "exact" or "ivf". Catalogs under IVF_MIN_ITEMS items always get an exact index.
+        **options: Passed to the index class, e.g. nlist / nprobe for IVF.
+
+    Raises:
+        ValueError: If `mode` is not one of RETRIEVAL_MODES.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {', '.join(RETRIEVAL_MODES)}")
+    if mode == "ivf" and len(item_biases) >= IVF_MIN_ITEMS:
+        return IVFIndex(item_biases, item_embeddings, **options)
+    return ExactIndex(item_biases, item_embeddings)
+
+
+def recall_at_n(approximate_items, exact_items):
+    """Mean fraction of each user's exact top-N that the approximate top-N also returned."""
+    hits = [len(np.intersect1d(approx, exact)) for approx, exact in zip(approximate_items, exact_items)]
+    return float(np.mean(hits)) / exact_items.shape[1]
+
+
+if __name__ == "__main__":
+    # Benchmark: recall@N and throughput of IVF against exact search on synthetic embeddings.
+    # Run from the repository root: python backend/retrieval.py [num_items] [num_users]
+    import sys
+    import time
+
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    num_users = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+    no_components, n = 30, 10
+    rng = np.random.default_rng(0)
+    # Clustered embeddings, as trained item factors are: products of a category sit together
+    topics = rng.normal(size=(1000, no_components)).astype(np.float32)
+    item_embeddings = topics[rng.integers(0, len(topics), num_items)] + rng.normal(size=(num_items, no_components))
+    item_biases = 0.5 * rng.normal(size=num_items)
+    user_embeddings = topics[rng.integers(0, len(topics), num_users)] + rng.normal(size=(num_users, no_components))
+    user_embeddings = user_embeddings.astype(np.float32)
+
+    exact = ExactIndex(item_biases, item_embeddings)
+    start = time.perf_counter()
+    exact_items, _ = exact.search(user_embeddings, n)
+    exact_seconds = time.perf_counter() - start
+    print(f"{num_items} items, {num_users} users, top {n}")
+    print(f"exact            {exact_seconds:7.2f}s  {num_users / exact_seconds:9.0f} users/s")
+
+    start = time.perf_counter()
+    ivf = IVFIndex(item_biases, item_embeddings)
+    print(f"ivf build        {time.perf_counter() - start:7.2f}s  nlist={ivf.nlist}")
+    for nprobe in sorted({max(1, ivf.nlist // 64), max(1, ivf.nlist // 32), ivf.nprobe, ivf.nlist // 8}):
+        start = time.perf_counter()
+        ivf_items, _ = ivf.search(user_embeddings, n, nprobe=nprobe)
+        seconds = time.perf_counter() - start
+        print(
+            f"ivf nprobe={nprobe:<5d} {seconds:7.2f}s  {num_users / seconds:9.0f} users/s  "
+            f"recall@{n}={recall_at_n(ivf_items, exact_items):.3f}"
+        )
@@ -0,0 +1,239 @@
+# Upload schemas for the three CSV types
+# ----- Resolves headers from the first line, then parses only known columns with explicit dtypes in one read_csv pass -----
+
+import io
+import re
+import csv
+import difflib
+import numpy as np
+import pandas as pd
+from headers import CustomerHeaders, ProductHeaders, InteractionHeaders
+from instrumentation import span
+
+NO_EMAIL = "No Email Provided"
+# Minimum difflib similarity for a header that matches no alias exactly
+FUZZY_CUTOFF = 0.85
+
+
+class ColumnSpec:
+    """One known column: canonical name, parse dtype, header aliases and how to fill it when missing."""
+
+    def __init__(self, name, dtype, aliases=(), default=None, required=False):
+        self.name = name
+        self.dtype = dtype
+        self.aliases = aliases
+        self.default = default
+        self.required = required
+
+    @property
+    def numeric(self):
+        return self.dtype not in (str, "category")
+
+
+# dtypes: ids and emails stay strings, low-cardinality labels are categoricals and
+# numbers are parsed straight into 32-bit columns. Purchases stay float32 like the
+# other numbers, so fractional counts (e.g. 2.5 units) are kept rather than truncated.
+SCHEMAS = {
+    "customers": [
+        ColumnSpec(CustomerHeaders.CUSTOMER_ID, str, ("customer_id", "customer", "user_id", "userid", "user"), required=True),
+        ColumnSpec(CustomerHeaders.GENDER, "category", ("gender", "sex")),
+        ColumnSpec(CustomerHeaders.AGE_GROUP, "category", ("age_group", "agegroup", "age_range", "age_band", "age")),
+    ],
+    "products": [
+        ColumnSpec(ProductHeaders.PRODUCT_ID, str, ("product_id", "product", "item_id", "itemid", "item", "sku"), required=True),
+        ColumnSpec(ProductHeaders.CATEGORY, "category", ("product_category", "category", "productcategory")),
+        ColumnSpec(ProductHeaders.PRICE, np.float64, ("price", "unit_price", "unitprice", "cost")),
+    ],
+    "interactions": [
+        ColumnSpec(InteractionHeaders.CUSTOMER_ID, str, ("customer_id", "customer", "user_id", "userid", "user"), required=True),
+        ColumnSpec(InteractionHeaders.PRODUCT_ID, str, ("product_id", "product", "item_id", "itemid", "item", "sku"), required=True),
+        ColumnSpec(InteractionHeaders.RATINGS, np.float32, ("rating", "ratings", "score", "stars"), default=4),
+        ColumnSpec(
+            InteractionHeaders.PURCHASES, np.float32,
+            ("number_of_purchases", "purchases", "purchase", "purchase_count", "purchasecount", "quantity", "qty"),
+            default=1,
+        ),
+        ColumnSpec(InteractionHeaders.EMAIL, str, ("email", "e_mail", "email_address", "emailaddress"), default=NO_EMAIL),
+    ],
+}
+
+
+def normalize_header(header):
+    """Lower-case a header and drop everything but letters and digits: ' Customer_ID ' -> 'customerid'."""
+    return re.sub(r"[^0-9a-z]", "", str(header).lower())
+
+
+def _alias_table(kind):
+    table = {}
+    for spec in SCHEMAS[kind]:
+        for alias in (spec.name, *spec.aliases):
+            table.setdefault(normalize_header(alias), spec)
+    return table
+
+
+_ALIASES = {kind: _alias_table(kind) for kind in SCHEMAS}
+
+
+def resolve_headers(header, kind):
+    """
+    Map the raw header row of a `kind` CSV to the schema's columns.
+
+    Headers are matched on their normalized form against each column's aliases,
+    falling back to the closest alias above FUZZY_CUTOFF. The first column that
+    resolves to a name wins; later duplicates and unknown columns are ignored.
+
+    Args:
+        header (list): Raw header cells in file order.
+        kind (str): "customers", "products" or "interactions".
+
+    Returns:
+        tuple: (positions, specs, ignored) where positions are the file columns
+        to parse, specs their ColumnSpec in the same order, and ignored the raw
+        headers that were skipped.
+    """
+    aliases = _ALIASES[kind]
+    positions, specs, ignored, seen = [], [], [], set()
+    for position, raw in enumerate(header):
+        key = normalize_header(raw)
+        spec = aliases.get(key)
+        if spec is None and key:
+            close = difflib.get_close_matches(key, aliases, n=1, cutoff=FUZZY_CUTOFF)
+            spec = aliases[close[0]] if close else None
+        if spec is None or spec.name in seen:
+            ignored.append(str(raw))
+            continue
+        seen.add(spec.name)
+        positions.append(position)
+        specs.append(spec)
+    return positions, specs, ignored
+
+
+def parse_header_line(line):
+    """Split the first line of a CSV into header cells, honouring quotes."""
+    return next(csv.reader([line.rstrip("\r\n")]), [])
+
+
+def read_options(header, kind, debug_info=None, numeric_as_text=False):
+    """
+    `pd.read_csv` keyword arguments that parse only the schema's columns, already renamed, with their dtypes.
+
+    With `numeric_as_text` numeric columns are read as strings, for `coerce_numeric`.
+
+    Raises:
+        ValueError: If a required column has no matching header.
+    """
+    positions, specs, ignored = resolve_headers(header, kind)
+    found = {spec.name for spec in specs}
+    missing = [spec.name for spec in SCHEMAS[kind] if spec.required and spec.name not in found]
+    if missing:
+        raise ValueError(f"Missing required columns: {missing}")
+
+    renamed = {str(header[position]): spec.name for position, spec in zip(positions, specs)}
+    if debug_info is not None:
+        changed = {raw: name for raw, name in renamed.items() if raw != name}
+        if changed:
+            debug_info[f"{kind}_headers_mapped"] = changed
+        if ignored:
+            debug_info[f"{kind}_columns_ignored"] = ignored
+
+    # Unique placeholder names let duplicate or blank headers through the parser untouched
+    names = [f"__ignored_{position}" for position in range(len(header))]
+    for position, spec in zip(positions, specs):
+        names[position] = spec.name
+    return {
+        "header": 0,
+        "names": names,
+        "usecols": [spec.name for spec in specs],
+        "dtype": {spec.name: object if numeric_as_text and spec.numeric else spec.dtype for spec in specs},
+    }
+
+
+def finalize(df, kind, debug_info=None):
+    """
+    Fill and add defaulted columns.
+
+    Columns that are entirely empty are treated as missing, as before the schema layer.
+    """
+    created = []
+    for spec in SCHEMAS[kind]:
+        if spec.name in df.columns and df[spec.name].isna().all() and spec.default is None:
+            df = df.drop(columns=spec.name)
+        if spec.default is not None:
+            if spec.name not in df.columns:
+                df[spec.name] = pd.Series(spec.default, index=df.index, dtype=spec.dtype if spec.numeric else object)
+                created.append(f"'{spec.name}' (default: {spec.default})")
+            elif df[spec.name].hasnans:
+                df[spec.name] = df[spec.name].fillna(spec.default)
+    if created and debug_info is not None:
+        debug_info["columns_auto_created"] = f"Auto-created columns: {', '.join(created)}"
+    return df
+
+
+def coerce_numeric(df, kind):
+    """Parse numeric columns that were read as text, turning unparseable values into NaN."""
+    for spec in SCHEMAS[kind]:
+        if spec.numeric and spec.name in df.columns and df[spec.name].dtype == object:
+            df[spec.name] = pd.to_numeric(df[spec.name], errors="coerce").astype(spec.dtype)
+    return df
+
+
+def read_csv_text(text, kind, debug_info=None):
+    """
+    Parse CSV text (the JSON upload path) with the schema for `kind`.
+
+    Numeric columns are parsed directly into their dtypes. Only if a value does
+    not parse is the text read again with them as strings and coerced, so stray
+    text becomes NaN and is filled with the column default.
+
+    Raises:
+        ValueError: If a required column has no matching header.
+    """
+    with span("parse", kind=kind) as timing:
+        end = text.find("\n")
+        header = parse_header_line(text if end < 0 else text[:end])
+        options = read_options(header, kind, debug_info)
+        try:
+            df = pd.read_csv(io.StringIO(text), **options)
+        except ValueError:
+            df = coerce_numeric(pd.read_csv(io.StringIO(text), **read_options(header, kind, numeric_as_text=True)), kind)
+        df = finalize(df, kind, debug_info)
+        timing.rows = len(df)
+    return df
+
+
+if __name__ == "__main__":
+    # Benchmark: the schema read against reading every column with inferred dtypes, on a wide interactions export.
+    # Run from the repository root: python backend/schema.py [num_rows] [extra_columns]
+    import sys
+    import time
+
+    num_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    extra_columns = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    rng = np.random.default_rng(0)
+    columns = {
+        "customer_id": [f"C{i:07d}" for i in rng.integers(0, num_rows // 5, num_rows)],
+        "Product ID": [f"P{i:05d}" for i in rng.integers(0, 5000, num_rows)],
+        "rating": rng.integers(1, 6, num_rows),
+        "Purchases": rng.integers(1, 5, num_rows),
+        "email": [f"user{i}@example.com" for i in rng.integers(0, num_rows // 5, num_rows)],
+    }
+    for i in range(extra_columns):
+        columns[f"export_field_{i}"] = rng.choice(["north", "south", "east", "west"], num_rows) if i % 2 else rng.random(num_rows)
+    text = pd.DataFrame(columns).to_csv(index=False)
+    print(f"{num_rows} rows, {len(columns)} columns, {len(text) / 2**20:.0f} MB of CSV text")
+
+    start = time.perf_counter()
+    inferred = pd.read_csv(io.StringIO(text))
+    inferred.columns = inferred.columns.str.strip()
+    for col in ("rating", "Purchases"):
+        inferred[col] = pd.to_numeric(inferred[col], errors="coerce")
+    inferred_seconds = time.perf_counter() - start
+    inferred_mb = inferred.memory_usage(deep=True).sum() / 2**20
+    del inferred
+
+    start = time.perf_counter()
+    parsed = read_csv_text(text, "interactions")
+    schema_seconds = time.perf_counter() - start
+    schema_mb = parsed.memory_usage(deep=True).sum() / 2**20
+    print(f"all columns, inferred dtypes  {inferred_seconds:6.2f}s  {inferred_mb:8.1f} MB")
+    print(f"schema read                   {schema_seconds:6.2f}s  {schema_mb:8.1f} MB  {dict(parsed.dtypes.astype(str))}")
@@ -0,0 +1,123 @@
+# Synthetic customers/products/interactions for benchmarks
+# ----- Same columns and value shapes as data/*_compressed.csv, at any size -----
+
+import os
+import numpy as np
+import pandas as pd
+
+GENDERS = ["Male", "Female"]
+AGE_GROUPS = ["18-24", "25-34", "35-44", "45-60", "Young Adult", "Senior"]
+CATEGORIES = ["Health & Personal Care", "Electronics", "Fashion", "Beauty"]
+SAMPLE_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def generate_frames(num_interactions, num_users=None, num_items=None, email_rate=0.3, seed=0):
+    """
+    Generate synthetic interactions, customers and products DataFrames.
+
+    Args:
+        num_interactions (int): Number of interaction rows.
+        num_users (int): Number of customers, defaults to num_interactions / 10.
+        num_items (int): Number of products, defaults to num_interactions / 50.
+        email_rate (float): Fraction of customers with an email address.
+        seed (int): Random seed.
+
+    Returns:
+        tuple: (interactions_df, customers_df, products_df)
+    """
+    rng = np.random.default_rng(seed)
+    num_users = num_users or max(10, num_interactions // 10)
+    num_items = num_items or max(10, num_interactions // 50)
+
+    user_ids = np.array([f"U{i:027d}" for i in range(num_users)], dtype=object)
+    item_ids = np.array([f"B{i:09d}" for i in range(num_items)], dtype=object)
+    emails = np.where(
+        rng.random(num_users) < email_rate,
+        np.array([f"customer{i}@example.com" for i in range(num_users)], dtype=object),
+        "No Email Provided",
+    )
+
+    customers = pd.DataFrame({
+        "CustomerID": user_ids,
+        "Gender": rng.choice(GENDERS, num_users),
+        "AgeGroup": rng.choice(AGE_GROUPS, num_users),
+    })
+    products = pd.DataFrame({
+        "ProductID": item_ids,
+        "ProductCategory": rng.choice(CATEGORIES, num_items),
+        "Price": np.round(rng.uniform(1, 300, num_items), 2),
+    })
+
+    # Skewed item popularity, like real purchase data
+    item_weights = 1.0 / np.arange(1, num_items + 1)
+    item_weights /= item_weights.sum()
+    interaction_users = rng.integers(0, num_users, num_interactions)
+    interactions = pd.DataFrame({
+        "CustomerID": user_ids[interaction_users],
+        "ProductID": item_ids[rng.choice(num_items, num_interactions, p=item_weights)],
+        "Rating": rng.choice([1.0, 2.0, 3.0, 4.0, 5.0], num_interactions, p=[0.15, 0.05, 0.07, 0.13, 0.6]),
+        "NumberOfPurchases": rng.integers(1, 8, num_interactions),
+        "Email": emails[interaction_users],
+    })
+    return interactions, customers, products
+
+
+def _resample_curve(counts, size):
+    """Stretch a descending count curve (e.g. interactions per product) to `size` points, as weights."""
+    counts = np.sort(np.asarray(counts, dtype=np.float64))[::-1]
+    weights = np.interp(np.linspace(0, len(counts) - 1, size), np.arange(len(counts)), counts)
+    return weights / weights.sum()
+
+
+def scale_sample_data(num_interactions, num_users=None, num_items=None, email_rate=0.3, seed=0, data_dir=SAMPLE_DATA_DIR):
+    """
+    Scale the sample CSVs in data/ (*_compressed.csv) up to any size.
+
+    Customer demographics, product categories and prices, and rating/purchase
+    pairs are resampled from the sample rows. Per-customer activity and product
+    popularity follow the sample's skew, stretched over the new id ranges. The
+    sample has almost no emails, so `email_rate` sets how many customers have one.
+
+    Args:
+        num_interactions (int): Number of interaction rows.
+        num_users (int): Number of customers, defaults to the sample's interactions per customer.
+        num_items (int): Number of products, defaults to the sample's interactions per product.
+        email_rate (float): Fraction of customers with an email address.
+        seed (int): Random seed.
+        data_dir (str): Directory holding the sample CSVs.
+
+    Returns:
+        tuple: (interactions_df, customers_df, products_df)
+    """
+    rng = np.random.default_rng(seed)
+    sample_users = pd.read_csv(os.path.join(data_dir, "user_compressed.csv"))
+    sample_items = pd.read_csv(os.path.join(data_dir, "item_compressed.csv"))
+    sample_interactions = pd.read_csv(os.path.join(data_dir, "interactions_compressed.csv"))
+    num_users = num_users or max(10, round(num_interactions * len(sample_users) / len(sample_interactions)))
+    num_items = num_items or max(10, round(num_interactions * len(sample_items) / len(sample_interactions)))
+
+    user_ids = np.array([f"U{i:027d}" for i in range(num_users)], dtype=object)
+    item_ids = np.array([f"B{i:09d}" for i in range(num_items)], dtype=object)
+    emails = np.where(
+        rng.random(num_users) < email_rate,
+        np.array([f"customer{i}@example.com" for i in range(num_users)], dtype=object),
+        "No Email Provided",
+    )
+
+    user_rows = sample_users.iloc[rng.integers(0, len(sample_users), num_users)].reset_index(drop=True)
+    customers = pd.DataFrame({"CustomerID": user_ids, "Gender": user_rows["Gender"], "AgeGroup": user_rows["AgeGroup"]})
+    item_rows = sample_items.iloc[rng.integers(0, len(sample_items), num_items)].reset_index(drop=True)
+    products = pd.DataFrame({"ProductID": item_ids, "ProductCategory": item_rows["ProductCategory"], "Price": item_rows["Price"]})
+
+    user_weights = _resample_curve(sample_interactions["CustomerID"].value_counts(), num_users)
+    item_weights = _resample_curve(sample_interactions["ProductID"].value_counts(), num_items)
+    interaction_users = rng.choice(num_users, num_interactions, p=user_weights)
+    interaction_rows = sample_interactions.iloc[rng.integers(0, len(sample_interactions), num_interactions)]
+    interactions = pd.DataFrame({
+        "CustomerID": user_ids[interaction_users],
+        "ProductID": item_ids[rng.choice(num_items, num_interactions, p=item_weights)],
+        "Rating": interaction_rows["Rating"].to_numpy(),
+        "NumberOfPurchases": interaction_rows["NumberOfPurchases"].to_numpy(),
+        "Email": emails[interaction_users],
+    })
+    return interactions, customers, products
@@ -5,14 +5,44 @@ from flask import Flask, request, jsonify, send_file
 import pandas as pd
 import numpy as np
 from lightfm import LightFM
-from lightfm.data import Dataset
-from lightfm.cross_validation import random_train_test_split
-import pickle
 import os
+import copy
+import logging
 import uuid
 import json
 import random
 import string
+from scoring import get_representations
+from retrieval import build_index, RETRIEVAL_MODE
+from matrix_builder import ColumnarDataset, build_matrices, extend_matrices
+from discount_engine import compute_discounts
+from model_registry import save_model, load_model
+from email_ledger import ledger_path
+from recommendation_store import open_store, write_store, generate_reward_codes
+from instrumentation import get_logger, span
+from parallelism import thread_budget, map_shards
+from model_selection import split_interactions, fit_with_early_stopping
+
+# LightFM settings for a full training run
+MODEL_PARAMS = {"no_components": 30, "loss": "warp"}
+TRAINING_EPOCHS = 10
+# Pick the epoch count by early stopping on a held-out split (model_selection) instead of TRAINING_EPOCHS
+TRAINING_EVALUATION = os.environ.get("TRAINING_EVALUATION", "").lower() in ("1", "true", "yes")
+# Epochs over every interaction, held-out ones included, that continue the evaluated model
+EVALUATION_FINAL_EPOCHS = int(os.environ.get("EVALUATION_FINAL_EPOCHS", 1))
+# Epochs run over the new interactions when warm-starting from a previous model
+WARM_START_EPOCHS = int(os.environ.get("WARM_START_EPOCHS", 10))
+# Rescore every user before publishing a warm-started model, instead of afterwards in refresh_recommendations
+WARM_START_RESCORE_ALL = os.environ.get("WARM_START_RESCORE_ALL", "").lower() in ("1", "true", "yes")
+
+log = get_logger(__name__)
+
+def training_hyperparameters(num_of_rewards):
+    """Every setting that changes what `train_model` produces for the same data."""
+    return {
+        **MODEL_PARAMS, "epochs": f"early_stopping+{EVALUATION_FINAL_EPOCHS}" if TRAINING_EVALUATION else TRAINING_EPOCHS,
+        "num_of_rewards": num_of_rewards, "retrieval_mode": RETRIEVAL_MODE,
+    }
 
 def calculate_discount_percentage(user_data, product_data, interaction_data):
     """
@@ -21,7 +51,8 @@ def calculate_discount_percentage(user_data, product_data, interaction_data):
     Args:
         user_data (pd.Series): User data containing AgeGroup and Gender.
         product_data (pd.Series): Product data containing ProductCategory and Price.
-        interaction_data (pd.DataFrame): Interaction data containing Rating and Purchases.
+        interaction_data (dict): First recorded Rating and NumberOfPurchases for the
+            user-product pair, or None if the user never interacted with the product.
     
     Returns:
         float: Discount percentage (0-100).
@@ -43,9 +74,9 @@ def calculate_discount_percentage(user_data, product_data, interaction_data):
         discount += 10  # Higher discount for expensive products
 
     # Interaction-based discount
-    if not interaction_data.empty:
-        rating = interaction_data["Rating"].iloc[0]
-        purchases = interaction_data["NumberOfPurchases"].iloc[0]
+    if interaction_data:
+        rating = interaction_data["Rating"]
+        purchases = interaction_data["NumberOfPurchases"]
         if rating >= 4:
             discount += 5  # Reward high ratings
         if purchases > 2:
@@ -56,145 +87,483 @@ def calculate_discount_percentage(user_data, product_data, interaction_data):
 
     return discount
 
+def build_reward_lookups(interactions_df, user_features_df, item_features_df):
+    """
+    Build the lookup tables used by reward generation, once per training run.
+
+    Each table keeps the first matching row, mirroring the `.iloc[0]` lookups
+    it replaces.
+
+    Args:
+        interactions_df (pd.DataFrame): Interaction data with CustomerID, ProductID, Email, Rating and NumberOfPurchases.
+        user_features_df (pd.DataFrame): User data with CustomerID, AgeGroup and Gender.
+        item_features_df (pd.DataFrame): Product data with ProductID, ProductCategory and Price.
+
+    Returns:
+        dict: "users" (CustomerID -> user row), "products" (ProductID -> product row),
+        "emails" (CustomerID -> first email) and "pairs" ((CustomerID, ProductID) -> interaction stats).
+    """
+    users = user_features_df.drop_duplicates("CustomerID").set_index("CustomerID", drop=False)
+    products = item_features_df.drop_duplicates("ProductID").set_index("ProductID", drop=False)
+    first_user_rows = interactions_df.drop_duplicates("CustomerID")
+    first_pair_rows = interactions_df.drop_duplicates(["CustomerID", "ProductID"])
+
+    return {
+        "users": users.to_dict("index"),
+        "products": products.to_dict("index"),
+        "emails": dict(zip(first_user_rows["CustomerID"], first_user_rows["Email"])),
+        "pairs": {
+            (customer_id, product_id): {"Rating": rating, "NumberOfPurchases": purchases}
+            for customer_id, product_id, rating, purchases in zip(
+                first_pair_rows["CustomerID"],
+                first_pair_rows["ProductID"],
+                first_pair_rows["Rating"],
+                first_pair_rows["NumberOfPurchases"],
+            )
+        },
+    }
+
+def merge_reward_lookups(previous, delta):
+    """
+    Combine the reward lookups of a previous model with those of new data.
+
+    User and product rows from the new data replace older ones; emails and
+    interaction stats keep the first recorded value, as a full rebuild would.
+    """
+    return {
+        "users": {**previous["users"], **delta["users"]},
+        "products": {**previous["products"], **delta["products"]},
+        "emails": {**delta["emails"], **previous["emails"]},
+        "pairs": {**delta["pairs"], **previous["pairs"]},
+    }
+
 def generate_reward_code():
     """Generate a random 5-character alphanumeric reward code."""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
 
-def train_model(interactions_df, user_features_df, item_features_df, num_of_rewards):
-    print("Starting model training...")
+def generate_reward_columns(user_ids, top_items, item_ids, lookups):
+    """
+    Turn top-N recommendations into reward columns for a batch of users.
+
+    Discounts are computed in one pass per shard by the discount engine. Large
+    batches are split by user range across a process pool (`parallelism.map_shards`)
+    and the shards concatenated in order, so the columns match a single pass.
+
+    Args:
+        user_ids (list): CustomerIDs, one per row of `top_items`.
+        top_items (np.ndarray): (num_users, n) internal item indices.
+        item_ids (np.ndarray): ProductID for each internal item index.
+        lookups (dict): Lookup tables from `build_reward_lookups`.
+
+    Returns:
+        dict: "emails" (one per user, "" if none), and (num_users, n) arrays "products"
+        (internal item index, -1 where the product is missing from product data),
+        "discounts" and "codes", ready for `recommendation_store.write_store`.
+    """
+    shards = map_shards(_reward_shard, (user_ids, top_items, item_ids, lookups), len(user_ids))
+    skipped = sum(shard["skipped"] for shard in shards)
+    if skipped:
+        log.warning("Skipping %d recommendations for ProductIDs missing from product data", skipped)
+
+    num_users, num_of_rewards = top_items.shape
+    return {
+        "emails": [email for shard in shards for email in shard["emails"]],
+        "products": np.concatenate([shard["products"] for shard in shards]).reshape(num_users, num_of_rewards),
+        "discounts": np.concatenate([shard["discounts"] for shard in shards]).reshape(num_users, num_of_rewards),
+        # Codes are random either way; drawing them once keeps them independent of the shard count
+        "codes": generate_reward_codes((num_users, num_of_rewards)),
+    }
+
+def _reward_shard(user_ids, top_items, item_ids, lookups, start, stop):
+    """Emails, products and discounts for users `start` to `stop` of a batch, plus the count of skipped products."""
+    users, products, emails, pairs = lookups["users"], lookups["products"], lookups["emails"], lookups["pairs"]
+    user_ids = user_ids[start:stop]
+    top_items = top_items[start:stop]
+    num_users, num_of_rewards = top_items.shape
+
+    # Per-user and per-item columns, gathered into (user, product) pairs below
+    user_rows = [users[user_id] for user_id in user_ids]
+    item_rows = [products.get(product_id) for product_id in item_ids]
+    user_column = lambda name: np.repeat(np.array([row[name] for row in user_rows], dtype=object), num_of_rewards)
+    item_column = lambda name: np.array([row[name] if row else None for row in item_rows], dtype=object)[top_items].ravel()
+
+    known = np.array([row is not None for row in item_rows], dtype=bool)[top_items].ravel()
+
+    pair_users = np.repeat(np.array(user_ids, dtype=object), num_of_rewards)[known]
+    pair_products = item_ids[top_items].ravel()[known]
+    pair_stats = [pairs.get(pair) for pair in zip(pair_users, pair_products)]
+
+    discounts = np.zeros(num_users * num_of_rewards, dtype=np.uint8)
+    discounts[known] = compute_discounts({
+        "AgeGroup": user_column("AgeGroup")[known],
+        "Gender": user_column("Gender")[known],
+        "ProductCategory": item_column("ProductCategory")[known],
+        "Price": item_column("Price")[known],
+        "Rating": [stats["Rating"] if stats else np.nan for stats in pair_stats],
+        "NumberOfPurchases": [stats["NumberOfPurchases"] if stats else np.nan for stats in pair_stats],
+    })
+    recommended = top_items.astype(np.int32).ravel()
+    recommended[~known] = -1
+
+    user_emails = [emails.get(user_id) for user_id in user_ids]
+    return {
+        "emails": [email if email is not None and pd.notna(email) and email != "No Email Provided" else "" for email in user_emails],
+        "products": recommended,
+        "discounts": discounts,
+        "skipped": len(known) - int(known.sum()),
+    }
+
+def fit_evaluated(interactions, user_features, item_features, report):
+    """
+    Train with early stopping on a held-out split, then continue on every interaction.
+
+    The model from the best epoch is trained for EVALUATION_FINAL_EPOCHS more epochs
+    over all interactions, so the held-out ones are learned without refitting from
+    scratch. Its metrics are those of the best epoch, before the held-out rows were seen.
+
+    Returns:
+        tuple: (model, evaluation) where evaluation is the `fit_with_early_stopping`
+        summary without its per-epoch history. Both are None when the data is too
+        small to hold any interactions out.
+    """
+    train, test = split_interactions(interactions)
+    if test.nnz == 0:
+        log.warning("No interactions to hold out for evaluation, training for %d epochs", TRAINING_EPOCHS)
+        return None, None
+    result = fit_with_early_stopping(
+        MODEL_PARAMS, train, test, user_features, item_features, keep_best=True,
+        progress=lambda epoch, max_epochs: report("evaluating", 0.1 + 0.6 * (epoch - 1) / max_epochs),
+    )
+    log.info(
+        "Early stopping picked %d epochs: precision@k %.4f, AUC %.4f (%.1fs of training, %.1fs with evaluation)",
+        result["best_epoch"], result["precision"], result["auc"], result["seconds"], result["total_seconds"],
+    )
+    model = result.pop("model")
+    for epoch in range(EVALUATION_FINAL_EPOCHS):
+        report("training", 0.7 + 0.1 * epoch / EVALUATION_FINAL_EPOCHS)
+        with span("model_fit") as timing:
+            model.fit_partial(interactions, user_features=user_features, item_features=item_features, epochs=1, num_threads=thread_budget())
+            timing.rows = interactions.nnz
+    return model, {key: value for key, value in result.items() if key != "history"}
+
+def train_model(interactions_df, user_features_df, item_features_df, num_of_rewards, progress=None, evaluate=TRAINING_EVALUATION):
+    """
+    Train a LightFM model, store it and generate rewards for every user.
+
+    Args:
+        progress (callable): Optional `progress(stage, fraction)` callback, called as training advances.
+        evaluate (bool): Train by early stopping on a held-out split, then continue the
+            best model over every interaction (see `fit_evaluated`).
+
+    Returns:
+        dict: message, model_id and the path of the recommendation store, plus the
+        held-out "evaluation" when `evaluate` is set.
+    """
+    report = progress or (lambda stage, fraction: None)
+    log.info(
+        "Starting model training on %d interactions, %d customers and %d products",
+        len(interactions_df), len(user_features_df), len(item_features_df),
+    )
     try:
         # Prepare LightFM dataset
-        print("Interactions DataFrame:", interactions_df.shape, interactions_df.columns)
-        print("User Features DataFrame:", user_features_df.shape, user_features_df.columns)
-        print("Item Features DataFrame:", item_features_df.shape, item_features_df.columns)
-        dataset = Dataset()
-
-        print("Fitting dataset with users and items...")
-        # Fit users and items with their features
-        dataset.fit(
-            users=user_features_df["CustomerID"],
-            items=pd.concat([interactions_df["ProductID"], item_features_df["ProductID"]]).unique(),
-            user_features=user_features_df["Gender"].unique().tolist() + user_features_df["AgeGroup"].unique().tolist(),
-            item_features=item_features_df["ProductCategory"].unique().tolist() + item_features_df["Price"].astype(str).unique().tolist()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Interactions columns: %s", interactions_df.dtypes.to_dict())
+            log.debug("User features columns: %s", user_features_df.dtypes.to_dict())
+            log.debug("Item features columns: %s", item_features_df.dtypes.to_dict())
+        report("building_matrices", 0.05)
+        dataset, interactions, _, user_features, item_features = build_matrices(
+            interactions_df, user_features_df, item_features_df
         )
 
-        print("Dataset fitted. Building interaction matrices...")
-        # Build interactions matrix
-        (interactions, _) = dataset.build_interactions([
-            (row["CustomerID"], row["ProductID"], row["Rating"] + row["NumberOfPurchases"])
-            for _, row in interactions_df.iterrows()
-        ])
-
-        print("Interactions matrix built. Splitting into train and test sets...")
-        # Build user features matrix
-        user_features = dataset.build_user_features([
-            (row["CustomerID"], [row["Gender"], row["AgeGroup"]])
-            for _, row in user_features_df.iterrows()
-        ])
-
-        print("User features matrix built. Building item features matrix...")
-        # Build item features matrix
-        item_features = dataset.build_item_features([
-            (row["ProductID"], [row["ProductCategory"], str(row["Price"])])
-            for _, row in item_features_df.iterrows()
-        ])
-
-        print("Dataset and matrices prepared. Starting model training...")
-        
-        # Train LightFM model
-        model = LightFM(no_components=30, loss='warp')
-        model.fit(interactions, user_features=user_features, item_features=item_features, epochs=10, num_threads=4)
-
-        # Save model to a file
-        os.makedirs("backend/models", exist_ok=True)
-        model_id = str(uuid.uuid4())
-        model_path = f"backend/models/lightfm_model_{model_id}.pkl"
-        with open(model_path, "wb") as f:
-            pickle.dump(model, f)
-
-        print(f"Model saved to lightfm_model_{model_id}.pkl")
-
-        # Generate recommendations for all users
-        user_id_map, _, item_id_map, _ = dataset.mapping()
-        reverse_item_map = {v: k for k, v in item_id_map.items()}
-        num_items = len(item_id_map)
-
-        recommendations = {}
-        for index, (user_id, internal_user_id) in enumerate(user_id_map.items()):
-            if index >= 50:  # Limit to the first 10 users
-                break
-
-            scores = model.predict(internal_user_id, np.arange(num_items), user_features=user_features, item_features=item_features)
-            top_items = np.argsort(-scores)[:num_of_rewards]  # Get top N items based on scores
-            
-            user_data = user_features_df[user_features_df["CustomerID"] == user_id].iloc[0]
-            
-            email_row = interactions_df[interactions_df["CustomerID"] == user_id]["Email"]
-            email = email_row.iloc[0] if not email_row.empty and pd.notna(email_row.iloc[0]) else "No Email Provided"
-            
-            rewards = [] 
-            
-            for item_id in top_items:
-                product_id = reverse_item_map[item_id]
-                product_match = item_features_df[item_features_df["ProductID"] == product_id]
-                if product_match.empty:
-                    print(f"⚠️ Skipping missing ProductID: {product_id}")
-                    continue  # or handle gracefully
-
-                product_data = product_match.iloc[0]
-                product_data = item_features_df[item_features_df["ProductID"] == product_id].iloc[0]
-                
-                interaction_data = interactions_df[
-                    (interactions_df["CustomerID"] == user_id) & (interactions_df["ProductID"] == product_id)
-                ]
-                
-                # Calculate discount percentage
-                discount_percentage = calculate_discount_percentage(user_data, product_data, interaction_data)
-                
-                # Generate a reward code
-                reward_code = generate_reward_code()
-                
-                # Append reward string
-                rewards.append(f"{discount_percentage}% off {product_id} <{reward_code}>")
-            
-            # Append user_id and rewards to recommendations_with_discounts
-            recommendations[user_id] = {
-                "email": email,
-                "rewards": rewards
-            }
-            
-        # Save recommendations to a JSON file
-        os.makedirs("backend/recommendations", exist_ok=True)
-        recommendations_path = f"backend/recommendations/recommendations_{model_id}.json"
-        with open(recommendations_path, "w") as f:
-            json.dump(recommendations, f)
-
-        print(f"Recommendations saved to {recommendations_path}")
-        
-        # Filter recommendations to include only user_ids with valid emails
-        recommendations_with_emails = [
-            recommendation for recommendation in recommendations.values() if recommendation["email"] != "No Email Provided"
-        ]
-
-        # Save recommendations_with_emails to a JSON file
-        os.makedirs("backend/recommendations_with_emails", exist_ok=True)
-        recommendations_with_emails_path = f"backend/recommendations_with_emails/recommendations_{model_id}.json"
-        with open(recommendations_with_emails_path, "w") as f:
-            json.dump(recommendations_with_emails, f)
-
-        print(f"Recommendations with emails saved to {recommendations_with_emails_path}")
-
-        return {
-            "message": "Model trained successfully!",
-            "model_id": model_id,
-            "recommendations": recommendations,
+        model, evaluation = None, None
+        if evaluate:
+            model, evaluation = fit_evaluated(interactions, user_features, item_features, report)
+
+        if model is None:
+            # Train LightFM model
+            # One epoch per fit_partial call, which is equivalent to fit(epochs=10), so progress can be reported
+            model = LightFM(**MODEL_PARAMS)
+            for epoch in range(TRAINING_EPOCHS):
+                report("training", 0.1 + 0.7 * epoch / TRAINING_EPOCHS)
+                with span("model_fit") as timing:
+                    model.fit_partial(interactions, user_features=user_features, item_features=item_features, epochs=1, num_threads=thread_budget())
+                    timing.rows = interactions.nnz
+
+        lookups = build_reward_lookups(interactions_df, user_features_df, item_features_df)
+        result = publish_model(model, dataset, user_features, item_features, lookups, num_of_rewards, report)
+        if evaluation is not None:
+            result["evaluation"] = evaluation
+        return result
+
+    except Exception:
+        log.exception("Error occurred during model training")
+        raise
+
+def resize_model(model, no_user_features, no_item_features):
+    """
+    Grow a fitted model's parameters to cover features added since it was trained.
+
+    New rows are initialised the way `LightFM` initialises a fresh model: small
+    random embeddings, zero biases and fresh optimizer accumulators. Existing
+    rows, including their learning-rate history, are left untouched.
+    """
+    accumulator_start = 1.0 if model.learning_schedule == "adagrad" else 0.0
+    for prefix, no_features in (("user", no_user_features), ("item", no_item_features)):
+        embeddings = getattr(model, f"{prefix}_embeddings")
+        added = no_features - embeddings.shape[0]
+        if added <= 0:
+            continue
+        new_embeddings = ((model.random_state.rand(added, model.no_components) - 0.5) / model.no_components).astype(np.float32)
+        new_biases = np.zeros(added, dtype=np.float32)
+        grown = {
+            "embeddings": new_embeddings,
+            "embedding_gradients": np.full_like(new_embeddings, accumulator_start),
+            "embedding_momentum": np.zeros_like(new_embeddings),
+            "biases": new_biases,
+            "bias_gradients": np.full_like(new_biases, accumulator_start),
+            "bias_momentum": np.zeros_like(new_biases),
         }
+        for name, rows in grown.items():
+            attribute = f"{prefix}_{name}"
+            setattr(model, attribute, np.concatenate([getattr(model, attribute), rows]))
+    return model
 
-    except Exception as e:
-        import traceback
-        print("Error occurred during model training:", str(e))
-        traceback.print_exc()
-        return jsonify({"error": str(e)}), 500
+def update_model(base_model_id, interactions_df, user_features_df, item_features_df, num_of_rewards, epochs=WARM_START_EPOCHS, progress=None):
+    """
+    Warm-start a new model version from a stored model and a delta of new data.
+
+    The previous model's mappings are extended with new users, items and feature
+    values, its parameters are grown to match, and `fit_partial` runs over the new
+    interactions only. The result is published under a new model_id; the base
+    model is left as it was. Only users the new data touches are rescored before
+    publishing; the others start out with the base model's stored rewards until
+    `refresh_recommendations` rescores them.
+
+    Args:
+        base_model_id (str): Model to continue training from.
+        interactions_df (pd.DataFrame): New interactions only.
+        user_features_df (pd.DataFrame): New or changed customers; must include every
+            customer in `interactions_df` the base model has not seen.
+        item_features_df (pd.DataFrame): New or changed products.
+        num_of_rewards (int): Rewards generated per user.
+        epochs (int): Passes over the new interactions.
+        progress (callable): Optional `progress(stage, fraction)` callback.
+
+    Returns:
+        dict: message, model_id, the path of the recommendation store and "refresh",
+        true when users still carry the base model's rewards.
+    """
+    report = progress or (lambda stage, fraction: None)
+    log.info("Starting incremental training from model %s on %d new interactions", base_model_id, len(interactions_df))
+    try:
+        report("loading_model", 0.02)
+        base = load_model(base_model_id)
+        if base.get("lookups") is None:
+            raise ValueError(f"Model {base_model_id} was saved without reward data and cannot be retrained incrementally")
+        # The cached bundle keeps serving the base model, so train a copy
+        model = copy.deepcopy(base["model"])
+
+        report("building_matrices", 0.05)
+        dataset, interactions, _, user_features, item_features = extend_matrices(
+            ColumnarDataset(*base["mapping"]),
+            base["user_features"],
+            base["item_features"],
+            interactions_df,
+            user_features_df,
+            item_features_df,
+        )
+        resize_model(model, user_features.shape[1], item_features.shape[1])
+        log.info("Model extended to %d users and %d items", user_features.shape[0], item_features.shape[0])
+
+        for epoch in range(epochs):
+            report("training", 0.1 + 0.7 * epoch / epochs)
+            with span("model_fit", mode="warm_start") as timing:
+                model.fit_partial(interactions, user_features=user_features, item_features=item_features, epochs=1, num_threads=thread_budget())
+                timing.rows = interactions.nnz
+
+        lookups = merge_reward_lookups(
+            base["lookups"], build_reward_lookups(interactions_df, user_features_df, item_features_df)
+        )
+        reuse = None
+        if not WARM_START_RESCORE_ALL:
+            reuse = reusable_rewards(base_model_id, dataset, interactions_df, user_features_df, num_of_rewards)
+        result = publish_model(
+            model, dataset, user_features, item_features, lookups, num_of_rewards, report, parent_model_id=base_model_id,
+            reuse=reuse,
+        )
+        result["refresh"] = reuse is not None
+        return result
+
+    except Exception:
+        log.exception("Error occurred during incremental training")
+        raise
+
+def reusable_rewards(base_model_id, dataset, interactions_df, user_features_df, num_of_rewards):
+    """
+    Rows of the base model's recommendation store a warm-started model can publish as they are.
+
+    Users who are new, have new interactions or changed features are rescored
+    before publishing. Everyone else keeps their stored rewards and reward codes
+    until `refresh_recommendations` rescores them off the critical path.
+
+    Returns:
+        tuple: (store, rows) with the base model's store and, for each user of
+        `dataset` in index order, the store row to copy or -1 to rescore; None
+        when the store is missing or was written for another number of rewards.
+    """
+    try:
+        store = open_store(base_model_id)
+    except FileNotFoundError:
+        return None
+    user_id_map, _, item_id_map, _ = dataset.mapping()
+    # Extended mappings keep existing items at their indices, so stored products carry over
+    if store.meta["n"] != num_of_rewards or list(item_id_map)[:len(store.item_ids)] != np.char.decode(store.item_ids, "utf-8").tolist():
+        return None
+
+    rows = store.rows_of(list(user_id_map))
+    touched = pd.concat([interactions_df["CustomerID"].astype(str), user_features_df["CustomerID"].astype(str)]).unique()
+    rows[[user_id_map[user_id] for user_id in touched if user_id in user_id_map]] = -1
+    return store, rows
+
+def refresh_recommendations(model_id, num_of_rewards):
+    """
+    Rescore every user of a published model and rewrite its recommendation store.
+
+    Follows a warm start published with `reusable_rewards`. Users whose products
+    come out the same keep their stored discounts and reward codes. Skipped once
+    an email campaign for the model has started, so emailed codes stay the stored ones.
+
+    Returns:
+        bool: Whether the store was rewritten.
+    """
+    if os.path.exists(ledger_path(model_id)):
+        log.info("Not refreshing recommendations of model %s, its email campaign has started", model_id)
+        return False
+    bundle = load_model(model_id)
+    index = bundle["index"] if bundle.get("index") is not None else bundle["indexes"]["exact"]
+    user_ids = list(bundle["user_id_map"])
+
+    with span("scoring", mode=index.mode) as timing:
+        top_items_by_user, _ = index.search(bundle["representations"][1], num_of_rewards)
+        timing.rows = len(top_items_by_user)
+    with span("reward_generation") as timing:
+        columns = generate_reward_columns(user_ids, top_items_by_user, bundle["item_ids"], bundle["lookups"])
+        timing.rows = len(columns["products"])
+
+    store = open_store(model_id)
+    rows = store.rows_of(user_ids)
+    same = np.flatnonzero(rows >= 0)
+    same = same[(columns["products"][same] == store.products[rows[same]]).all(axis=1)]
+    columns["discounts"][same] = store.discounts[rows[same]]
+    columns["codes"][same] = store.codes[rows[same]]
+
+    with span("recommendations_write"):
+        write_store(
+            model_id, user_ids, columns["emails"], bundle["item_ids"], columns["products"], columns["discounts"], columns["codes"]
+        )
+    log.info("Refreshed recommendations of model %s: %d of %d users changed", model_id, len(user_ids) - len(same), len(user_ids))
+    return True
+
+def publish_model(
+    model, dataset, user_features, item_features, lookups, num_of_rewards, report, parent_model_id=None,
+    retrieval_mode=RETRIEVAL_MODE, reuse=None,
+):
+    """
+    Save a trained model under a new model_id and write rewards for every user it knows.
+
+    Args:
+        model (LightFM): Trained model.
+        dataset (ColumnarDataset): Dataset whose mappings produced the training matrices.
+        user_features (scipy.sparse.csr_matrix): User features matrix used in training.
+        item_features (scipy.sparse.csr_matrix): Item features matrix used in training.
+        lookups (dict): Reward lookup tables covering every user in `dataset`.
+        num_of_rewards (int): Rewards generated per user.
+        report (callable): `report(stage, fraction)` progress callback.
+        parent_model_id (str): Model this one was warm-started from, if any.
+        retrieval_mode (str): "exact" or "ivf" retrieval index used to pick every user's top items.
+        reuse (tuple): (store, rows) from `reusable_rewards`; users with a row are copied from
+            that store instead of being rescored.
+
+    Returns:
+        dict: message, model_id and the path of the recommendation store.
+    """
+    # Build the item retrieval index, then save it with the model, its mappings and feature matrices
+    report("saving_model", 0.8)
+    with span("index_build", mode=retrieval_mode):
+        representations = get_representations(model, user_features, item_features)
+        index = build_index(representations[2], representations[3], retrieval_mode)
+    model_id = str(uuid.uuid4())
+    with span("model_write"):
+        model_path = save_model(model_id, model, dataset, user_features, item_features, lookups, parent_model_id, index)
+
+    log.info("Model saved to %s", model_path)
+
+    # Generate recommendations for all users
+    user_id_map, _, item_id_map, _ = dataset.mapping()
+    item_ids = np.array(list(item_id_map), dtype=object)
+
+    user_ids = list(user_id_map)
+    user_embeddings, scored_ids = representations[1], user_ids
+    if reuse is not None:
+        rescored = np.flatnonzero(reuse[1] < 0)
+        user_embeddings, scored_ids = user_embeddings[rescored], [user_ids[user] for user in rescored]
+        log.info("Rescoring %d of %d users; the rest keep the rewards of model %s", len(rescored), len(user_ids), parent_model_id)
+
+    report("scoring", 0.85)
+    with span("scoring", mode=index.mode) as timing:
+        top_items_by_user, _ = index.search(user_embeddings, num_of_rewards)
+        timing.rows = len(top_items_by_user)
+
+    report("generating_rewards", 0.9)
+    with span("reward_generation") as timing:
+        columns = generate_reward_columns(scored_ids, top_items_by_user, item_ids, lookups)
+        timing.rows = len(columns["products"])
+    if reuse is not None:
+        columns = _merge_stored_rewards(columns, rescored, *reuse)
+
+    # Save recommendations as a columnar store; JSON is served from it as a view
+    report("writing_recommendations", 0.95)
+    with span("recommendations_write"):
+        recommendations_path = write_store(
+            model_id, user_ids, columns["emails"], item_ids, columns["products"], columns["discounts"], columns["codes"]
+        )
+    log.info("Recommendations for %d customers saved to %s", len(user_ids), recommendations_path)
+
+    return {
+        "message": "Model trained successfully!",
+        "model_id": model_id,
+        "recommendations_path": recommendations_path,
+    }
+
+def _merge_stored_rewards(columns, rescored, store, rows):
+    """Reward columns for every user: `columns` for the `rescored` users, stored rows for the rest."""
+    kept = np.flatnonzero(rows >= 0)
+    merged = {}
+    for name in ("products", "discounts", "codes"):
+        merged[name] = np.empty((len(rows), columns[name].shape[1]), dtype=columns[name].dtype)
+        merged[name][rescored] = columns[name]
+        merged[name][kept] = getattr(store, name)[rows[kept]]
+    emails = np.empty(len(rows), dtype=object)
+    emails[rescored] = columns["emails"]
+    emails[kept] = np.char.decode(store.emails[rows[kept]], "utf-8")
+    merged["emails"] = emails.tolist()
+    return merged
+
+def recommendations_file(model_id):
+    """Path of the recommendations JSON written by `train_model` before the columnar store."""
+    return f"backend/recommendations/recommendations_{model_id}.json"
+
+def load_recommendations(model_id):
+    """Load the recommendations stored for `model_id`, keyed by CustomerID."""
+    try:
+        return open_store(model_id).to_dict()
+    except FileNotFoundError:
+        # Models trained before the columnar store
+        path = recommendations_file(model_id)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Recommendations for model_id {model_id} not found")
+        with open(path, "r") as f:
+            return json.load(f)
 
 def get_recommendations(model_id):
     try:
@@ -211,4 +580,45 @@ def get_recommendations(model_id):
         # Serve the recommendations JSON file
         return send_file(recommendations_path, mimetype='application/json')
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
+
+if __name__ == "__main__":
+    # Benchmark, run from the repo root: python backend/train_lightfm.py [num_interactions] [delta_interactions]
+    # Reports the time to a trained model and the time spent publishing it (scoring and
+    # writing rewards). A warm start publishes after rescoring the users the delta touches
+    # and refreshes the rest afterwards; set WARM_START_RESCORE_ALL=1 to rescore everyone first.
+    import sys
+    import time
+    from synthetic_data import generate_frames
+
+    def timed(train, *args):
+        stages = {}
+        start = time.perf_counter()
+        result = train(*args, progress=lambda stage, fraction: stages.setdefault(stage, time.perf_counter()))
+        end = time.perf_counter()
+        return stages["saving_model"] - start, end - stages["saving_model"], result
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    delta_size = int(sys.argv[2]) if len(sys.argv) > 2 else size // 100
+    interactions_df, user_features_df, item_features_df = generate_frames(size)
+    base_model_id = train_model(interactions_df, user_features_df, item_features_df, 3)["model_id"]
+    full_fit, full_publish, _ = timed(train_model, interactions_df, user_features_df, item_features_df, 3)
+
+    # The delta touches existing customers and products plus a few percent of new ones
+    num_users, num_items = len(user_features_df), len(item_features_df)
+    delta_interactions, delta_users, delta_items = generate_frames(
+        delta_size, num_users=int(num_users * 1.02), num_items=int(num_items * 1.02), seed=1
+    )
+    delta_users = delta_users[delta_users["CustomerID"].isin(delta_interactions["CustomerID"])]
+    delta_items = delta_items.iloc[num_items:]
+    warm_fit, warm_publish, warm = timed(update_model, base_model_id, delta_interactions, delta_users, delta_items, 3)
+    start = time.perf_counter()
+    if warm["refresh"]:
+        refresh_recommendations(warm["model_id"], 3)
+    refresh_seconds = time.perf_counter() - start
+
+    print(f"full train on {size} interactions: fit {full_fit:.2f}s  publish {full_publish:.2f}s")
+    print(
+        f"warm start on {delta_size} new interactions: fit {warm_fit:.2f}s  publish {warm_publish:.2f}s  "
+        f"background refresh {refresh_seconds:.2f}s"
+    )
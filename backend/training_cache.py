@@ -0,0 +1,209 @@
+# Upload fingerprint cache
+# ----- Maps a content hash of the uploaded data plus training settings to the job and model it produced -----
+
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from jobs import get_job, update_job, job_abandoned
+from model_registry import model_path, delete_model, model_last_used
+from recommendation_store import store_path, delete_store
+from dataset_store import FRAME_KINDS
+from email_ledger import campaign_status
+from instrumentation import get_logger
+
+CACHE_DIR = os.path.join("backend", "training_cache")
+# Entries not used for this long are evicted along with their model and recommendations
+CACHE_MAX_AGE_SECONDS = int(os.environ.get("TRAINING_CACHE_MAX_AGE_SECONDS", 7 * 24 * 3600))
+# Disk used by cached models and recommendation stores before the least recently used are evicted
+CACHE_MAX_BYTES = int(os.environ.get("TRAINING_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# Models loaded or served this recently (model_registry.touch_model) are never evicted
+CACHE_IN_USE_SECONDS = int(os.environ.get("TRAINING_CACHE_IN_USE_SECONDS", 3600))
+
+log = get_logger(__name__)
+
+
+def frame_digest(df):
+    """
+    Hash of a DataFrame's content, independent of row order, column order and dtype encoding.
+
+    Every row is hashed by value over the sorted columns, so a re-upload of the same
+    CSV hashes the same whether it came as JSON or a file, categorical or not.
+    """
+    if df is None:
+        return "none"
+    columns = sorted(df.columns)
+    row_hashes = np.sort(pd.util.hash_pandas_object(df[columns], index=False).to_numpy())
+    digest = hashlib.sha256(json.dumps(columns).encode("utf-8"))
+    digest.update(row_hashes.tobytes())
+    return digest.hexdigest()
+
+
+def fingerprint(frames, hyperparameters):
+    """
+    Fingerprint of a training run.
+
+    Args:
+        frames (dict): kind -> DataFrame (or None) for customers, products and interactions.
+        hyperparameters (dict): Settings from `train_lightfm.training_hyperparameters`.
+
+    Returns:
+        str: Hex digest identifying the inputs.
+    """
+    digest = hashlib.sha256(json.dumps(hyperparameters, sort_keys=True).encode("utf-8"))
+    for kind in FRAME_KINDS:
+        digest.update(f"{kind}:{frame_digest(frames.get(kind))}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+
+def _write_entry(entry):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _entry_path(entry["fingerprint"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+
+def _read_entries():
+    entries = []
+    if not os.path.isdir(CACHE_DIR):
+        return entries
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(CACHE_DIR, name), "r") as f:
+                    entries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return entries
+
+
+def _remove(entry):
+    """Drop an entry together with the model and recommendations it points to."""
+    if entry.get("model_id"):
+        delete_model(entry["model_id"])
+        delete_store(entry["model_id"])
+    path = _entry_path(entry["fingerprint"])
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def find_cached_run(key):
+    """
+    Cached training run for a fingerprint.
+
+    Entries whose job is still queued or running are returned too, so a duplicate
+    upload attaches to the training already under way. Failed jobs, jobs whose
+    process is gone or hung (`jobs.job_abandoned`, then marked failed) and entries
+    whose model or recommendations are gone count as misses.
+
+    Returns:
+        dict: fingerprint, job_id, model_id (None until trained), analytics and
+        timestamps, or None on a miss.
+    """
+    try:
+        with open(_entry_path(key), "r") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if entry.get("model_id") is None:
+        try:
+            job = get_job(entry["job_id"])
+        except FileNotFoundError:
+            job = {"state": "failed"}
+        if job_abandoned(job):
+            log.warning("Training job %s was abandoned in state %s, not reusing it", entry["job_id"], job["state"])
+            job = update_job(entry["job_id"], state="failed", error="Training process exited or stopped reporting progress")
+        if job["state"] == "failed":
+            _remove(entry)
+            return None
+        entry["model_id"] = job.get("model_id")
+
+    if entry["model_id"] is not None and not (
+        os.path.exists(model_path(entry["model_id"])) and os.path.exists(store_path(entry["model_id"]))
+    ):
+        _remove(entry)
+        return None
+
+    entry["last_used_at"] = time.time()
+    _write_entry(entry)
+    return entry
+
+
+def remember_run(key, job_id, analytics):
+    """Record the training job started for a fingerprint, then evict stale entries."""
+    now = time.time()
+    _write_entry({
+        "fingerprint": key, "job_id": job_id, "model_id": None, "analytics": analytics,
+        "created_at": now, "last_used_at": now,
+    })
+    evict()
+
+
+def _disk_bytes(model_id):
+    total = 0
+    path = model_path(model_id)
+    if os.path.exists(path):
+        total += os.path.getsize(path)
+    for root, _, files in os.walk(store_path(model_id)):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def _campaign_running(model_id):
+    try:
+        return campaign_status(model_id)["state"] == "running"
+    except FileNotFoundError:
+        return False
+
+
+def evict(max_age_seconds=CACHE_MAX_AGE_SECONDS, max_bytes=CACHE_MAX_BYTES, in_use_seconds=CACHE_IN_USE_SECONDS):
+    """
+    Evict entries unused for `max_age_seconds`, then the least recently used until
+    their models and recommendations fit in `max_bytes`.
+
+    An entry counts as used when it is hit here and whenever its model is loaded
+    or its recommendations opened. Models used within `in_use_seconds`, or with an
+    email campaign running, are never evicted, even over the budget.
+
+    Returns:
+        int: Number of entries evicted.
+    """
+    now = time.time()
+    entries = _read_entries()
+    for entry in entries:
+        # Resolve finished jobs so their models count against the budget
+        if entry.get("model_id") is None:
+            try:
+                entry["model_id"] = get_job(entry["job_id"]).get("model_id")
+            except FileNotFoundError:
+                pass
+        if entry.get("model_id"):
+            entry["last_used_at"] = max(entry["last_used_at"], model_last_used(entry["model_id"]))
+    entries.sort(key=lambda entry: entry["last_used_at"], reverse=True)
+
+    evicted = 0
+    kept = 0
+    total = 0
+    for entry in entries:
+        size = _disk_bytes(entry["model_id"]) if entry.get("model_id") else 0
+        in_use = entry.get("model_id") and (
+            now - entry["last_used_at"] < in_use_seconds or _campaign_running(entry["model_id"])
+        )
+        # The most recently used entry is kept whatever its size
+        if not in_use and (now - entry["last_used_at"] > max_age_seconds or (total + size > max_bytes and kept)):
+            log.info("Evicting cached training run %s (model %s)", entry["fingerprint"][:12], entry.get("model_id"))
+            _remove(entry)
+            evicted += 1
+        else:
+            kept += 1
+            total += size
+    return evicted
@@ -49,14 +49,33 @@ const FileUploader = () => {
   const handleFileUpload = (fileType, file) => {
     if (!file) return;
 
-    const reader = new FileReader();
-    reader.onload = (e) => {
-      setCsvData(prev => ({
+    // Keep the File itself; it is streamed to the backend as multipart form data
+    setCsvData(prev => ({
+      ...prev,
+      [fileType]: file
+    }));
+  };
+
+  const pollTrainingJob = async (jobId) => {
+    // Training runs in the background on the server; poll until the model is ready
+    while (true) {
+      const response = await fetch(`https://lifehack-hackathon.onrender.com/jobs/${jobId}`);
+      const job = await response.json();
+      if (!response.ok) {
+        throw new Error(job.error || `HTTP error! status: ${response.status}`);
+      }
+      if (job.state === 'succeeded') {
+        return job.recommended_rewards;
+      }
+      if (job.state === 'failed') {
+        throw new Error(`Model training failed: ${job.error}`);
+      }
+      setUploadStatus(prev => ({
         ...prev,
-        [fileType]: e.target.result
+        message: `Training model... ${Math.round((job.progress || 0) * 100)}%`
       }));
-    };
-    reader.readAsText(file);
+      await new Promise(resolve => setTimeout(resolve, 2000));
+    }
   };
 
   const uploadDataToBackend = async () => {
@@ -66,12 +85,14 @@ const FileUploader = () => {
 
     try {
       console.log('Making request to backend...');
-      const response = await fetch('https://lifehack-hackathon.onrender.com/upload_data', {
+      const formData = new FormData();
+      Object.entries(csvData).forEach(([fileType, file]) => {
+        if (file) formData.append(fileType, file);
+      });
+
+      const response = await fetch('https://lifehack-hackathon.onrender.com/upload_files', {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify(csvData)
+        body: formData
       });
 
       console.log('Response status:', response.status);
@@ -99,9 +120,14 @@ const FileUploader = () => {
         
         console.log('Setting analytics to:', result.analytics);
         setAnalytics(result.analytics);
-        setRecommendations(result.recommended_rewards);
 
         setRenderKey(prev => prev + 1);
+
+        if (result.training_job) {
+          const recommendedRewards = await pollTrainingJob(result.training_job.job_id);
+          setRecommendations(recommendedRewards);
+          setUploadStatus(prev => ({ ...prev, message: result.message }));
+        }
         
       } else {
         setUploadStatus({
@@ -131,10 +157,29 @@ const FileUploader = () => {
       });
 
       const result = await response.json();
-      if (response.ok) {
-        setEmailStatus(`✅ Emails sent: ${result.sent_count}`);
-      } else {
+      if (!response.ok && response.status !== 409) {
         setEmailStatus(`❌ Error: ${result.error}`);
+        return;
+      }
+
+      // Emails are sent in the background; poll the campaign until every recipient is handled
+      while (true) {
+        const statusResponse = await fetch(`https://lifehack-hackathon.onrender.com/campaigns/${sendModelId}`);
+        const campaign = await statusResponse.json();
+        if (!statusResponse.ok) {
+          setEmailStatus(`❌ Error: ${campaign.error}`);
+          return;
+        }
+        if (campaign.state === 'completed') {
+          setEmailStatus(`✅ Emails sent: ${campaign.sent}${campaign.failed ? ` (${campaign.failed} failed)` : ''}`);
+          return;
+        }
+        if (campaign.state === 'failed' || campaign.state === 'stalled') {
+          setEmailStatus(`❌ Email campaign ${campaign.state} after ${campaign.sent} emails: ${campaign.error || 'send again to resume'}`);
+          return;
+        }
+        setEmailStatus(`📤 Sending emails... ${campaign.sent}/${campaign.total}`);
+        await new Promise(resolve => setTimeout(resolve, 2000));
       }
     } catch (err) {
       setEmailStatus(`❌ Email dispatch failed: ${err.message}`);
@@ -205,7 +250,7 @@ const FileUploader = () => {
               <div className="relative">
                 <input 
                   type="file" 
-                  accept=".csv"
+                  accept=".csv,.gz"
                   onChange={(e) => handleFileUpload('customers', e.target.files[0])}
                   className="absolute inset-0 w-full h-full opacity-0 cursor-pointer z-10"
                 />
@@ -230,7 +275,7 @@ const FileUploader = () => {
               <div className="relative">
                 <input 
                   type="file" 
-                  accept=".csv"
+                  accept=".csv,.gz"
                   onChange={(e) => handleFileUpload('products', e.target.files[0])}
                   className="absolute inset-0 w-full h-full opacity-0 cursor-pointer z-10"
                 />
@@ -255,7 +300,7 @@ const FileUploader = () => {
               <div className="relative">
                 <input 
                   type="file" 
-                  accept=".csv"
+                  accept=".csv,.gz"
                   onChange={(e) => handleFileUpload('interactions', e.target.files[0])}
                   className="absolute inset-0 w-full h-full opacity-0 cursor-pointer z-10"
                 />